@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+"""Render time and Redis memory of the ways to persist the chart.
+
+- svg: only the render output (the default).
+- chart_state: the compact inputs and geometry (STORE_CHART_STATE=1).
+- pickles: the PsychroChart and its axes pickled after each render, as
+  before the chart state.
+
+Usage: `python benchmarks/bench_chart_state.py [--redis-url URL] [-n 8]`.
+Without a Redis URL it runs with fakeredis (from `requirements_test.txt`).
+The stored size of each var is its encoded value, or its `MEMORY USAGE`
+with a real Redis server.
+"""
+import argparse
+from io import BytesIO
+from statistics import median
+from time import perf_counter
+
+from redis.exceptions import ResponseError
+import yaml
+
+from psychrochartmaker.make_charts import (
+    _chart_backgrounds, make_psychrochart, rebuild_psychrochart)
+from psychrodata.common import CHART_STYLE_DEFAULT, CHART_ZONES_DEFAULT
+from psychrodata.redis_mng import get_var, set_vars
+
+
+POINTS = {
+    'Office': {'xy': (24.5, 45.), 'style': {'marker': 'o', 'color': 'red'},
+               'label': 'Office'},
+    'Living': {'xy': (21., 55.), 'style': {'marker': 'o', 'color': 'blue'},
+               'label': 'Living'}}
+ARROWS = {
+    'Office': {'xy': [(22., 40.), (24.5, 45.)],
+               'style': {'color': [1, 0, 0, .6], 'arrowstyle': 'wedge'}},
+    'Living': {'xy': [(23., 50.), (21., 55.)],
+               'style': {'color': [0, 0, 1, .6], 'arrowstyle': 'wedge'}}}
+MODES = ('svg', 'chart_state', 'pickles')
+
+
+def _get_redis(parser, redis_url):
+    if redis_url:
+        from redis import StrictRedis
+        return StrictRedis.from_url(redis_url)
+    try:
+        import fakeredis
+    except ImportError:
+        parser.error('fakeredis is not installed, use a --redis-url or '
+                     '`pip install -r requirements_test.txt`')
+    return fakeredis.FakeStrictRedis()
+
+
+def _stored_size(redis, key):
+    # MEMORY USAGE needs Redis >= 4 (and a redis-py with it)
+    try:
+        return redis.memory_usage(key)
+    except (AttributeError, ResponseError):
+        return redis.strlen(key)
+
+
+def _render(redis, mode):
+    tic = perf_counter()
+    make_psychrochart(redis, store_chart_state=mode == 'chart_state')
+    if mode == 'pickles':
+        chart = next(iter(_chart_backgrounds.values()))
+        set_vars(redis, {'chart': chart, 'chart_axes': chart.axes},
+                 pickle_keys=('chart', 'chart_axes'))
+    return perf_counter() - tic
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--redis-url', help='Redis server (or fakeredis)')
+    parser.add_argument('-n', '--renders', type=int, default=8)
+    args = parser.parse_args()
+
+    redis = _get_redis(parser, args.redis_url)
+    with open(CHART_STYLE_DEFAULT) as f:
+        chart_style = yaml.safe_load(f)
+    with open(CHART_ZONES_DEFAULT) as f:
+        zones = yaml.safe_load(f)
+    set_vars(redis, {'chart_style': chart_style, 'chart_zones': zones,
+                     'last_points': POINTS, 'arrows': ARROWS})
+    # Warm chart background
+    make_psychrochart(redis)
+
+    for mode in MODES:
+        times = [_render(redis, mode) for _ in range(args.renders)]
+        print(f"Render with {mode}: {1000 * median(times):.0f} ms "
+              f"(median of {args.renders})")
+
+    for key in ('svg_chart', 'chart_state', 'chart', 'chart_axes'):
+        print(f"Stored {key}: {_stored_size(redis, key) / 1000:.1f} kB")
+
+    tic = perf_counter()
+    chart = rebuild_psychrochart(get_var(redis, 'chart_state'))
+    chart.save(BytesIO(), format='svg')
+    print(f"Rebuild from chart_state: {1000 * (perf_counter() - tic):.0f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import datetime as dt
 import logging
 from math import floor
 import os
@@ -6,13 +7,14 @@ import sys
 from time import time
 
 # noinspection PyUnresolvedReferences
-from flask import Flask, jsonify, make_response, g
+from flask import Flask, jsonify, make_response, request, g
 from flask_redis import Redis
 from werkzeug.contrib.fixers import ProxyFix
 from werkzeug.exceptions import default_exceptions, HTTPException
 from werkzeug.routing import Rule
 
 from psychrodata import Config
+from psychrodata.content import ENCODINGS
 # noinspection PyUnresolvedReferences
 from psychrodata.redis_mng import get_celery, get_var, set_var
 
@@ -77,9 +79,14 @@ celery = create_celery(app)
 ROUTE_HA_CONFIG = '/ha_config'
 ROUTE_HA_STATES = '/ha_states'
 ROUTE_HA_EVOLUTION = '/ha_evolution'
+ROUTE_HA_HISTORY = '/ha_history/<sensor>'
 ROUTE_CHARTCONFIG = '/chartconfig'
 ROUTE_SVGCHART = '/svgchart'
+ROUTE_RASTERCHART = '/chart.<image_type>'
+ROUTE_CHART_GEOMETRY = '/chart_geometry'
 ROUTE_CLEAN_CACHE = '/clean'
+ROUTE_SENSOR_READINGS = '/readings'
+ROUTE_STREAM = '/stream'
 
 
 ###############################################################################
@@ -101,23 +108,61 @@ ATTR_TEMPERATURE = 'temperature'
 ATTR_HUMIDITY = 'humidity'
 
 SVG_MIMETYPE = 'image/svg+xml'
+PNG_MIMETYPE = 'image/png'
+WEBP_MIMETYPE = 'image/webp'
 JSON_MIMETYPE = 'application/json'
 MIMETYPES = {
     'svg': SVG_MIMETYPE,
+    'png': PNG_MIMETYPE,
+    'webp': WEBP_MIMETYPE,
     'json': JSON_MIMETYPE}
 
 
-def image_response(bytes_image, image_type='svg'):
+def conditional_response(response, meta, etag_suffix=None):
+    """Set ETag and Last-Modified, and answer with 304 if not modified.
+
+    `meta` is the dict with the 'etag' and 'ts' of the content.
+    """
+    etag = meta['etag']
+    if etag_suffix:  # Different entity for each content encoding
+        etag += '-' + etag_suffix
+    response.set_etag(etag)
+    response.last_modified = dt.datetime.utcfromtimestamp(meta['ts'])
+    # Always revalidate, the content changes with each new chart
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
+def image_response(bytes_image, image_type='svg', meta=None, variants=None):
+    """Image response, conditional if `meta` is passed.
+
+    `variants` are precompressed contents by encoding, used if the client
+    accepts them.
+    """
     # try:
     mimetype = MIMETYPES[image_type]
     # except KeyError:
     #     mimetype = JSON_MIMETYPE
 
+    encoding = None
+    if variants:
+        encoding = request.accept_encodings.best_match(
+            [enc for enc in ENCODINGS if enc in variants])
+    if encoding is not None:
+        response = make_response(variants[encoding], 200)
+        response.headers['Content-Encoding'] = encoding
+    else:
+        response = make_response(bytes_image, 200)
+    response.mimetype = mimetype
+    if variants:
+        response.vary.add('Accept-Encoding')
+    if meta is not None:
+        response = conditional_response(response, meta, encoding)
+
     tic = g.get('tic_request')
     took = time() - tic
-    logging.info(f"IMG RESPONSE [{image_type}] took {took:.4f}s")
-    response = make_response(bytes_image, 200)
-    response.mimetype = mimetype
+    logging.info(f"IMG RESPONSE [{image_type}, {response.status_code}, "
+                 f"{encoding or 'identity'}] took {took:.4f}s")
     return response
 
 
@@ -200,7 +245,7 @@ if sys.argv[0].endswith('celery'):
     @celery.on_after_configure.connect
     def init_chart_config(sender, **kwargs):
         # from psychrochartmaker import TASK_PERIODIC_GET_HA_STATES
-        from psychrochartmaker import TASK_CLEAN_CACHE_DATA
+        from psychrochartmaker import TASK_CLEAN_CACHE_DATA, send_render_task
         from psychrochartmaker.tasks import periodic_get_ha_states
 
         logging.warning(f"On INIT_CHART_CONFIG")
@@ -217,7 +262,7 @@ if sys.argv[0].endswith('celery'):
         set_var(redis, 'scheduler', scheduler)
 
         # Make first psychrochart
-        celery.send_task('create_psychrochart')
+        send_render_task(celery, redis)
         return True
 else:
     # noinspection PyUnresolvedReferences,PyPep8
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Process-local copy of the last chart (SVG, rasters and geometry) and
+evolution data.
+
+They are reloaded from Redis only when the render worker announces a new
+version in the pub/sub channels, so serving them doesn't touch Redis. While
+the subscription is down, they are read from Redis in each request.
+Clients of the event stream wait for the updates here, so they don't need
+a Redis connection each.
+"""
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+from redis.exceptions import RedisError
+
+from psychrochartmaker import raster_var
+from psychrodata.content import ENCODINGS
+from psychrodata.redis_mng import (
+    CHANNEL_CHART_VERSION, CHANNEL_EVOLUTION_VERSION, get_var, get_vars)
+
+
+RECONNECT_DELAY = 5  # seconds
+RASTERS_MAXSIZE = 8
+
+
+class ChartCache(object):
+    """Last chart (SVG with its metadata and compressed variants, and an
+    LRU of raster images) and evolution data, updated by the pub/sub
+    notifications of new versions.
+    """
+
+    def __init__(self, redis):
+        self._redis = redis
+        self._lock = threading.Lock()
+        self._listener = None
+        self._subscribed = False
+        self._chart = (None, None, {})
+        self._evolution = (None, None)
+        # LRU of raster images of the chart, by (image_type, width)
+        self._rasters = OrderedDict()
+        self._geometry = None
+        # Updates counter, to wake up the stream clients
+        self._updated = threading.Condition()
+        self._generation = 0
+
+    def _load(self):
+        svg, meta, *encoded = get_vars(
+            self._redis, 'svg_chart', 'svg_chart_meta',
+            *[f'svg_chart_{encoding}' for encoding in ENCODINGS])
+        variants = {}
+        if meta is not None:
+            variants = {encoding: data
+                        for encoding, data in zip(ENCODINGS, encoded)
+                        if data is not None
+                        and encoding in meta.get('encodings', [])}
+        if meta is None or meta['etag'] != self._etag:
+            self._rasters.clear()  # Made for the old chart
+            self._geometry = None
+        self._chart = svg, meta, variants
+        return self._chart
+
+    @property
+    def _etag(self):
+        meta = self._chart[1]
+        return meta['etag'] if meta is not None else None
+
+    def _load_evolution(self):
+        self._evolution = tuple(get_vars(
+            self._redis, 'ha_evolution', 'ha_evolution_meta'))
+        return self._evolution
+
+    def _notify(self):
+        with self._updated:
+            self._generation += 1
+            self._updated.notify_all()
+
+    def _listen(self):
+        channel_chart = CHANNEL_CHART_VERSION.encode()
+        while True:
+            pubsub = self._redis.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(
+                    CHANNEL_CHART_VERSION, CHANNEL_EVOLUTION_VERSION)
+                # Changes before subscribing are not notified, load now
+                self._load()
+                self._load_evolution()
+                self._subscribed = True
+                self._notify()
+                logging.debug('Subscribed to chart versions')
+                for message in pubsub.listen():
+                    if message['channel'] == channel_chart:
+                        self._load()
+                    else:
+                        self._load_evolution()
+                    self._notify()
+            except RedisError as exc:
+                logging.error(f"Chart versions subscription error: "
+                              f"{exc.__class__}: {str(exc)}")
+            finally:
+                self._subscribed = False
+                pubsub.close()
+            time.sleep(RECONNECT_DELAY)
+
+    def _start_listener(self):
+        # Started with the 1st request, in each (forked) worker process
+        with self._lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen, name='chart_cache', daemon=True)
+                self._listener.start()
+
+    @property
+    def generation(self):
+        """Counter of the updates received."""
+        return self._generation
+
+    def get(self):
+        """Return the last SVG chart, its metadata and compressed variants.
+
+        The metadata is a dict with the 'etag' and 'ts' of the chart, and
+        the variants a dict of compressed contents by encoding.
+        """
+        if self._listener is None:
+            self._start_listener()
+        if not self._subscribed or self._chart[0] is None:
+            return self._load()
+        return self._chart
+
+    def get_evolution(self):
+        """Return the last evolution data and its metadata."""
+        if self._listener is None:
+            self._start_listener()
+        if not self._subscribed or self._evolution[0] is None:
+            return self._load_evolution()
+        return self._evolution
+
+    def get_raster(self, image_type, width):
+        """Return a raster image of the last chart, or None if not made."""
+        _svg, meta, _variants = self.get()
+        if meta is None:
+            return None
+        key = (image_type, width)
+        if key in self._rasters:
+            self._rasters.move_to_end(key)
+            return self._rasters[key]
+
+        raster = get_var(self._redis, raster_var(image_type, width))
+        if raster is None or raster['version'] != meta['etag']:
+            return None
+        self._rasters[key] = raster['data']
+        while len(self._rasters) > RASTERS_MAXSIZE:
+            self._rasters.popitem(last=False)
+        return raster['data']
+
+    def get_geometry(self):
+        """Return the geometry JSON of the last chart, its metadata and
+        compressed variants, or None if not available.
+        """
+        _svg, meta, _variants = self.get()
+        if meta is None:
+            return None
+        if self._geometry is not None:
+            return self._geometry
+
+        geometry = get_var(self._redis, 'chart_geometry')
+        if geometry is None or geometry['version'] != meta['etag']:
+            return None
+        self._geometry = (geometry['data'], geometry['meta'],
+                          geometry['variants'])
+        return self._geometry
+
+    def wait_update(self, generation, timeout=None):
+        """Wait for an update after `generation`, returning the current one.
+
+        If there is no update before the timeout, `generation` is returned.
+        """
+        if self._listener is None:
+            self._start_listener()
+        with self._updated:
+            if self._generation == generation:
+                self._updated.wait(timeout)
+            return self._generation
@@ -1,16 +1,32 @@
 # -*- coding: utf-8 -*-
+import datetime as dt
+import json
 import logging
+import math
+from numbers import Number
+from time import time
 
-from flask import request, redirect, url_for, jsonify
+from celery.exceptions import TimeoutError as CeleryTimeoutError
+from flask import (
+    request, redirect, url_for, jsonify, Response, stream_with_context)
 
-from psychrodata.redis_mng import get_var, set_var, has_var
+from psychrodata.redis_mng import get_var, get_vars, remove_var, set_vars
+from psychrodata.timeseries import (
+    DOWNSAMPLING_METHODS, VALUE_COLUMNS, get_history_store)
 
 from psychrochartmaker import (
-    TASK_CLEAN_CACHE_DATA, TASK_CREATE_PSYCHROCHART, TASK_RELOAD_HA_CONFIG)
+    TASK_CLEAN_CACHE_DATA, TASK_RELOAD_HA_CONFIG,
+    TASK_INGEST_SENSOR_READINGS, RASTER_FORMATS,
+    raster_width, send_raster_task, send_render_task)
+from psychrochartmaker.remote import parse_datetime, valid_entity_id
+from psychrocam.chart_cache import ChartCache
 from psychrocam import (
-    app, image_response, json_response, json_error, redis, celery,
+    app, conditional_response, image_response, json_response, json_error,
+    redis, celery,
     ROUTE_CHARTCONFIG, ROUTE_HA_CONFIG, ROUTE_HA_STATES,
-    ROUTE_CLEAN_CACHE, ROUTE_SVGCHART, ROUTE_HA_EVOLUTION)
+    ROUTE_CLEAN_CACHE, ROUTE_SVGCHART, ROUTE_RASTERCHART, ROUTE_HA_EVOLUTION,
+    ROUTE_SENSOR_READINGS, ROUTE_STREAM, ROUTE_CHART_GEOMETRY,
+    ROUTE_HA_HISTORY)
 
 
 CHART_STYLE_KEYS = ['figure', 'limits', 'saturation', 'constant_rh',
@@ -20,6 +36,18 @@ CHART_STYLE_KEYS = ['figure', 'limits', 'saturation', 'constant_rh',
 HA_CONFIG_KEYS = ['exterior', 'history', 'homeassistant',
                   'interior', 'location', 'sun']
 
+# Last SVG chart, kept in memory
+chart_cache = ChartCache(redis)
+history_store = get_history_store()
+
+STREAM_KEEPALIVE = 15  # seconds
+RASTER_TIMEOUT = 30  # seconds
+RASTER_RETRY_AFTER = 5  # seconds
+STREAM_RETRY = 5000  # ms
+DEFAULT_HISTORY_SPAN = 86400  # seconds
+DEFAULT_HISTORY_POINTS = 500
+MAX_HISTORY_POINTS = 5000
+
 
 # TODO Validate new config
 def _update_dict(old_style, new_style, valid_keys):
@@ -33,37 +61,78 @@ def _update_dict(old_style, new_style, valid_keys):
             old_style[key] = value
 
 
+def _parse_reading(reading):
+    """Validate a pushed sensor reading, with an ISO or epoch timestamp."""
+    entity_id = reading['entity_id']
+    state = reading['state']
+    if not isinstance(entity_id, str) or not valid_entity_id(entity_id):
+        raise ValueError("Invalid entity_id")
+    if not isinstance(state, (str, Number)):
+        raise ValueError("Invalid state")
+
+    timestamp = reading.get('timestamp')
+    ts = time() if timestamp is None else _parse_timestamp(timestamp)
+    return {'entity_id': entity_id.lower(), 'state': str(state), 'ts': ts}
+
+
+def _parse_timestamp(timestamp):
+    """Epoch of a UTC ISO or epoch timestamp.
+
+    Raises ValueError if it is not valid (a bool, not finite, or out of
+    the datetime range).
+    """
+    if isinstance(timestamp, bool):
+        raise ValueError("Invalid timestamp")
+    try:
+        ts = float(timestamp)
+    except ValueError:
+        parsed = parse_datetime(timestamp)
+        if parsed is None:
+            raise ValueError("Invalid timestamp")
+        if parsed.tzinfo is None:
+            parsed = parsed.replace(tzinfo=dt.timezone.utc)
+        return parsed.timestamp()
+
+    if not math.isfinite(ts):
+        raise ValueError("Invalid timestamp")
+    try:
+        dt.datetime.fromtimestamp(ts, dt.timezone.utc)
+    except (OverflowError, OSError):
+        raise ValueError("Timestamp out of range")
+    return ts
+
+
 ###############################################################################
 # Routes
 ###############################################################################
 @app.route(ROUTE_CHARTCONFIG, methods=['GET', 'POST'])
 def psychrochart_config():
     if request.method == 'GET':
-        if not has_var(redis, 'chart_style'):
+        styles, zones = get_vars(redis, 'chart_style', 'chart_zones')
+        if styles is None or zones is None:
             task = celery.send_task(TASK_CLEAN_CACHE_DATA)
             return json_error(
                 404000, error_msg=f"No chart config available!, "
                                   f"resetting all (task: {task})")
-        styles = get_var(redis, 'chart_style')
-        styles['zones'] = get_var(redis, 'chart_zones')['zones']
+        styles['zones'] = zones['zones']
         return json_response(styles)
     elif isinstance(request.json, dict) and request.json:
         new_data = request.json
         logging.warning(f"Set new chart style: {new_data}")
 
-        styles = get_var(redis, 'chart_style')
-        zones = get_var(redis, 'chart_zones')
+        styles, zones = get_vars(redis, 'chart_style', 'chart_zones')
 
         _update_dict(styles, new_data, CHART_STYLE_KEYS)
         _update_dict(zones, new_data, CHART_STYLE_KEYS)
 
-        set_var(redis, 'chart_style', styles)
-        set_var(redis, 'chart_zones', zones)
-        set_var(redis, 'chart_config_changed', True)
+        set_vars(redis, {'chart_style': styles, 'chart_zones': zones,
+                         'chart_config_changed': True})
+        # Made with the old style
+        remove_var(redis, 'chart_geometry')
 
         logging.debug('Make psychrochart now!')
-        celery.send_task(TASK_CREATE_PSYCHROCHART)
-        styles['zones'] = get_var(redis, 'chart_zones')['zones']
+        send_render_task(celery, redis)
+        styles['zones'] = zones['zones']
         return json_response({"new_config": new_data, "result": styles})
     return json_error(400, error_msg="Bad request! json: %s; args: %s",
                       msg_args=[request.json, request.args])
@@ -72,19 +141,20 @@ def psychrochart_config():
 @app.route(ROUTE_HA_CONFIG, methods=['GET', 'POST'])
 def homeassistant_config():
     if request.method == 'GET':
-        if not has_var(redis, 'ha_yaml_config'):
+        ha_config = get_var(redis, 'ha_yaml_config')
+        if ha_config is None:
             return json_error(
                 404001, error_msg="No Home Assistant config available!, "
                                   "please POST one")
 
-        return json_response(get_var(redis, 'ha_yaml_config'))
+        return json_response(ha_config)
     elif isinstance(request.json, dict) and request.json:
         new_data = request.json
         logging.warning(f"Set new HA config: {new_data}")
         ha_config = get_var(redis, 'ha_yaml_config')
         _update_dict(ha_config, new_data, HA_CONFIG_KEYS)
-        set_var(redis, 'ha_yaml_changed', True)
-        set_var(redis, 'ha_yaml_config', ha_config)
+        set_vars(redis, {'ha_yaml_changed': True,
+                         'ha_yaml_config': ha_config})
         celery.send_task(TASK_RELOAD_HA_CONFIG)
         return json_response(ha_config)
     return json_error(400, error_msg="Bad request! json: %s; args: %s",
@@ -93,44 +163,217 @@ def homeassistant_config():
 
 @app.route(ROUTE_HA_STATES, methods=['GET'])
 def homeassistant_states():
-    if not has_var(redis, 'ha_states'):
+    ha_states = get_var(redis, 'ha_states')
+    if ha_states is None:
         return json_error(
             404002, error_msg="No Home Assistant states available!")
 
-    ha_states = get_var(redis, 'ha_states', unpickle_object=True)
     for s in ha_states:
         ha_states[s]['last_updated'] = ha_states[s]['last_updated'].isoformat()
         ha_states[s]['last_changed'] = ha_states[s]['last_changed'].isoformat()
     return json_response(ha_states)
 
 
+@app.route(ROUTE_SENSOR_READINGS, methods=['POST'])
+def post_sensor_readings():
+    """Webhook to push readings of sensors, as a list or {"readings": []}.
+
+    Each reading is like `{"entity_id": "sensor.office_temperature",
+    "state": 25.1, "timestamp": "2018-06-21T07:11:19"}`, with a UTC ISO
+    (or epoch) timestamp, being now if not present.
+    """
+    data = request.json
+    if isinstance(data, dict):
+        data = data.get('readings', [data])
+    if not isinstance(data, list) or not data:
+        return json_error(400, error_msg="Bad request! json: {}",
+                          msg_args=[request.json])
+
+    # Only the last reading of each sensor is needed
+    readings = {}
+    for reading in data:
+        try:
+            reading = _parse_reading(reading)
+        except (KeyError, TypeError, ValueError) as exc:
+            return json_error(400, error_msg="Bad reading {}: {}",
+                              msg_args=[reading, exc])
+        last = readings.get(reading['entity_id'])
+        if last is None or last['ts'] <= reading['ts']:
+            readings[reading['entity_id']] = reading
+
+    celery.send_task(TASK_INGEST_SENSOR_READINGS,
+                     args=[list(readings.values())])
+    return json_response({"num_readings": len(data),
+                          "num_sensors": len(readings)})
+
+
 @app.route(ROUTE_HA_EVOLUTION, methods=['GET'])
 def get_homeassistant_sensors_evolution():
-    ha_evolution = get_var(redis, 'ha_evolution')
+    ha_evolution, meta = chart_cache.get_evolution()
     if ha_evolution:
         # Without response schema (direct use with HA REST sensor)
-        return jsonify(ha_evolution)
+        response = jsonify(ha_evolution)
+        if meta is not None:
+            return conditional_response(response, meta)
+        return response
     # Do something!
     return json_error(500002, error_msg="No history data available!")
 
 
+@app.route(ROUTE_HA_HISTORY, methods=['GET'])
+def get_sensor_history(sensor):
+    """History of a sensor in a time range, decimated to a num of points.
+
+    Query args: `start` and `end` (UTC ISO or epoch, the last day by
+    default), `points` (500 by default), `method` ('lttb' or 'minmax') and
+    `columns` (comma separated, 'temperature,humidity' by default).
+    """
+    if sensor not in history_store.sensors():
+        return json_error(404, error_msg="No history of {}",
+                          msg_args=[sensor])
+    args = request.args
+    try:
+        end = _parse_timestamp(args['end']) if 'end' in args else time()
+        start = (_parse_timestamp(args['start']) if 'start' in args
+                 else end - DEFAULT_HISTORY_SPAN)
+        num_points = min(int(args.get('points', DEFAULT_HISTORY_POINTS)),
+                         MAX_HISTORY_POINTS)
+    except ValueError as exc:
+        return json_error(400, error_msg="Bad history request: {}",
+                          msg_args=[exc])
+    method = args.get('method', DOWNSAMPLING_METHODS[0])
+    columns = args.get('columns', 'temperature,humidity').split(',')
+    if (method not in DOWNSAMPLING_METHODS
+            or not set(columns).issubset(VALUE_COLUMNS)):
+        return json_error(400, error_msg="Bad history request: {}",
+                          msg_args=[dict(args)])
+
+    series = {}
+    for column in columns:
+        ts, values, level = history_store.downsample(
+            sensor, column, start, end, num_points, method)
+        series[column] = list(zip(ts.round().tolist(),
+                                  values.astype(float).round(2).tolist()))
+    return json_response({'sensor': sensor, 'start': start, 'end': end,
+                          'method': method, 'resolution': level,
+                          'series': series})
+
+
 @app.route(ROUTE_SVGCHART, methods=['GET'])
 def get_svg_chart():
-    svg = get_var(redis, 'svg_chart')
+    svg, meta, variants = chart_cache.get()
     if svg:
-        return image_response(svg, image_type='svg')
+        return image_response(svg, image_type='svg',
+                              meta=meta, variants=variants)
     # Do something!
     return json_error(500001, error_msg="No SVG image available!")
 
     # TODO POST points/zones/etc
 
 
+@app.route(ROUTE_RASTERCHART, methods=['GET'])
+def get_raster_chart(image_type):
+    """PNG/WebP image of the chart, `?width=` px wide (in fixed steps)."""
+    if image_type not in RASTER_FORMATS:
+        return json_error(404, error_msg="Image format not available: {}",
+                          msg_args=[image_type])
+    width = raster_width(request.args.get('width', type=int))
+    svg, meta, _variants = chart_cache.get()
+    if not svg:
+        return json_error(500001, error_msg="No SVG image available!")
+
+    image = chart_cache.get_raster(image_type, width)
+    if image is not None:
+        return image_response(image, image_type=image_type, meta=meta)
+
+    # Not pre-warmed, make it now in the render worker (once at a time)
+    task = send_raster_task(celery, redis, image_type, width,
+                            expires=RASTER_TIMEOUT)
+    if task is not None:
+        try:
+            if not task.get(timeout=RASTER_TIMEOUT):
+                return json_error(500003, error_msg="Can't make the {} image!",
+                                  msg_args=[image_type])
+            image = chart_cache.get_raster(image_type, width)
+        except CeleryTimeoutError:
+            logging.error(f"Timeout making {image_type} image [{width}px]")
+    if image is None:
+        response = json_error(
+            503001, error_msg="The {} image is being made, retry later",
+            msg_args=[image_type])
+        response.headers['Retry-After'] = str(RASTER_RETRY_AFTER)
+        return response
+    return image_response(image, image_type=image_type, meta=meta)
+
+
+@app.route(ROUTE_CHART_GEOMETRY, methods=['GET'])
+def get_chart_geometry():
+    """Curves, zones, points and arrows of the chart, to draw it client-side.
+
+    Coordinates are [dry bulb temp (°C), humidity ratio (g/kg)].
+    """
+    geometry = chart_cache.get_geometry()
+    if geometry is None:
+        return json_error(500004, error_msg="No chart geometry available!")
+    data, meta, variants = geometry
+    return image_response(data, image_type='json',
+                          meta=meta, variants=variants)
+
+
+def _stream_event(with_svg=False):
+    """Return the id and the data of the event with the last updates."""
+    svg, meta, _variants = chart_cache.get()
+    ha_evolution, ev_meta = chart_cache.get_evolution()
+    version = meta['etag'] if meta else None
+    ev_version = ev_meta['etag'] if ev_meta else None
+    data = {'version': version, 'ts': meta['ts'] if meta else None,
+            'evolution_version': ev_version, 'evolution': ha_evolution}
+    if with_svg:
+        data['svg'] = svg.decode() if svg else None
+    return f"{version}:{ev_version}", json.dumps(data)
+
+
+@app.route(ROUTE_STREAM, methods=['GET'])
+def stream_updates():
+    """Server-sent events with the new chart versions and evolution data.
+
+    Each event has the chart version (and the SVG itself, with `?svg=1`)
+    and the evolution data. The clients only wait in this worker process,
+    without any connection to Redis.
+    """
+    with_svg = request.args.get('svg', '0').lower() in ('1', 'true')
+    last_event_id = request.headers.get('Last-Event-ID')
+
+    def _events():
+        nonlocal last_event_id
+        yield f"retry: {STREAM_RETRY}\n\n"
+        generation = chart_cache.generation
+        while True:
+            event_id, data = _stream_event(with_svg)
+            if event_id != last_event_id:
+                last_event_id = event_id
+                yield f"event: update\nid: {event_id}\ndata: {data}\n\n"
+
+            new_generation = chart_cache.wait_update(
+                generation, timeout=STREAM_KEEPALIVE)
+            if new_generation == generation:
+                yield ": keepalive\n\n"
+            generation = new_generation
+
+    response = Response(
+        stream_with_context(_events()), mimetype='text/event-stream')
+    response.cache_control.no_cache = True
+    # Don't buffer the stream in reverse proxies
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
 @app.route(ROUTE_CLEAN_CACHE, methods=['GET', 'POST'])
 def clean_cache():
     # TODO remove GET method for cache cleaning
     if request.method == 'POST' or 'clean' in request.args:
         celery.send_task(TASK_CLEAN_CACHE_DATA)
-        celery.send_task(TASK_CREATE_PSYCHROCHART, countdown=.5)
+        send_render_task(celery, redis, delay=.5)
         # time_limit = None, soft_time_limit = None
         return json_response({"cache_cleaned": True})
     return json_error(405, "Can't clean the cache with args: %s", request.args)
@@ -1,7 +1,138 @@
 # -*- coding: utf-8 -*-
+from time import time
+
+from psychrodata import Config
+
 
 # Tasks identifiers
 TASK_CLEAN_CACHE_DATA = 'clean_cache_data'
 TASK_CREATE_PSYCHROCHART = 'create_psychrochart'
 TASK_RELOAD_HA_CONFIG = 'reload_ha_config'
 TASK_PERIODIC_GET_HA_STATES = 'periodic_get_ha_states'
+TASK_INGEST_SENSOR_READINGS = 'ingest_sensor_readings'
+TASK_MAKE_RASTER_CHART = 'make_raster_chart'
+
+# Render jobs go to a dedicated queue, consumed by a prefork (CPU) worker
+RENDER_QUEUE = 'render'
+RENDER_EXPIRES = 60  # seconds
+# Render scheduling keys: pending request ('force' or 'changed'), job
+# already scheduled, start of the last render, and lease of the running one
+KEY_RENDER_REQUEST = 'render_request'
+KEY_RENDER_SCHEDULED = 'render_scheduled'
+KEY_RENDER_LAST_TS = 'render_last_ts'
+KEY_RENDER_LEASE = 'render_lease'
+RENDER_LEASE_TTL = 60  # seconds, > render time limit
+REQUEST_FORCE = 'force'
+REQUEST_CHANGED = 'changed'
+# Raster image jobs in flight, one at most by image type and width
+KEY_RASTER_REQUEST = 'raster_request'
+RASTER_EXPIRES = 30  # seconds
+
+
+def send_render_task(celery_obj, redis, only_if_changed=False, delay=0):
+    """Request a chart render to the render worker.
+
+    The pending requests are collapsed in one render job, scheduled at
+    least `Config.RENDER_MIN_INTERVAL` seconds after the start of the last
+    render, which uses the data in Redis when it runs. It is only forced
+    (made even if the inputs didn't change) if any of the requests is.
+    Returns the new job, or None if there was one already scheduled.
+    """
+    pipe = redis.pipeline()
+    if only_if_changed:
+        pipe.set(KEY_RENDER_REQUEST, REQUEST_CHANGED, nx=True)
+    else:
+        pipe.set(KEY_RENDER_REQUEST, REQUEST_FORCE)
+    pipe.get(KEY_RENDER_LAST_TS)
+    _, last_ts = pipe.execute()
+    return schedule_render(celery_obj, redis, max(
+        delay, float(last_ts or 0) + Config.RENDER_MIN_INTERVAL - time()))
+
+
+def schedule_render(celery_obj, redis, countdown=0, reschedule=False):
+    """Send a render job, unless there is one already scheduled."""
+    countdown = max(countdown, 0)
+    expires = countdown + RENDER_EXPIRES
+    # The flag expires with the job, in case it is lost
+    if not redis.set(KEY_RENDER_SCHEDULED, 1, ex=int(expires) + 1,
+                     nx=not reschedule):
+        return None
+    return celery_obj.send_task(
+        TASK_CREATE_PSYCHROCHART, kwargs={'only_if_changed': True},
+        queue=RENDER_QUEUE, countdown=countdown, expires=expires)
+
+
+def _raster_request_key(image_type, width):
+    return f'{KEY_RASTER_REQUEST}:{image_type}:{width}'
+
+
+def send_raster_task(celery_obj, redis, image_type, width,
+                     expires=RASTER_EXPIRES):
+    """Request a raster image to the render worker, if not requested yet.
+
+    The job expires if not started in `expires` seconds, as its requester
+    doesn't wait more for it. Returns the new job, or None if there was
+    one already in flight for that image.
+    """
+    # The flag expires with the job, in case it is lost
+    if not redis.set(_raster_request_key(image_type, width), 1,
+                     ex=int(expires) + 1, nx=True):
+        return None
+    return celery_obj.send_task(
+        TASK_MAKE_RASTER_CHART, args=[image_type, width],
+        queue=RENDER_QUEUE, expires=expires)
+
+
+def end_raster_request(redis, image_type, width):
+    """Clear the request of a raster image, when its job ends."""
+    redis.delete(_raster_request_key(image_type, width))
+
+
+def render_lease(redis):
+    """Lease (lock with TTL) for the renders, one at a time."""
+    return redis.lock(KEY_RENDER_LEASE, timeout=RENDER_LEASE_TTL)
+
+
+def take_render_request(redis):
+    """Take the pending render request, when the render job starts.
+
+    Returns True if the render is forced. New requests from now on
+    schedule a new job.
+    """
+    pipe = redis.pipeline()
+    pipe.get(KEY_RENDER_REQUEST)
+    pipe.delete(KEY_RENDER_REQUEST, KEY_RENDER_SCHEDULED)
+    pipe.set(KEY_RENDER_LAST_TS, time())
+    request = pipe.execute()[0]
+    return request is not None and request.decode() == REQUEST_FORCE
+
+
+# Raster images of the chart, only in these widths (px) to bound the cache
+RASTER_FORMATS = ('png', 'webp')
+RASTER_WIDTHS = (320, 480, 640, 800, 1024, 1280, 1600, 1920)
+DEFAULT_RASTER_WIDTH = 800
+
+
+def raster_width(width=None):
+    """Return the smallest raster width valid for the requested one."""
+    if not width:
+        return DEFAULT_RASTER_WIDTH
+    return next((w for w in RASTER_WIDTHS if w >= width), RASTER_WIDTHS[-1])
+
+
+def raster_var(image_type, width):
+    """Name of the var with a raster image of the chart."""
+    return f'chart_raster_{image_type}_{width}'
+
+
+def parse_raster_sizes(sizes):
+    """Parse a list of raster sizes like 'png:800,webp:1280'.
+
+    Unknown formats and bad items (like 'none') are ignored.
+    """
+    parsed = []
+    for item in sizes.replace(' ', '').split(','):
+        image_type, _, width = item.partition(':')
+        if image_type in RASTER_FORMATS and width.isdigit():
+            parsed.append((image_type, raster_width(int(width))))
+    return parsed
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Geometry of the psychrometric chart, as compact numeric arrays.
+
+All the coordinates are (dry bulb temperature [°C], humidity ratio
+[g/kg_da]), as in the chart axes, so clients can draw the chart themselves.
+"""
+from psychrochart.chart import curve_constant_humidity_ratio
+from psychrochart.equations import (
+    humidity_ratio, saturation_pressure_water_vapor)
+
+
+GEOMETRY_DECIMALS = 3
+CURVE_FAMILIES = (
+    ('saturation', 'saturation'),
+    ('constant_rh', 'constant_rh_data'),
+    ('constant_h', 'constant_h_data'),
+    ('constant_v', 'constant_v_data'),
+    ('constant_wet_temp', 'constant_wbt_data'),
+    ('constant_dry_temp', 'constant_dry_temp_data'),
+    ('constant_humidity', 'constant_humidity_data'))
+
+
+def _round(values):
+    return [round(float(v), GEOMETRY_DECIMALS) for v in values]
+
+
+def _curves_geometry(psychrocurves):
+    """Curves of a family, with the temperatures only once if shared."""
+    curves = [c for c in psychrocurves.curves if c.x_data and c.y_data]
+    if not curves:
+        return None
+    family = {'label': psychrocurves.family_label,
+              'style': curves[0].style}
+    x_data = curves[0].x_data
+    if len(curves) > 1 and all(c.x_data == x_data for c in curves):
+        family['x'] = _round(x_data)
+        family['curves'] = [{'y': _round(c.y_data), 'label': c._label}
+                            for c in curves]
+    else:
+        family['curves'] = [{'x': _round(c.x_data), 'y': _round(c.y_data),
+                             'label': c._label} for c in curves]
+    return family
+
+
+def _humidity_ratio(temp, rh, p_atm_kpa):
+    return round(curve_constant_humidity_ratio(
+        [temp], rh_percentage=rh, p_atm_kpa=p_atm_kpa)[0], GEOMETRY_DECIMALS)
+
+
+def background_geometry(chart, dry_temp_lines=()):
+    """Geometry of the static layer of a (not necessarily plotted) chart.
+
+    `dry_temp_lines` is a list of (temperature, style), for vertical lines
+    from the min humidity to the saturation curve.
+    """
+    families = {}
+    for name, attr in CURVE_FAMILIES:
+        psychrocurves = getattr(chart, attr)
+        if psychrocurves is not None:
+            family = _curves_geometry(psychrocurves)
+            if family is not None:
+                families[name] = family
+
+    zones = []
+    for zone_curves in chart.zones:
+        zones.extend({'x': _round(c.x_data), 'y': _round(c.y_data),
+                      'style': c.style, 'label': c._label}
+                     for c in zone_curves.curves)
+
+    lines = [{'x': [temp, temp],
+              'y': [chart.w_min, round(1000 * humidity_ratio(
+                  saturation_pressure_water_vapor(temp), chart.p_atm_kpa),
+                  GEOMETRY_DECIMALS)],
+              'style': style} for temp, style in dry_temp_lines]
+
+    return {'limits': {'temp': [chart.dbt_min, chart.dbt_max],
+                       'humidity': [chart.w_min, chart.w_max],
+                       'pressure_kpa': chart.p_atm_kpa},
+            'curves': families,
+            'zones': zones,
+            'lines': lines}
+
+
+def overlay_geometry(p_atm_kpa, points=None, arrows=None,
+                     interior_zones=None, heatmap=None):
+    """Geometry of the dynamic layer: points, arrows, point groups and the
+    heatmap (its extent, shape and [[bin, count], ...] by sensor).
+    """
+    points_geom = {}
+    for key, point in (points or {}).items():
+        temp, rh = point['xy']
+        points_geom[key] = {
+            'xy': [temp, _humidity_ratio(temp, rh, p_atm_kpa)],
+            'style': point.get('style'),
+            'label': point.get('label')}
+
+    arrows_geom = {}
+    for key, arrow in (arrows or {}).items():
+        arrows_geom[key] = {
+            'xy': [[temp, _humidity_ratio(temp, rh, p_atm_kpa)]
+                   for temp, rh in arrow['xy']],
+            'style': arrow.get('style')}
+
+    groups = [{'points': list(names), 'style_line': style_line,
+               'style_fill': style_fill}
+              for names, style_line, style_fill in (interior_zones or [])]
+    return {'points': points_geom, 'arrows': arrows_geom,
+            'interior_zones': groups, 'heatmap': heatmap}
@@ -1,30 +1,74 @@
 # -*- coding: utf-8 -*-
 """Extract sensor values from a remote Home Assistant instance."""
-from collections import deque
+from contextlib import contextmanager
 import datetime as dt
+import json
 import logging
 
 import matplotlib.colors as mcolors
+from psychrochart.equations import PRESSURE_STD_ATM_KPA, pressure_by_altitude
+from redis.exceptions import LockError
 from requests.exceptions import ConnectionError
 from urllib3.exceptions import (
     NewConnectionError, MaxRetryError, ReadTimeoutError)
 
-from psychrochartmaker.remote import API, get_states, HomeAssistantError
-from psychrodata.redis_mng import get_var, set_var, has_var, remove_var
+from psychrochartmaker.heatmap import (
+    heatmap_grid, heatmap_layer, update_heatmap, HEATMAP_PERIOD,
+    HEATMAP_RESOLUTION)
+from psychrochartmaker.psychrometrics import points_properties
+from psychrochartmaker.remote import (
+    API, close_sessions, get_entity_states, get_states, HomeAssistantError,
+    State, DEFAULT_POOL_SIZE, UTC)
+from psychrochartmaker.rolling_stats import (
+    DEFAULT_WINDOWS, rolling_stats, update_rolling_stats)
+from psychrodata.content import content_meta
+from psychrodata.redis_mng import (
+    append_history, get_history_items, get_var, get_vars, set_var, set_vars,
+    remove_var, publish_evolution_version)
+from psychrodata.timeseries import get_history_store
+
+
+history_store = get_history_store()
+
+# Lease of the HA states and the vars made from them (points, stats, ...),
+# held by each writer: the polls, the pushed readings and the HA events
+KEY_STATE_LEASE = 'ha_state_lease'
+STATE_LEASE_TTL = 30  # seconds
+STATE_LEASE_WAIT = 20  # seconds
+
+
+@contextmanager
+def state_lease(redis):
+    """Hold the lease to update the HA states and the points.
+
+    Raises LockError if it is not acquired in `STATE_LEASE_WAIT` seconds.
+    """
+    lease = redis.lock(KEY_STATE_LEASE, timeout=STATE_LEASE_TTL,
+                       blocking_timeout=STATE_LEASE_WAIT)
+    if not lease.acquire():
+        raise LockError('HA state lease not acquired')
+    try:
+        yield
+    finally:
+        try:
+            lease.release()
+        except LockError:
+            logging.error('HA state lease expired before the update end')
 
 
 ###############################################################################
 # HA Config
 ###############################################################################
 def parse_config_ha(redis, yaml_config):
+    config_vars = {}
     location_config = yaml_config['location']
     if 'altitude' in location_config:
-        set_var(redis, 'altitude', location_config['altitude'])
+        config_vars['altitude'] = location_config['altitude']
     if 'pressure_sensor' in location_config:
-        set_var(redis, 'pressure_sensor', location_config['pressure_sensor'])
+        config_vars['pressure_sensor'] = location_config['pressure_sensor']
 
     history_config = yaml_config['history']
-    set_var(redis, 'ha_history', history_config)
+    config_vars['ha_history'] = history_config
 
     # Get HA sensors
     interior_sensors = yaml_config['interior']
@@ -47,7 +91,7 @@ def parse_config_ha(redis, yaml_config):
              dict(color='darkblue', lw=1, alpha=.5, ls='--'),
              dict(color='darkblue', lw=0, alpha=.3)),
         ]
-        set_var(redis, 'interior_zones', interior_zones)
+        config_vars['interior_zones'] = interior_zones
 
     # TODO implement sun position and irradiations
     # sun_sensor = yaml_config['sun']
@@ -63,18 +107,26 @@ def parse_config_ha(redis, yaml_config):
     #     sensors.update({"sun": sun_sensor})
 
     if sensors:
-        set_var(redis, 'ha_sensors', sensors)
+        config_vars['ha_sensors'] = sensors
 
     # Get HA API
     ha_config = yaml_config['homeassistant']
-    set_var(redis, 'ha_config', ha_config)
+    config_vars['ha_config'] = ha_config
 
-    set_var(redis, 'ha_yaml_config', yaml_config)
+    config_vars['ha_yaml_config'] = yaml_config
+    set_vars(redis, config_vars)
 
 
 ###############################################################################
 # HA remote polling
 ###############################################################################
+# Above this number of sensors, the entire /api/states dump is cheaper
+MAX_ENTITY_REQUESTS = 20
+
+# Process-local HA API, reused across polls to keep its HTTP connections
+_ha_api = {}
+
+
 def get_ha_api(redis):
     ha_config = get_var(redis, 'ha_config')
     logging.debug(f"HA API config: {ha_config}")
@@ -83,32 +135,36 @@ def get_ha_api(redis):
     api_params = dict(host=ha_config.get('host', '127.0.0.1'),
                       api_password=ha_config.get('api_password', None),
                       port=ha_config.get('port', 8123),
-                      use_ssl=ha_config.get('use_ssl', False))
+                      use_ssl=ha_config.get('use_ssl', False),
+                      pool_size=ha_config.get('pool_size', DEFAULT_POOL_SIZE),
+                      keep_alive=ha_config.get('keep_alive', True))
+    key = json.dumps(api_params, sort_keys=True)
+    if key in _ha_api:
+        return _ha_api[key]
+
     try:
         api = API(**api_params)
         try:
             assert api.validate_api(force_validate=True)
-            set_var(redis, 'ha_api', api, pickle_object=True)
+            _ha_api.clear()
+            _ha_api[key] = api
+            return api
         except AssertionError:
             logging.error(f"No HA API found. Removing config from cache")
-            if has_var(redis, 'ha_api'):
-                remove_var(redis, 'ha_api')
+            reset_ha_api()
     except (HomeAssistantError, ConnectionError,
             NewConnectionError, MaxRetryError) as exc:
         logging.error(f"{exc.__class__}: {str(exc)}")
         return
 
 
-def get_ha_states(redis):
-    api = get_var(redis, 'ha_api', unpickle_object=True)
-    if not api:
-        logging.error(f"No HA API loaded, aborting get_states")
-        if has_var(redis, 'ha_states'):
-            remove_var(redis, 'ha_states')
-        return {}
+def reset_ha_api():
+    _ha_api.clear()
+    close_sessions()
 
-    sensors = get_var(redis, 'ha_sensors')
-    logging.debug(f"Sensors: {sensors}")
+
+def get_sensor_entities(sensors):
+    """List the HA entities used by the configured sensors."""
     entities = []
     if "pressure_sensor" in sensors:
         entities.append(sensors["pressure_sensor"])
@@ -124,17 +180,93 @@ def get_ha_states(redis):
                      for k, s in sensor.items()
                      if k in ['temperature', 'humidity']]
     # print(entities)
+    return list(dict.fromkeys(entities))
+
+
+def get_ha_states(redis, api=None, make_points=False):
+    """Poll the HA states, merged with the pushed ones.
+
+    With `make_points`, the points are made from them, holding the same
+    state lease as the merge.
+    """
+    if api is None:
+        api = get_ha_api(redis)
+    if not api:
+        logging.error(f"No HA API loaded, aborting get_states")
+        remove_var(redis, 'ha_states')
+        return {}
+
+    sensors, ha_config = get_vars(
+        redis, 'ha_sensors', 'ha_config', defaults={'ha_config': {}})
+    logging.debug(f"Sensors: {sensors}")
+    entities = get_sensor_entities(sensors)
+    max_entity_requests = ha_config.get(
+        'max_entity_requests', MAX_ENTITY_REQUESTS)
     try:
-        states = {s.entity_id: s.as_dict()
-                  for s in filter(lambda x: x.entity_id in entities,
-                                  get_states(api))}
-        set_var(redis, 'ha_states', states, pickle_object=True)
+        if len(entities) > max_entity_requests:
+            ha_states = get_states(api, entities)
+        else:
+            ha_states = get_entity_states(api, entities)
     except (ReadTimeoutError, ConnectionRefusedError, HomeAssistantError):
-        states = {}
+        return {}
 
+    with state_lease(redis):
+        states = get_var(redis, 'pushed_states', default={})
+        merge_states(states, (s.as_dict() for s in ha_states))
+        set_var(redis, 'ha_states', states)
+        if make_points and states:
+            make_points_from_states(redis, states)
     return states
 
 
+###############################################################################
+# Pushed sensor readings
+###############################################################################
+def merge_states(states, new_states):
+    """Update the states with the newer ones, returning the changed ids."""
+    changed = []
+    for new_state in new_states:
+        entity_id = new_state['entity_id']
+        old_state = states.get(entity_id)
+        if (old_state is None or old_state['last_updated'].timestamp()
+                <= new_state['last_updated'].timestamp()):
+            states[entity_id] = new_state
+            changed.append(entity_id)
+    return changed
+
+
+def merge_sensor_readings(redis, readings):
+    """Merge pushed readings of sensors, making new points if any changed.
+
+    Each reading is a dict with 'entity_id', 'state' and 'ts' (epoch).
+    Readings of unknown sensors or older than the stored ones are ignored.
+    """
+    with state_lease(redis):
+        sensors, pushed_states, states = get_vars(
+            redis, 'ha_sensors', 'pushed_states', 'ha_states',
+            defaults={'pushed_states': {}, 'ha_states': {}})
+        if not sensors:
+            logging.error("No sensors configured, ignoring pushed readings")
+            return False
+
+        entities = set(get_sensor_entities(sensors))
+        new_states = [
+            State(reading['entity_id'], reading['state'],
+                  last_updated=dt.datetime.fromtimestamp(
+                      reading['ts'], UTC)).as_dict()
+            for reading in readings if reading['entity_id'] in entities]
+
+        merge_states(pushed_states, new_states)
+        changed = merge_states(states, new_states)
+        set_vars(redis, {'pushed_states': pushed_states, 'ha_states': states})
+        if not changed:
+            return False
+
+        logging.debug(f"Pushed readings of {changed}")
+        make_points_from_states(redis, states)
+    return True
+
+
 def _arrow_style(style):
     if 'color' in style:
         color = style['color']
@@ -188,31 +320,66 @@ def _make_ev_data(first_point, mid_point, end_point):
     return out
 
 
+def _make_history_record(points):
+    """Compact record of the points for the history: {key: [T, HR, ts]}."""
+    return {key: [point['xy'][0], point['xy'][1], point['ts']]
+            for key, point in points.items()}
+
+
+def _history_record_ts(record):
+    return max((values[2] for values in record.values()), default=0)
+
+
+def expand_history_record(record):
+    """Expand a history record to points-like dicts, with 'xy' and 'ts'."""
+    return {key: {'xy': (values[0], values[1]), 'ts': values[2]}
+            for key, values in (record or {}).items()}
+
+
+def _store_history(readings, pressure_kpa):
+    """Append the new readings of the points to the history store."""
+    try:
+        for key, (ts, temperature, humidity) in readings.items():
+            history_store.append(key, ts, temperature, humidity, pressure_kpa)
+    except OSError as exc:
+        logging.error(f"Can't store the sensor history: "
+                      f"{exc.__class__}: {str(exc)}")
+
+
 def make_points_from_states(redis, states):
     # Make points
-    sensors = get_var(redis, 'ha_sensors')
-    points = get_var(redis, 'last_points', default={})
-    points_unknown = get_var(redis, 'points_unknown', default=[])
+    (sensors, points, points_unknown, history_config, pressure_kpa,
+     altitude, rolling_state, chart_style, heatmap_state) = get_vars(
+        redis, 'ha_sensors', 'last_points', 'points_unknown', 'ha_history',
+        'pressure_kpa', 'altitude', 'ha_rolling_stats', 'chart_style',
+        'ha_heatmap',
+        defaults={'last_points': {}, 'points_unknown': [], 'ha_history': {},
+                  'ha_rolling_stats': {}, 'ha_heatmap': {}})
+    new_vars = {}
+    readings = {}
 
     for sensor_group in sensors.values():
         if isinstance(sensor_group, str):
             try:
-                set_var(redis, 'pressure_kpa',
-                        _mb2kpa(float(states[sensor_group]['state'])))
+                pressure_kpa = _mb2kpa(float(states[sensor_group]['state']))
+                new_vars['pressure_kpa'] = pressure_kpa
             except ValueError:
                 logging.error(f"Bad pressure read from {sensor_group}")
                 # pass
             continue
         for key, p_config in sensor_group.items():
             try:
+                # Time of the last update of any of its sensors
+                ts = max(states[p_config['temperature']]['last_updated'],
+                         states[p_config['humidity']]['last_updated'])
                 points.update(
                     {key: {'xy': (
                         float(states[p_config['temperature']]['state']),
                         float(states[p_config['humidity']]['state'])),
                            'style': {'marker': 'o', **p_config['style']},
-                           'ts': (states[p_config['humidity']]['last_updated']
-                                  .timestamp()),
+                           'ts': ts.timestamp(),
                            'label': key}})
+                readings[key] = (ts.timestamp(), *points[key]['xy'])
                 if key in points_unknown:
                     points_unknown.remove(key)
             except KeyError:
@@ -225,47 +392,90 @@ def make_points_from_states(redis, states):
                     f"{states[p_config['temperature']]['state']}ºC, "
                     f"{states[p_config['humidity']]['state']}%]")
                 points_unknown.append(key)
-    set_var(redis, 'last_points', points)
-    set_var(redis, 'points_unknown', points_unknown)
+    new_vars['last_points'] = points
+    new_vars['points_unknown'] = points_unknown
+    _store_history(readings, pressure_kpa)
+
+    # Derived properties of all the points, in one batch
+    if pressure_kpa is not None:
+        p_atm_kpa = pressure_kpa
+    elif altitude is not None:
+        p_atm_kpa = pressure_by_altitude(altitude)
+    else:
+        p_atm_kpa = PRESSURE_STD_ATM_KPA
+    properties = points_properties(points, p_atm_kpa)
+    new_vars['points_properties'] = properties
+
+    # Time spent by the points in each zone of the chart
+    heatmap_config = history_config.get('heatmap')
+    if heatmap_config and chart_style is not None:
+        if not isinstance(heatmap_config, dict):
+            heatmap_config = {}
+        grid = heatmap_grid(chart_style, heatmap_config.get(
+            'resolution', HEATMAP_RESOLUTION))
+        if update_heatmap(heatmap_state, readings, grid, p_atm_kpa,
+                          heatmap_config.get('period', HEATMAP_PERIOD)):
+            new_vars['ha_heatmap'] = heatmap_state
+            new_vars['heatmap'] = heatmap_layer(heatmap_state)
+
+    # Update the rolling statistics with the new readings
+    stats_windows = history_config.get('stats_windows', DEFAULT_WINDOWS)
+    if update_rolling_stats(rolling_state, readings, stats_windows,
+                            history_config.get('comfort')):
+        new_vars['ha_rolling_stats'] = rolling_state
+    ev_data = {"pressure_kPa": pressure_kpa}
+    ev_data.update({key: {'properties': point_properties}
+                    for key, point_properties in properties.items()})
+    for key, sensor_stats in rolling_stats(
+            rolling_state, stats_windows).items():
+        if key in points:
+            ev_data.setdefault(key, {})['stats'] = sensor_stats
 
     # Make arrows
-    history_config = get_var(redis, 'ha_history', default={})
-    if 'delta_arrows' not in history_config or \
-            not history_config['delta_arrows']:
-        return
-
-    delta_arrows = history_config['delta_arrows']
-    scan_interval = history_config['scan_interval']
-    len_deque = max(3, int(delta_arrows / scan_interval))
-    points_dq = get_var(redis, 'deque_points',
-                        default=deque([], maxlen=len_deque),
-                        unpickle_object=True)
-    points_dq.append(points)
-    set_var(redis, 'deque_points', points_dq, pickle_object=True)
-
-    num_points_dq = len(points_dq)
-    if num_points_dq > 1:
-        # arrows = {k: [p['xy'], points_dq[0][k]['xy']]
-        #           for k, p in points.items() if k in points_dq[0]
-        #           and p != points_dq[0][k]}
-        arrows = {k: {'xy': [p['xy'], points_dq[0][k]['xy']],
-                      'style': _arrow_style(p['style'])}
-                  for k, p in points.items() if k in points_dq[0]
-                  and p != points_dq[0][k]}
-        # logging.info('MAKE ARROWS: %s', arrows)
-        set_var(redis, 'arrows', arrows)
-
-    # Make evolution JSON endpoint with history
-    if num_points_dq > 3:
-        ev_data = {
-            "num_points": num_points_dq,
-            "pressure_kPa": get_var(redis, 'pressure_kpa')}
-
-        start_p = points_dq[0]
-        mid_p = points_dq[num_points_dq // 2 - 1]
-        end_p = points_dq[-1]
-        ev_data.update(
-            {key: _make_ev_data(start_p.get(key), mid_p.get(key), point)
-             for key, point in end_p.items()})
+    if history_config.get('delta_arrows'):
+        delta_arrows = history_config['delta_arrows']
+        scan_interval = history_config['scan_interval']
+        len_history = max(3, int(delta_arrows / scan_interval))
+        last_record = _make_history_record(points)
+        # One record by scan interval, whatever the number of updates (the
+        # last one is replaced until it is a scan interval newer than the
+        # previous one)
+        previous_record, stored_record = get_history_items(
+            redis, 'history_points', -2, -1)
+        replace_last = previous_record is not None and (
+            _history_record_ts(stored_record)
+            - _history_record_ts(previous_record) < scan_interval)
+        num_records = append_history(
+            redis, 'history_points', last_record, len_history, replace_last)
+        first_record, mid_record = get_history_items(
+            redis, 'history_points', 0, num_records // 2 - 1)
+
+        if num_records > 1:
+            arrows = {k: {'xy': [p['xy'], first_record[k][:2]],
+                          'style': _arrow_style(p['style'])}
+                      for k, p in points.items() if k in first_record
+                      and last_record[k] != first_record[k]}
+            # logging.info('MAKE ARROWS: %s', arrows)
+            new_vars['arrows'] = arrows
+
+        # Evolution between the first, mid and last points of the history
+        if num_records > 3:
+            ev_data["num_points"] = num_records
+            start_p = expand_history_record(first_record)
+            mid_p = expand_history_record(mid_record)
+            end_p = expand_history_record(last_record)
+            for key, point in end_p.items():
+                ev_data.setdefault(key, {}).update(
+                    _make_ev_data(start_p.get(key), mid_p.get(key), point))
+
+    # Make evolution JSON endpoint
+    if len(ev_data) > 1:
         logging.debug(f"EVOLUTION_DATA: {ev_data}")
-        set_var(redis, 'ha_evolution', ev_data)
+        new_vars['ha_evolution'] = ev_data
+        new_vars['ha_evolution_meta'] = content_meta(
+            json.dumps(ev_data, sort_keys=True).encode())
+
+    set_vars(redis, new_vars)
+    if 'ha_evolution_meta' in new_vars:
+        publish_evolution_version(
+            redis, new_vars['ha_evolution_meta']['etag'])
@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+"""Push-based ingestion of sensor states from the HA websocket API.
+
+This runs as a long-lived process (`python -m psychrochartmaker.ha_websocket`)
+subscribed to the `state_changed` events of the configured sensors. When
+it is connected, the periodic polling of HA states is skipped.
+"""
+import asyncio
+import logging
+import urllib.parse
+
+import aiohttp
+from redis.exceptions import LockError
+
+from psychrochartmaker import send_render_task
+from psychrochartmaker.ha_remote_polling import (
+    get_ha_states, get_sensor_entities, make_points_from_states,
+    merge_states, state_lease)
+from psychrochartmaker.remote import API, HomeAssistantError, State
+from psychrodata import Config
+from psychrodata.redis_mng import (
+    get_celery, get_redis, get_var, get_vars, set_var)
+
+
+URL_API_WEBSOCKET = '/api/websocket'
+EVENT_STATE_CHANGED = 'state_changed'
+
+HEARTBEAT = 30  # seconds
+RECONNECT_DELAY = 10  # seconds
+PUSH_ALIVE_EXPIRATION = 3 * HEARTBEAT  # seconds
+
+
+def websocket_url(ha_config):
+    api = API(host=ha_config.get('host', '127.0.0.1'),
+              port=ha_config.get('port', 8123),
+              use_ssl=ha_config.get('use_ssl', False))
+    return urllib.parse.urljoin(
+        api.base_url.replace('http', 'ws', 1), URL_API_WEBSOCKET)
+
+
+async def listen_state_changes(url, api_password, entity_ids,
+                               on_state_changed, on_heartbeat=None):
+    """Subscribe to HA `state_changed` events of some entities.
+
+    `on_state_changed(state)` is called with the new `State` of the wanted
+    entities, when its state value changes. `on_heartbeat()` is called
+    every `HEARTBEAT` seconds, and the subscription ends if it returns False.
+    """
+    loop = asyncio.get_event_loop()
+    async with aiohttp.ClientSession() as session:
+        async with session.ws_connect(url, heartbeat=HEARTBEAT) as ws:
+            msg = await ws.receive_json()
+            if msg.get('type') == 'auth_required':
+                await ws.send_json({'type': 'auth',
+                                    'api_password': api_password})
+                msg = await ws.receive_json()
+            if msg.get('type') != 'auth_ok':
+                raise HomeAssistantError(f"Websocket auth error: {msg}")
+
+            await ws.send_json({'id': 1, 'type': 'subscribe_events',
+                                'event_type': EVENT_STATE_CHANGED})
+            logging.info(f"Subscribed to HA events in {url}")
+
+            tic = loop.time()
+            while True:
+                try:
+                    msg = await ws.receive(timeout=HEARTBEAT)
+                except asyncio.TimeoutError:
+                    msg = None
+
+                if msg is not None:
+                    if msg.type != aiohttp.WSMsgType.TEXT:
+                        logging.warning(f"Websocket closed: {msg}")
+                        return
+                    data = msg.json()
+                    if data.get('type') == 'result' \
+                            and not data.get('success'):
+                        raise HomeAssistantError(
+                            f"Websocket subscription error: {data}")
+                    if data.get('type') == 'event':
+                        _process_event(
+                            data['event'], entity_ids, on_state_changed)
+
+                if loop.time() - tic > HEARTBEAT:
+                    tic = loop.time()
+                    if on_heartbeat is not None and not on_heartbeat():
+                        return
+
+
+def _process_event(event, entity_ids, on_state_changed):
+    event_data = event.get('data', {})
+    if (event.get('event_type') != EVENT_STATE_CHANGED
+            or event_data.get('entity_id') not in entity_ids
+            or not event_data.get('new_state')):
+        return
+
+    old_state = event_data.get('old_state')
+    new_state = event_data['new_state']
+    if old_state and old_state.get('state') == new_state.get('state'):
+        return  # Only attributes changed
+    on_state_changed(State.from_dict(new_state))
+
+
+###############################################################################
+# HA websocket subscriber
+###############################################################################
+def update_ha_state(redis, state):
+    """Merge a state changed event, making new points if it is not stale.
+
+    It holds the same state lease as the polls and the pushed readings, so
+    no update is lost. Returns True if the state changed.
+    """
+    with state_lease(redis):
+        states = get_var(redis, 'ha_states', default={})
+        if not merge_states(states, [state.as_dict()]):
+            logging.debug(f"Stale HA state ignored: {state}")
+            return False
+        set_var(redis, 'ha_states', states)
+        make_points_from_states(redis, states)
+    return True
+
+
+def _push_config(redis):
+    """Return the HA config and sensors if push updates are enabled."""
+    ha_config, sensors = get_vars(
+        redis, 'ha_config', 'ha_sensors', defaults={'ha_config': {}})
+    if ha_config.get('push_updates') and sensors:
+        return ha_config, sensors
+    return None, None
+
+
+async def subscribe_ha_states(redis, celery_obj):
+    """Keep the HA states updated by push while it is enabled in config."""
+    def _on_state_changed(state):
+        logging.debug(f"HA state changed: {state}")
+        if update_ha_state(redis, state):
+            send_render_task(celery_obj, redis, only_if_changed=True)
+
+    def _on_heartbeat():
+        # End the subscription if the config has changed
+        if _push_config(redis) != (ha_config, sensors):
+            return False
+        set_var(redis, 'ha_push_alive', 1, expiration=PUSH_ALIVE_EXPIRATION)
+        return True
+
+    while True:
+        ha_config, sensors = _push_config(redis)
+        if ha_config is None:
+            await asyncio.sleep(HEARTBEAT)
+            continue
+
+        entities = set(get_sensor_entities(sensors))
+
+        try:
+            # Initial states, by polling
+            if get_ha_states(redis, make_points=True):
+                send_render_task(celery_obj, redis, only_if_changed=True)
+                set_var(redis, 'ha_push_alive', 1,
+                        expiration=PUSH_ALIVE_EXPIRATION)
+                await listen_state_changes(
+                    websocket_url(ha_config),
+                    ha_config.get('api_password'), entities,
+                    _on_state_changed, _on_heartbeat)
+        except (aiohttp.ClientError, HomeAssistantError, LockError,
+                ValueError) as exc:
+            # A missed event is recovered with the initial poll
+            logging.error(f"{exc.__class__}: {str(exc)}")
+
+        set_var(redis, 'ha_push_alive', 0)
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+def main():
+    logging.basicConfig(
+        level=Config.LOG_LEVEL, datefmt='%d/%m/%Y %H:%M:%S',
+        format='%(levelname)s [%(filename)s_%(funcName)s] '
+               '- %(asctime)s: %(message)s')
+    redis = get_redis()
+    celery_obj = get_celery('hawebsocket')
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(subscribe_ha_states(redis, celery_obj))
+
+
+if __name__ == '__main__':
+    main()
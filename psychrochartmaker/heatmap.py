@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Density layer with the time spent by each sensor in each zone of the chart.
+
+A 2D histogram by sensor over the dry bulb temp / humidity ratio plane, in
+bins of the chart limits, updated with one bin increment by reading. The
+counts are kept in `HEATMAP_SLICES` slices of time, so the old ones expire
+with the configured period, as sparse dicts of `{bin index: count}`.
+
+The sensor totals (also sparse) are the chart layer, drawn as one image
+with the color of each sensor, whatever the number of readings.
+"""
+import matplotlib.colors as mcolors
+import numpy as np
+
+from psychrochartmaker.psychrometrics import (
+    SATURATION_MODE_POINTS, humidity_ratio, saturation_pressure)
+
+
+HEATMAP_PERIOD = 7 * 86400  # seconds
+HEATMAP_RESOLUTION = (.5, .25)  # (°C, g/kg)
+HEATMAP_SLICES = 24
+HEATMAP_ALPHA = .6
+# Over the zones, under the curves and points
+HEATMAP_ZORDER = 1.5
+
+
+def heatmap_grid(chart_style, resolution=HEATMAP_RESOLUTION):
+    """Bins of the chart plane: [t_min, t_max, w_min, w_max, n_t, n_w]."""
+    t_min, t_max = chart_style['limits']['range_temp_c']
+    w_min, w_max = chart_style['limits']['range_humidity_g_kg']
+    t_step, w_step = resolution
+    return [t_min, t_max, w_min, w_max,
+            max(1, int(round((t_max - t_min) / t_step))),
+            max(1, int(round((w_max - w_min) / w_step)))]
+
+
+def update_heatmap(state, readings, grid, p_atm_kpa,
+                   period=HEATMAP_PERIOD):
+    """Add new readings, `{sensor: (ts, temp, humid)}`, to the heatmap state.
+
+    The state is reset if the grid changes. Readings not newer than the
+    last one of the sensor, or out of the grid, are not counted.
+    Returns True if the state changed.
+    """
+    changed = False
+    if state.get('grid') != grid or state.get('period') != period:
+        state.clear()
+        state.update(grid=grid, period=period, sensors={})
+        changed = True
+    if not readings:
+        return changed
+
+    keys = list(readings)
+    ts, temps, humids = np.array(
+        [readings[key] for key in keys], dtype=float).T
+    # In the same place as the points in the chart
+    w_g_kg = 1000 * humidity_ratio(
+        saturation_pressure(temps, SATURATION_MODE_POINTS) * humids / 100,
+        p_atm_kpa)
+    t_min, t_max, w_min, w_max, n_t, n_w = grid
+    col = np.floor((temps - t_min) / (t_max - t_min) * n_t)
+    row = np.floor((w_g_kg - w_min) / (w_max - w_min) * n_w)
+    in_grid = (col >= 0) & (col < n_t) & (row >= 0) & (row < n_w)
+    bins = (row * n_t + col).astype(int)
+
+    slice_size = period / HEATMAP_SLICES
+    for i, key in enumerate(keys):
+        sensor_state = state['sensors'].setdefault(
+            key, {'last': None, 'slices': []})
+        if sensor_state['last'] is not None and ts[i] <= sensor_state['last']:
+            continue
+        sensor_state['last'] = ts[i]
+        changed = True
+        slices = sensor_state['slices']
+        # Expire the slices out of the period
+        while slices and slices[0][0] + slice_size <= ts[i] - period:
+            slices.pop(0)
+        if not in_grid[i]:
+            continue
+        start = ts[i] - ts[i] % slice_size
+        if not slices or slices[-1][0] != start:
+            slices.append([start, {}])
+        counts = slices[-1][1]
+        counts[str(bins[i])] = counts.get(str(bins[i]), 0) + 1
+    return changed
+
+
+def heatmap_layer(state):
+    """Chart layer with the sparse totals by sensor, as [[bin, count], ...]."""
+    t_min, t_max, w_min, w_max, n_t, n_w = state['grid']
+    sensors = {}
+    for key, sensor_state in state['sensors'].items():
+        totals = {}
+        for _start, counts in sensor_state['slices']:
+            for index, count in counts.items():
+                totals[int(index)] = totals.get(int(index), 0) + count
+        if totals:
+            sensors[key] = sorted(totals.items())
+    return {'extent': [t_min, t_max, w_min, w_max], 'shape': [n_w, n_t],
+            'sensors': sensors}
+
+
+def heatmap_image(layer, colors):
+    """RGBA image of the layer, with the sensors in their colors.
+
+    The opacity of each bin grows with the time spent in it by the sensor,
+    relative to its most visited bin.
+    """
+    n_w, n_t = layer['shape']
+    image = np.zeros((n_w * n_t, 4))
+    for key, totals in layer['sensors'].items():
+        indexes, counts = np.array(totals, dtype=float).T
+        alpha = np.zeros(n_w * n_t)
+        alpha[indexes.astype(int)] = HEATMAP_ALPHA * np.sqrt(
+            counts / counts.max())
+        rgb = np.array(mcolors.to_rgb(colors.get(key, 'darkgrey')))
+        # Composite over the image of the previous sensors
+        new_alpha = alpha + image[:, 3] * (1 - alpha)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            image[:, :3] = np.where(
+                new_alpha[:, None] > 0,
+                (rgb * alpha[:, None]
+                 + image[:, :3] * (image[:, 3] * (1 - alpha))[:, None])
+                / new_alpha[:, None], 0)
+        image[:, 3] = new_alpha
+    return image.reshape(n_w, n_t, 4)
+
+
+def plot_heatmap(chart, layer, points):
+    """Draw the heatmap layer in the chart, returning its handler."""
+    colors = {key: point['style'].get('color', 'darkgrey')
+              for key, point in (points or {}).items() if 'style' in point}
+    axes = chart.axes
+    xlim, ylim = axes.get_xlim(), axes.get_ylim()
+    handler = axes.imshow(
+        heatmap_image(layer, colors), extent=layer['extent'],
+        origin='lower', aspect='auto', interpolation='nearest',
+        zorder=HEATMAP_ZORDER)
+    axes.set_xlim(xlim)
+    axes.set_ylim(ylim)
+    return handler
@@ -1,61 +1,106 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict
 import datetime as dt
+import hashlib
 from io import BytesIO
+import json
 import logging
+import threading
+import weakref
 
 from psychrochart.chart import PsychroChart, load_config
+try:
+    from PIL import Image
+except ImportError:  # pragma: no cover
+    Image = None
 
-from psychrodata.redis_mng import get_var, set_var
+from psychrochartmaker import raster_var
+from psychrochartmaker.chart_geometry import (
+    background_geometry, overlay_geometry)
+from psychrochartmaker.heatmap import plot_heatmap
+from psychrochartmaker.pressure_table import (
+    DEFAULT_PRESSURE_STEP, PressureTable)
+from psychrochartmaker.svg_optimizer import DEFAULT_PRECISION, optimize_svg
+from psychrodata.content import compressed_variants, content_meta
+from psychrodata.redis_mng import (
+    get_history_items, get_vars, publish_chart_version, set_vars)
 
 
 ###############################################################################
-# PSYCHROCHART SVG GENERATION
+# CHART BACKGROUND CACHE
 ###############################################################################
-def make_psychrochart(redis, altitude=None, pressure_kpa=None,
-                      points=None, connectors=None,
-                      arrows=None, interior_zones=None):
-    """Create the PsychroChart SVG file and save it to disk."""
-    # Load chart style:
-    chart_style = load_config(get_var(redis, 'chart_style'))
-    zones = get_var(redis, 'chart_zones')
+CHART_BACKGROUNDS_MAXSIZE = 4
+PRESSURE_TABLES_MAXSIZE = 2
+# Comfort limits, as vertical lines: (temp, style, label, label params)
+COMFORT_LINES = (
+    (16, {"color": [0.0, 0.125, 0.376], "lw": 2, "ls": ':'},
+     ' TOO COLD, {:g}°C', dict(ha='left', loc=0., fontsize=14)),
+    (23, {"color": [0.475, 0.612, 0.075], "lw": 2, "ls": ':'},
+     None, {}),
+    (30, {"color": [1.0, 0.0, 0.247], "lw": 2, "ls": ':'},
+     'TOO HOT, {:g}°C ', dict(ha='right', loc=1, reverse=True, fontsize=14)),
+)
 
-    if altitude is None:  # Try redis key
-        altitude = get_var(redis, 'altitude')
-    if pressure_kpa is None:  # Try redis key
-        pressure_kpa = get_var(redis, 'pressure_kpa')
-    if points is None:  # Try redis key
-        points = get_var(redis, 'last_points', default={})
-    if arrows is None:  # Try redis key
-        arrows = get_var(redis, 'arrows')
-    if interior_zones is None:  # Try redis key
-        interior_zones = get_var(redis, 'interior_zones')
+# Process-local cache of plotted charts (without annotations) by fingerprint
+_chart_backgrounds = OrderedDict()
+_lock_chart = threading.RLock()
+# JSON geometry of the cached charts, dropped with them
+_background_geometries = weakref.WeakKeyDictionary()
+# Curves by pressure for the last chart configs
+_pressure_tables = OrderedDict()
+
+
+def _fingerprint(*data):
+    return hashlib.sha1(
+        json.dumps(data, sort_keys=True).encode()).hexdigest()
 
+
+def _get_pressure_table(chart_style, zones, pressure_step):
+    key = _fingerprint(chart_style, zones, pressure_step)
+    if key in _pressure_tables:
+        _pressure_tables.move_to_end(key)
+    else:
+        _pressure_tables[key] = PressureTable(
+            chart_style, zones, pressure_step)
+        while len(_pressure_tables) > PRESSURE_TABLES_MAXSIZE:
+            _pressure_tables.popitem(last=False)
+    return _pressure_tables[key]
+
+
+def _make_chart_background(chart_style, zones, altitude, pressure_kpa,
+                           pressure_step=DEFAULT_PRESSURE_STEP):
+    """Plot the static layer of the chart: curves, zones and comfort lines.
+
+    With a `pressure_step` > 0, the curves for a sensor pressure are
+    interpolated from a table of curves by pressure, instead of computed.
+    """
+    chart = None
     p_label = ''
     if pressure_kpa is not None:
-        chart_style['limits']['pressure_kpa'] = pressure_kpa
         p_label = 'P={:.1f} mb '.format(pressure_kpa * 10)
-        chart_style['limits'].pop('altitude_m', None)
         logging.debug(f"using pressure: {pressure_kpa}")
-    elif altitude is not None:
-        chart_style['limits']['altitude_m'] = altitude
-        p_label = 'H={:.0f} m '.format(altitude)
+        if pressure_step > 0:
+            chart = _get_pressure_table(
+                chart_style, zones, pressure_step).make_chart(pressure_kpa)
+
+    if chart is None:
+        chart_style = load_config(chart_style)
+        if pressure_kpa is not None:
+            chart_style['limits']['pressure_kpa'] = pressure_kpa
+            chart_style['limits'].pop('altitude_m', None)
+        elif altitude is not None:
+            chart_style['limits']['altitude_m'] = altitude
+            p_label = 'H={:.0f} m '.format(altitude)
 
-    # Make chart
-    # chart = PsychroChart(chart_style, zones, logger=app.logger)
-    chart = PsychroChart(chart_style, zones)
+        # Make chart
+        # chart = PsychroChart(chart_style, zones, logger=app.logger)
+        chart = PsychroChart(chart_style, zones)
 
     # Append lines
-    t_min, t_opt, t_max = 16, 23, 30
-    chart.plot_vertical_dry_bulb_temp_line(
-        t_min, {"color": [0.0, 0.125, 0.376], "lw": 2, "ls": ':'},
-        ' TOO COLD, {:g}°C'.format(t_min), ha='left',
-        loc=0., fontsize=14)
-    chart.plot_vertical_dry_bulb_temp_line(
-        t_opt, {"color": [0.475, 0.612, 0.075], "lw": 2, "ls": ':'})
-    chart.plot_vertical_dry_bulb_temp_line(
-        t_max, {"color": [1.0, 0.0, 0.247], "lw": 2, "ls": ':'},
-        'TOO HOT, {:g}°C '.format(t_max), ha='right', loc=1,
-        reverse=True, fontsize=14)
+    for temp, style, label, label_params in COMFORT_LINES:
+        chart.plot_vertical_dry_bulb_temp_line(
+            temp, style, label.format(temp) if label else None,
+            **label_params)
 
     # Append pressure / altitude label
     if p_label:
@@ -63,21 +108,103 @@ def make_psychrochart(redis, altitude=None, pressure_kpa=None,
             p_label, (1, 0), xycoords='axes fraction', ha='right', va='bottom',
             fontsize=15, color='darkviolet')
 
+    return chart
+
+
+def get_chart_background(chart_style, zones, altitude=None, pressure_kpa=None,
+                         pressure_step=DEFAULT_PRESSURE_STEP):
+    """Return a plotted chart for the config, reusing it while it is valid."""
+    key = _fingerprint(chart_style, zones, altitude, pressure_kpa,
+                       pressure_step)
+    with _lock_chart:
+        if key in _chart_backgrounds:
+            _chart_backgrounds.move_to_end(key)
+            return _chart_backgrounds[key]
+
+        logging.debug(f"Making new chart background [{key}]")
+        chart = _make_chart_background(
+            chart_style, zones, altitude, pressure_kpa, pressure_step)
+        _chart_backgrounds[key] = chart
+        while len(_chart_backgrounds) > CHART_BACKGROUNDS_MAXSIZE:
+            _, old_chart = _chart_backgrounds.popitem(last=False)
+            old_chart.close_fig()
+        return chart
+
+
+def _drop_chart_background(chart):
+    """Remove a chart from the cache, as its overlay can't be removed."""
+    with _lock_chart:
+        for key, cached_chart in list(_chart_backgrounds.items()):
+            if cached_chart is chart:
+                del _chart_backgrounds[key]
+                chart.close_fig()
+
+
+def clear_chart_backgrounds():
+    with _lock_chart:
+        _pressure_tables.clear()
+        while _chart_backgrounds:
+            _, old_chart = _chart_backgrounds.popitem()
+            old_chart.close_fig()
+
+
+def get_background_geometry(chart):
+    """Return the geometry of a chart background, as JSON bytes."""
+    with _lock_chart:
+        if chart not in _background_geometries:
+            geometry = background_geometry(
+                chart, [(temp, style) for temp, style, _, _ in COMFORT_LINES])
+            _background_geometries[chart] = json.dumps(
+                geometry, separators=(',', ':')).encode()
+        return _background_geometries[chart]
+
+
+def prepare_chart_background(redis, pressure_step=DEFAULT_PRESSURE_STEP):
+    """Plot the chart background for the current config, to warm the cache.
+
+    It also loads the fonts in matplotlib, so the first render is fast.
+    """
+    chart_style, zones, altitude, pressure_kpa = get_vars(
+        redis, 'chart_style', 'chart_zones', 'altitude', 'pressure_kpa')
+    if chart_style is None or zones is None:
+        return False
+    get_chart_background(
+        chart_style, zones, altitude, pressure_kpa, pressure_step)
+    return True
+
+
+###############################################################################
+# PSYCHROCHART SVG GENERATION
+###############################################################################
+WEBP_QUALITY = 90
+
+
+def _history_label(redis):
+    first_record, third_record, last_record = get_history_items(
+        redis, 'history_points', 0, 2, -1)
+    if third_record is not None:  # more than 2 records
+        start = list(first_record.values())[0]
+        end = list(last_record.values())[0]
+        delta = (dt.datetime.fromtimestamp(end[2])
+                 - dt.datetime.fromtimestamp(start[2])).total_seconds()
+        # delta = history_config['delta_arrows']
+        return '∆T:{:.1f}h'.format(delta / 3600.)
+
+
+def _plot_overlay(chart, history_label, points, connectors, arrows,
+                  interior_zones, heatmap=None):
+    """Plot the dynamic layer, returning the extra handlers to remove."""
+    handlers = []
+    if heatmap and heatmap['sensors']:
+        handlers.append(plot_heatmap(chart, heatmap, points))
     if arrows:
         chart.plot_arrows_dbt_rh(arrows)
         # Append history label
-        points_dq = get_var(redis, 'deque_points',
-                            default=[], unpickle_object=True)
-        if len(points_dq) > 2:
-            start = list(points_dq[0].values())[0]
-            end = list(points_dq[-1].values())[0]
-            delta = (dt.datetime.fromtimestamp(end['ts'])
-                     - dt.datetime.fromtimestamp(start['ts'])).total_seconds()
-            # delta = history_config['delta_arrows']
-            chart.axes.annotate(
-                '∆T:{:.1f}h'.format(delta / 3600.),
+        if history_label:
+            handlers.append(chart.axes.annotate(
+                history_label,
                 (0, 0), xycoords='axes fraction', ha='left', va='bottom',
-                fontsize=10, color='darkgrey')
+                fontsize=10, color='darkgrey'))
 
     if points:
         chart.plot_points_dbt_rh(points, connectors,
@@ -85,14 +212,237 @@ def make_psychrochart(redis, altitude=None, pressure_kpa=None,
 
     chart.plot_legend(
         frameon=False, fontsize=15, labelspacing=.8, markerscale=.8)
+    return handlers
 
-    bytes_svg = BytesIO()
-    chart.save(bytes_svg, format='svg')
-    bytes_svg.seek(0)
-    set_var(redis, 'svg_chart', bytes_svg.read())
-    set_var(redis, 'chart_axes', chart.axes, pickle_object=True)
 
+def _remove_overlay(chart, handlers):
     chart.remove_annotations()
-    set_var(redis, 'chart', chart, pickle_object=True)
+    chart.remove_legend()
+    for handler in handlers:
+        handler.remove()
+
 
+def _clean_chart_background(chart, handlers):
+    """Remove the overlay of a cached chart, or drop it if that fails."""
+    try:
+        _remove_overlay(chart, handlers)
+    except Exception as exc:
+        logging.error(f"Can't remove the chart overlay, dropping the chart "
+                      f"background: {exc.__class__}: {str(exc)}")
+        _drop_chart_background(chart)
+
+
+def _chart_state(chart, **chart_inputs):
+    """Compact representation of a chart: its inputs and geometry."""
+    state = dict(chart_inputs)
+    state['figsize'] = [float(v) for v in chart.axes.figure.get_size_inches()]
+    state['xlim'] = [float(v) for v in chart.axes.get_xlim()]
+    state['ylim'] = [float(v) for v in chart.axes.get_ylim()]
+    return state
+
+
+def rebuild_psychrochart(chart_state):
+    """Rebuild a PsychroChart, with its overlay, from its stored state."""
+    chart = _make_chart_background(
+        chart_state['chart_style'], chart_state['zones'],
+        chart_state['altitude'], chart_state['pressure_kpa'])
+    _plot_overlay(chart, chart_state['history_label'],
+                  chart_state['points'], chart_state['connectors'],
+                  chart_state['arrows'], chart_state['interior_zones'],
+                  chart_state.get('heatmap'))
+    return chart
+
+
+def _load_chart_inputs(redis, altitude=None, pressure_kpa=None,
+                       points=None, connectors=None,
+                       arrows=None, interior_zones=None):
+    """Return the chart inputs and the key of the ones of the last chart.
+
+    The inputs not passed are taken from Redis.
+    """
+    (chart_style, zones, redis_altitude, redis_pressure_kpa, redis_points,
+     redis_arrows, redis_interior_zones, heatmap,
+     last_inputs_key) = get_vars(
+        redis, 'chart_style', 'chart_zones', 'altitude', 'pressure_kpa',
+        'last_points', 'arrows', 'interior_zones', 'heatmap',
+        'svg_chart_inputs', defaults={'last_points': {}})
+
+    if altitude is None:  # Try redis key
+        altitude = redis_altitude
+    if pressure_kpa is None:  # Try redis key
+        pressure_kpa = redis_pressure_kpa
+    if points is None:  # Try redis key
+        points = redis_points
+    if arrows is None:  # Try redis key
+        arrows = redis_arrows
+    if interior_zones is None:  # Try redis key
+        interior_zones = redis_interior_zones
+    history_label = None
+    if arrows:
+        history_label = _history_label(redis)
+
+    inputs = OrderedDict([
+        ('chart_style', chart_style), ('zones', zones),
+        ('altitude', altitude), ('pressure_kpa', pressure_kpa),
+        ('points', points), ('connectors', connectors), ('arrows', arrows),
+        ('interior_zones', interior_zones), ('history_label', history_label),
+        ('heatmap', heatmap)])
+    return inputs, last_inputs_key
+
+
+def _plot_chart(inputs, pressure_step=DEFAULT_PRESSURE_STEP):
+    """Plot the chart for some inputs, returning it and the overlay."""
+    # Static layer, only remade when the config or the pressure changes
+    chart = get_chart_background(
+        inputs['chart_style'], inputs['zones'],
+        inputs['altitude'], inputs['pressure_kpa'], pressure_step)
+
+    # Dynamic layer (a partial one can't be removed, so the chart is dropped)
+    try:
+        handlers = _plot_overlay(
+            chart, inputs['history_label'], inputs['points'],
+            inputs['connectors'], inputs['arrows'], inputs['interior_zones'],
+            inputs['heatmap'])
+    except BaseException:
+        _drop_chart_background(chart)
+        raise
+    return chart, handlers
+
+
+def _make_raster(chart, image_type, width):
+    """Rasterize the plotted chart as PNG or WebP, `width` pixels wide."""
+    dpi = width / chart.axes.figure.get_size_inches()[0]
+    bytes_png = BytesIO()
+    chart.save(bytes_png, format='png', dpi=dpi)
+    if image_type == 'png':
+        return bytes_png.getvalue()
+
+    bytes_png.seek(0)
+    bytes_img = BytesIO()
+    Image.open(bytes_png).save(bytes_img, format='WEBP', quality=WEBP_QUALITY)
+    return bytes_img.getvalue()
+
+
+def _make_rasters(chart, raster_sizes, version):
+    """Make raster images of the chart, as vars labeled with its version."""
+    rasters = {}
+    for image_type, width in raster_sizes:
+        if image_type == 'webp' and Image is None:
+            logging.warning('WebP images need Pillow installed')
+            continue
+        rasters[raster_var(image_type, width)] = {
+            'version': version,
+            'data': _make_raster(chart, image_type, width)}
+    return rasters
+
+
+def _make_geometry(chart, inputs, version):
+    """Geometry of the plotted chart as JSON, with meta and variants."""
+    overlay = overlay_geometry(
+        chart.p_atm_kpa, inputs['points'], inputs['arrows'],
+        inputs['interior_zones'], inputs['heatmap'])
+    # The background part is serialized once for each chart background
+    data = (b'{"background":' + get_background_geometry(chart)
+            + b',"overlay":'
+            + json.dumps(overlay, separators=(',', ':')).encode() + b'}')
+    variants = compressed_variants(data)
+    meta = content_meta(data)
+    meta.update(encodings=list(variants))
+    return {'version': version, 'data': data,
+            'meta': meta, 'variants': variants}
+
+
+def make_psychrochart(redis, altitude=None, pressure_kpa=None,
+                      points=None, connectors=None,
+                      arrows=None, interior_zones=None,
+                      only_if_changed=False, store_chart_state=False,
+                      svg_precision=DEFAULT_PRECISION, raster_sizes=(),
+                      pressure_step=DEFAULT_PRESSURE_STEP):
+    """Create the PsychroChart SVG file and save it to disk.
+
+    With `only_if_changed`, the render is skipped when the inputs of the
+    chart are the same than the ones used for the stored SVG.
+    With `store_chart_state`, the inputs and geometry of the chart are
+    also stored, as 'chart_state', to rebuild it with
+    `rebuild_psychrochart`.
+    The SVG is optimized with `svg_precision` decimals in its coordinates,
+    or stored as matplotlib makes it if it is negative.
+    Raster images are also made for the `raster_sizes`, a list of
+    (image_type, width), and the geometry of the chart is stored as JSON,
+    as 'chart_geometry', for the clients drawing it by themselves.
+    The curves for a sensor pressure are interpolated from a table with
+    nodes every `pressure_step` kPa (0 to compute them for each pressure).
+    """
+    # Load chart style and data
+    inputs, last_inputs_key = _load_chart_inputs(
+        redis, altitude, pressure_kpa, points, connectors,
+        arrows, interior_zones)
+
+    # Change detection
+    inputs_key = _fingerprint(*inputs.values())
+    if only_if_changed and last_inputs_key == inputs_key:
+        logging.debug('Same chart inputs, reusing last chart')
+        return True
+
+    with _lock_chart:
+        chart, handlers = _plot_chart(inputs, pressure_step)
+        try:
+            bytes_svg = BytesIO()
+            chart.save(bytes_svg, format='svg')
+            bytes_svg.seek(0)
+            svg_raw = svg = bytes_svg.read()
+            if svg_precision >= 0:
+                svg = optimize_svg(svg_raw, svg_precision)
+                logging.debug(
+                    f"SVG optimized: {len(svg_raw)} -> {len(svg)} bytes")
+            # Compressed variants, made once to serve them as they are
+            variants = compressed_variants(svg)
+            svg_meta = content_meta(svg)
+            svg_meta.update(encodings=list(variants),
+                            size=len(svg), size_raw=len(svg_raw))
+            # With its inputs, to make other images of the same chart
+            new_vars = {'svg_chart': svg,
+                        'svg_chart_meta': svg_meta,
+                        'svg_chart_inputs': inputs_key,
+                        'svg_chart_plot_inputs': dict(inputs)}
+            new_vars.update({f'svg_chart_{encoding}': data
+                             for encoding, data in variants.items()})
+            new_vars['chart_geometry'] = _make_geometry(
+                chart, inputs, svg_meta['etag'])
+            # Pre-warmed raster images (others are made on demand)
+            new_vars.update(_make_rasters(
+                chart, raster_sizes, svg_meta['etag']))
+            if store_chart_state:
+                new_vars['chart_state'] = _chart_state(chart, **inputs)
+        finally:
+            # Always, to not leave the overlay in the cached background
+            _clean_chart_background(chart, handlers)
+
+    set_vars(redis, new_vars)
+    publish_chart_version(redis, inputs_key)
     return True
+
+
+def make_raster_chart(redis, image_type, width,
+                      pressure_step=DEFAULT_PRESSURE_STEP):
+    """Make a raster image of the last chart, if it is not already done.
+
+    It is plotted with the inputs of the last chart, as its version.
+    """
+    svg_meta, inputs, raster = get_vars(
+        redis, 'svg_chart_meta', 'svg_chart_plot_inputs',
+        raster_var(image_type, width))
+    if svg_meta is None or inputs is None:
+        return False
+    if raster is not None and raster['version'] == svg_meta['etag']:
+        return True
+
+    with _lock_chart:
+        chart, handlers = _plot_chart(inputs, pressure_step)
+        try:
+            rasters = _make_rasters(
+                chart, [(image_type, width)], svg_meta['etag'])
+        finally:
+            _clean_chart_background(chart, handlers)
+    set_vars(redis, rasters)
+    return bool(rasters)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""Table of chart curves over the range of atmospheric pressures.
+
+The curves of a chart style are computed at the nodes of a pressure grid,
+each node only once, and the charts for the pressures in between are made
+by linear interpolation of the curves of the two closest nodes, without
+solving any psychrometric equation.
+
+Error bound: the humidity ratio is w = 0.622·pw / (p - pw), so the error of
+the linear interpolation is at most step² / 8 · 2·w / (p - pw)², with w in
+g/kg. In the chart limits (w <= 50 g/kg, p >= 75 kPa), and with the default
+step of 0.5 kPa, it is below 0.001 g/kg, far under the resolution of the
+plot. The curves solved by iteration in psychrochart (dew points, and the
+saturation points of the constant enthalpy and volume lines) keep the
+tolerance of its solver at the nodes, as in the charts made directly.
+"""
+import copy
+
+from psychrochart.chart import PsychroChart, PsychroCurves, load_config
+
+from psychrochartmaker.chart_geometry import CURVE_FAMILIES
+
+
+DEFAULT_PRESSURE_STEP = 0.5  # kPa
+# Realistic atmospheric pressures, from ~2400 m of altitude to sea level highs
+PRESSURE_RANGE_KPA = (75., 110.)
+
+
+def _interp_values(values_0, values_1, frac):
+    return [v0 + frac * (v1 - v0) for v0, v1 in zip(values_0, values_1)]
+
+
+def _interp_curves(curves_0, curves_1, frac):
+    """Interpolated copy of a list of curves, or None if not compatible."""
+    if len(curves_0) != len(curves_1):
+        return None
+    new_curves = []
+    for curve_0, curve_1 in zip(curves_0, curves_1):
+        if (len(curve_0.x_data) != len(curve_1.x_data)
+                or len(curve_0.y_data) != len(curve_1.y_data)):
+            return None
+        curve = copy.copy(curve_0)
+        curve.x_data = _interp_values(curve_0.x_data, curve_1.x_data, frac)
+        curve.y_data = _interp_values(curve_0.y_data, curve_1.y_data, frac)
+        new_curves.append(curve)
+    return new_curves
+
+
+def _interp_family(family_0, family_1, frac):
+    """Interpolated copy of a family of curves, or None if not compatible."""
+    curves = _interp_curves(family_0.curves, family_1.curves, frac)
+    if curves is None:
+        return None
+    return PsychroCurves(curves, family_label=family_0.family_label)
+
+
+class PressureTable(object):
+    """Curves of a chart style and zones, by atmospheric pressure."""
+
+    def __init__(self, chart_style, zones, step=DEFAULT_PRESSURE_STEP,
+                 pressure_range=PRESSURE_RANGE_KPA):
+        self._chart_style = chart_style
+        self._zones = zones
+        self.step = step
+        self.p_min, self.p_max = pressure_range
+        # Not plotted charts, by node index
+        self._nodes = {}
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def _node(self, index):
+        if index not in self._nodes:
+            chart_style = load_config(self._chart_style)
+            chart_style['limits']['pressure_kpa'] = round(
+                self.p_min + index * self.step, 6)
+            chart_style['limits'].pop('altitude_m', None)
+            self._nodes[index] = PsychroChart(chart_style, self._zones)
+        return self._nodes[index]
+
+    def make_chart(self, pressure_kpa):
+        """Return a new (not plotted) chart for the pressure.
+
+        None is returned if the pressure is out of the table, or the curves
+        of its nodes can't be interpolated.
+        """
+        if not self.p_min <= pressure_kpa <= self.p_max:
+            return None
+        index, rest = divmod(pressure_kpa - self.p_min, self.step)
+        index = int(index)
+        frac = rest / self.step
+        chart_0 = self._node(index)
+        chart_1 = self._node(index + 1) if frac else chart_0
+
+        chart = copy.copy(chart_0)
+        chart.p_atm_kpa = pressure_kpa
+        chart._handlers_annotations = []
+        for _name, attr in CURVE_FAMILIES:
+            if getattr(chart_0, attr) is None:
+                continue
+            family = _interp_family(
+                getattr(chart_0, attr), getattr(chart_1, attr), frac)
+            if family is None:
+                return None
+            setattr(chart, attr, family)
+        chart.zones = []
+        for zone_0, zone_1 in zip(chart_0.zones, chart_1.zones):
+            zone = _interp_family(zone_0, zone_1, frac)
+            if zone is None:
+                return None
+            chart.zones.append(zone)
+        return chart
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""Derived psychrometric properties of moist air, for arrays of readings.
+
+Same equations (2009 ASHRAE Handbook—Fundamentals) as psychrochart, with
+its same saturation pressure approximations (`mode`), so the values match
+the chart, but evaluated with NumPy for any number of sensors or readings
+in one call.
+The wet bulb temperature, with no closed form, is solved by bisection of
+all the values at the same time.
+"""
+import numpy as np
+from psychrochart.equations import (
+    DELTA_TEMP_C_TO_KELVIN, GAS_CONSTANT_R_DA, PRESSURE_STD_ATM_KPA)
+
+
+HUMID_RATIO_VAP_PRES = .621945
+GAS_CONSTANT_R_W = .461524  # kJ/(kg_w·K)
+WET_BULB_ITERATIONS = 30  # bisection steps, for < 1e-7 °C
+# Saturation pressure mode of psychrochart: the default one, of most curves,
+# and the one of the relative humidity curves and the points
+SATURATION_MODE = 3
+SATURATION_MODE_POINTS = 1
+# (key, label in JSON, decimals) of the derived properties
+PROPERTIES = (
+    ('humidity_ratio', 'w [g/kg]', 2),
+    ('dew_point', 'Tdp [°C]', 1),
+    ('wet_bulb', 'Twb [°C]', 1),
+    ('enthalpy', 'h [kJ/kg]', 1),
+    ('specific_volume', 'v [m³/kg]', 4),
+    ('absolute_humidity', 'AH [g/m³]', 2))
+
+
+def saturation_pressure(dry_temp_c, mode=SATURATION_MODE):
+    """Saturation pressure of water vapor (kPa), as psychrochart.
+
+    Modes: 1, eqs (5) and (6); 2, Magnus formulas for T > 0 / T < 0;
+    3, the simplest one (default in psychrochart).
+    """
+    dry_temp_c = np.asarray(dry_temp_c, dtype=float)
+    if mode == 2:
+        return np.where(
+            dry_temp_c > 0,
+            .6105 * np.exp(17.269 * dry_temp_c / (237.3 + dry_temp_c)),
+            .6105 * np.exp(21.875 * dry_temp_c / (265.5 + dry_temp_c)))
+    if mode != 1:
+        return 19314560 * 10. ** (-1779.75 / (237.3 + dry_temp_c))
+
+    abs_temp = dry_temp_c + DELTA_TEMP_C_TO_KELVIN
+    ln_p_water = (-5.8002206e3 / abs_temp + 1.3914993
+                  - 4.8640239e-2 * abs_temp + 4.1764768e-5 * abs_temp ** 2
+                  - 1.4452093e-8 * abs_temp ** 3
+                  + 6.5459673 * np.log(abs_temp))
+    ln_p_ice = (-5.6745359e3 / abs_temp + 6.3925247
+                - 9.6778430e-3 * abs_temp + 6.2215701e-7 * abs_temp ** 2
+                + 2.0747825e-9 * abs_temp ** 3 - 9.4840240e-13 * abs_temp ** 4
+                + 4.1635019 * np.log(abs_temp))
+    return np.exp(np.where(dry_temp_c > 0, ln_p_water, ln_p_ice)) / 1000
+
+
+def humidity_ratio(p_vapor_kpa, p_atm_kpa):
+    """Humidity ratio (kg/kg_da) from the water vapor pressure, eq (22)."""
+    return HUMID_RATIO_VAP_PRES * p_vapor_kpa / (p_atm_kpa - p_vapor_kpa)
+
+
+def dew_point(p_vapor_kpa):
+    """Dew point temperature, eqs (39) and (40) Peppers 1988."""
+    alpha = np.log(p_vapor_kpa)
+    dew_temp = (6.54 + 14.526 * alpha + .7389 * alpha ** 2
+                + .009486 * alpha ** 3 + .4569 * p_vapor_kpa ** .1984)
+    return np.where(dew_temp < 0,
+                    6.09 + 12.608 * alpha + .4959 * alpha ** 2, dew_temp)
+
+
+def _humidity_ratio_from_temps(dry_temp_c, wet_temp_c, p_atm_kpa):
+    """Humidity ratio from the dry and wet bulb temperatures, eqs (35, 37)."""
+    w_sat_wet = humidity_ratio(saturation_pressure(wet_temp_c), p_atm_kpa)
+    factor_delta = 1.006 * (dry_temp_c - wet_temp_c)
+    w_water = (((2501 - 2.326 * wet_temp_c) * w_sat_wet - factor_delta)
+               / (2501 + 1.86 * dry_temp_c - 4.186 * wet_temp_c))
+    w_ice = (((2830 - .24 * wet_temp_c) * w_sat_wet - factor_delta)
+             / (2830 + 1.86 * dry_temp_c - 2.1 * wet_temp_c))
+    return np.where(dry_temp_c > 0, w_water, w_ice)
+
+
+def wet_bulb(dry_temp_c, w_kg_kga, dew_temp_c, p_atm_kpa):
+    """Wet bulb temperature, between the dew point and the dry bulb temp."""
+    low = np.minimum(dew_temp_c, dry_temp_c) - 1
+    high = np.array(dry_temp_c, dtype=float)
+    for _ in range(WET_BULB_ITERATIONS):
+        mid = (low + high) / 2
+        below = _humidity_ratio_from_temps(
+            dry_temp_c, mid, p_atm_kpa) < w_kg_kga
+        low = np.where(below, mid, low)
+        high = np.where(below, high, mid)
+    return (low + high) / 2
+
+
+def derived_properties(dry_temp_c, relative_humid,
+                       p_atm_kpa=PRESSURE_STD_ATM_KPA):
+    """Derived properties from dry bulb temps (°C) and relative humidities (%).
+
+    Inputs are scalars or arrays (of the same shape, or broadcastable, as a
+    single pressure for all). Returns a dict of arrays, by `PROPERTIES` key:
+    humidity ratio (g/kg), dew point and wet bulb temps (°C), enthalpy
+    (kJ/kg), specific volume (m³/kg) and absolute humidity (g/m³).
+    """
+    dry_temp_c, relative_humid, p_atm_kpa = np.broadcast_arrays(
+        np.asarray(dry_temp_c, dtype=float),
+        np.asarray(relative_humid, dtype=float),
+        np.asarray(p_atm_kpa, dtype=float))
+    p_vapor = saturation_pressure(dry_temp_c) * relative_humid / 100
+    w_kg_kga = humidity_ratio(p_vapor, p_atm_kpa)
+    abs_temp = dry_temp_c + DELTA_TEMP_C_TO_KELVIN
+    with np.errstate(divide='ignore', invalid='ignore'):
+        dew_temp = dew_point(p_vapor)
+        wet_temp = wet_bulb(dry_temp_c, w_kg_kga, dew_temp, p_atm_kpa)
+    return {
+        'humidity_ratio': 1000 * w_kg_kga,
+        'dew_point': dew_temp,
+        'wet_bulb': wet_temp,
+        'enthalpy': 1.006 * dry_temp_c + w_kg_kga * (2501 + 1.86 * dry_temp_c),
+        'specific_volume': (GAS_CONSTANT_R_DA * abs_temp
+                            * (1 + 1.607858 * w_kg_kga) / p_atm_kpa),
+        'absolute_humidity': 1000 * p_vapor / (GAS_CONSTANT_R_W * abs_temp)}
+
+
+def points_properties(points, p_atm_kpa=PRESSURE_STD_ATM_KPA):
+    """Derived properties of the chart points (all in one batch), by key.
+
+    Returns a dict `{point key: {label: value}}`, with the values rounded.
+    """
+    keys = [key for key, point in points.items() if 'xy' in point]
+    if not keys:
+        return {}
+    dry_temps, humids = np.array([points[key]['xy'] for key in keys],
+                                 dtype=float).T
+    properties = derived_properties(dry_temps, humids, p_atm_kpa)
+    columns = [(label, properties[prop].round(decimals).tolist())
+               for prop, label, decimals in PROPERTIES]
+    return {key: {label: None if np.isnan(values[i]) else values[i]
+                  for label, values in columns}
+            for i, key in enumerate(keys)}
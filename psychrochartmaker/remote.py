@@ -7,15 +7,19 @@ HomeAssistantError will be raised.
 For more details about the Python API, please refer to the documentation at
 https://home-assistant.io/developers/python_api/
 """
+import codecs
+from concurrent.futures import ThreadPoolExecutor
 import datetime as dt
 import enum
 import json
 import logging
 import pytz
 import re
+import threading
 
 from types import MappingProxyType
-from typing import Optional, Dict, Any, List
+from typing import (
+    Optional, Dict, Any, Iterable, Iterator, List, Tuple)
 import urllib.parse
 
 # from aiohttp.hdrs import METH_GET, METH_POST, METH_DELETE, CONTENT_TYPE
@@ -30,6 +34,8 @@ ATTR_FRIENDLY_NAME = 'friendly_name'
 CONTENT_TYPE_JSON = 'application/json'
 HTTP_HEADER_HA_AUTH = 'X-HA-access'
 SERVER_PORT = 8123
+DEFAULT_POOL_SIZE = 4
+STREAM_CHUNK_SIZE = 64 * 1024
 
 URL_API = '/api/'
 URL_API_CONFIG = '/api/config'
@@ -55,6 +61,10 @@ DATETIME_RE = re.compile(
     r'(?::(?P<second>\d{1,2})(?:\.(?P<microsecond>\d{1,6})\d{0,6})?)?'
     r'(?P<tzinfo>Z|[+-]\d{2}(?::?\d{2})?)?$')
 
+# Whitespace and separators between the items of a JSON array
+_RE_JSON_ARRAY_SEP = re.compile(r'[\s,]*')
+_JSON_ARRAY_DELIMITERS = (',', ']', ' ', '\t', '\n', '\r')
+
 
 def parse_datetime(dt_str: str) -> Optional[dt.datetime]:
     """Parse a string and return a datetime.datetime.
@@ -264,16 +274,56 @@ class APIStatus(enum.Enum):
         return self.value  # type: ignore
 
 
+# Persistent HTTP sessions (with its connection pool), by base URL
+_SESSIONS = {}  # type: Dict[str, Tuple[requests.Session, int, bool]]
+_LOCK_SESSIONS = threading.Lock()
+
+
+def get_session(base_url: str, pool_size: int = DEFAULT_POOL_SIZE,
+                keep_alive: bool = True) -> requests.Session:
+    """Return the pooled HTTP session for a base URL, creating it once.
+
+    If the pool parameters change, the old session is closed and replaced.
+    """
+    with _LOCK_SESSIONS:
+        if base_url in _SESSIONS:
+            session, old_pool_size, old_keep_alive = _SESSIONS[base_url]
+            if (old_pool_size, old_keep_alive) == (pool_size, keep_alive):
+                return session
+            session.close()
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1, pool_maxsize=pool_size)
+        session.mount(base_url, adapter)
+        if not keep_alive:
+            session.headers['Connection'] = 'close'
+        _SESSIONS[base_url] = session, pool_size, keep_alive
+        return session
+
+
+def close_sessions() -> None:
+    """Close all the persistent HTTP sessions."""
+    with _LOCK_SESSIONS:
+        for session, _, _ in _SESSIONS.values():
+            session.close()
+        _SESSIONS.clear()
+
+
 class API:
     """Object to pass around Home Assistant API location and credentials."""
 
     def __init__(self, host: str, api_password: Optional[str] = None,
                  port: Optional[int] = SERVER_PORT,
-                 use_ssl: bool = False) -> None:
+                 use_ssl: bool = False,
+                 pool_size: int = DEFAULT_POOL_SIZE,
+                 keep_alive: bool = True) -> None:
         """Init the API."""
         self.host = host
         self.port = port
         self.api_password = api_password
+        self.pool_size = pool_size
+        self.keep_alive = keep_alive
 
         if host.startswith(("http://", "https://")):
             self.base_url = host
@@ -299,7 +349,7 @@ class API:
         return self.status == APIStatus.OK
 
     def __call__(self, method: str, path: str, data: Optional[Dict] = None,
-                 timeout: int = 5) -> requests.Response:
+                 timeout: int = 5, stream: bool = False) -> requests.Response:
         """Make a call to the Home Assistant API."""
         if data is None:
             data_str = None
@@ -307,16 +357,17 @@ class API:
             data_str = json.dumps(data, cls=JSONEncoder)
 
         url = urllib.parse.urljoin(self.base_url, path)
+        session = get_session(self.base_url, self.pool_size, self.keep_alive)
 
         try:
             if method == METH_GET:
-                return requests.get(
+                return session.get(
                     url, params=data_str, timeout=timeout,
-                    headers=self._headers)
+                    headers=self._headers, stream=stream)
 
-            return requests.request(
+            return session.request(
                 method, url, data=data_str, timeout=timeout,
-                headers=self._headers)
+                headers=self._headers, stream=stream)
 
         except requests.exceptions.ConnectionError:
             _LOGGER.exception("Error connecting to server")
@@ -369,17 +420,108 @@ def validate_api(api: API) -> APIStatus:
         return APIStatus.CANNOT_CONNECT
 
 
-def get_states(api: API) -> List[State]:
-    """Query given API for all states."""
+def iter_json_array(chunks: Iterable[str]) -> Iterator[Any]:
+    """Decode the items of a JSON array incrementally from text chunks.
+
+    Only one item (plus the last chunk) is kept in memory at a time.
+    Raises ValueError if the data is not a well formatted JSON array.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    in_array = False
+    for chunk in chunks:
+        buffer += chunk
+        pos = 0
+        while True:
+            pos = _RE_JSON_ARRAY_SEP.match(buffer, pos).end()
+            if pos == len(buffer):
+                break
+            if not in_array:
+                if buffer[pos] != '[':
+                    raise ValueError("JSON data is not an array")
+                in_array = True
+                pos += 1
+                continue
+            if buffer[pos] == ']':
+                return
+            try:
+                item, pos_end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                # Incomplete item, wait for more data
+                break
+            if buffer[pos_end:pos_end + 1] not in _JSON_ARRAY_DELIMITERS:
+                # Until its delimiter, as a number can continue in the next
+                # chunk (or the rest is not valid)
+                break
+            yield item
+            pos = pos_end
+        buffer = buffer[pos:]
+
+    raise ValueError("Incomplete JSON array")
+
+
+def _iter_response_text(req: requests.Response) -> Iterator[str]:
+    decoder = codecs.getincrementaldecoder(req.encoding or 'utf-8')()
+    for chunk in req.iter_content(chunk_size=STREAM_CHUNK_SIZE):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+def get_states(api: API,
+               entity_ids: Optional[Iterable[str]] = None) -> List[State]:
+    """Query given API for all states.
+
+    With `entity_ids`, the response is parsed as a stream, and only the
+    states of those entities are built.
+    """
     try:
-        req = api(METH_GET,
-                  URL_API_STATES)
+        if entity_ids is None:
+            req = api(METH_GET,
+                      URL_API_STATES)
 
-        return [State.from_dict(item) for
-                item in req.json()]
+            return [State.from_dict(item) for
+                    item in req.json()]
 
-    except (HomeAssistantError, ValueError, AttributeError):
+        wanted = set(entity_ids)
+        req = api(METH_GET, URL_API_STATES, stream=True)
+        try:
+            return [State.from_dict(item) for
+                    item in iter_json_array(_iter_response_text(req))
+                    if item.get('entity_id') in wanted]
+        finally:
+            req.close()
+
+    except (HomeAssistantError, ValueError, AttributeError,
+            requests.exceptions.RequestException):
         # ValueError if req.json() can't parse the json
         _LOGGER.error("Error fetching states")
 
         return []
+
+
+def get_state(api: API, entity_id: str) -> Optional[State]:
+    """Query given API for state of entity_id."""
+    try:
+        req = api(METH_GET, URL_API_STATES_ENTITY.format(entity_id))
+
+        # req.status_code == 404 if entity does not exist
+        return State.from_dict(req.json()) \
+            if req.status_code == 200 else None
+
+    except (HomeAssistantError, ValueError):
+        # ValueError if req.json() can't parse the json
+        _LOGGER.error("Error fetching state of %s", entity_id)
+
+        return None
+
+
+def get_entity_states(api: API, entity_ids: List[str]) -> List[State]:
+    """Query given API for the states of some entities, concurrently."""
+    if not entity_ids:
+        return []
+
+    num_workers = min(len(entity_ids), api.pool_size)
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        states = executor.map(lambda x: get_state(api, x), entity_ids)
+
+    return [state for state in states if state is not None]
@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""Incremental rolling statistics of the sensors, over several time windows.
+
+Each window is divided in `PANES_PER_WINDOW` panes of time, with the count,
+sum, min, max, time sums (for the least squares slope) and the time spent
+below and above the comfort range of each variable, so each new reading
+only updates the current pane of each window, and the window statistics
+are a merge of its panes. Windows include the readings of the (partial)
+oldest pane, so they can be up to 1/PANES_PER_WINDOW longer.
+
+The state is a plain dict (to store it in Redis), by sensor:
+`{'last': [ts, temp, humid], 'panes': {window: [pane, ...]}}`.
+"""
+
+
+DEFAULT_WINDOWS = (900, 3600, 86400)  # seconds
+PANES_PER_WINDOW = 12
+# Comfort ranges, as the comfort lines of the chart
+DEFAULT_COMFORT = {'temperature': (16, 30), 'humidity': (30, 70)}
+VARIABLES = (('temperature', 'T', '°C'), ('humidity', 'HR', '%'))
+
+# Pane: [start, time, *stats of each variable]
+PANE_START, PANE_TIME = 0, 1
+STATS_SIZE = 9
+(COUNT, SUM, MIN, MAX, SUM_DT, SUM_DT2, SUM_DT_V,
+ TIME_BELOW, TIME_ABOVE) = range(STATS_SIZE)
+
+
+def _new_pane(start):
+    pane = [start, 0.]
+    for _ in VARIABLES:
+        pane += [0, 0., None, None, 0., 0., 0., 0., 0.]
+    return pane
+
+
+def _update_pane(pane, ts, values, elapsed, last_values, comfort):
+    pane[PANE_TIME] += elapsed
+    dt = ts - pane[PANE_START]
+    for i, (name, _label, _unit) in enumerate(VARIABLES):
+        base = 2 + i * STATS_SIZE
+        value = values[i]
+        pane[base + COUNT] += 1
+        pane[base + SUM] += value
+        if pane[base + MIN] is None or value < pane[base + MIN]:
+            pane[base + MIN] = value
+        if pane[base + MAX] is None or value > pane[base + MAX]:
+            pane[base + MAX] = value
+        pane[base + SUM_DT] += dt
+        pane[base + SUM_DT2] += dt * dt
+        pane[base + SUM_DT_V] += dt * value
+        # The time since the last reading had its value
+        if elapsed and last_values is not None:
+            low, high = comfort[name]
+            if last_values[i] < low:
+                pane[base + TIME_BELOW] += elapsed
+            elif last_values[i] > high:
+                pane[base + TIME_ABOVE] += elapsed
+
+
+def update_rolling_stats(state, readings, windows=DEFAULT_WINDOWS,
+                         comfort=None):
+    """Add new readings, `{sensor: (ts, temp, humid)}`, to the state.
+
+    Readings not newer than the last one of the sensor are ignored.
+    Returns True if any was added.
+    """
+    comfort = {**DEFAULT_COMFORT, **(comfort or {})}
+    changed = False
+    for sensor, (ts, *values) in readings.items():
+        sensor_state = state.setdefault(sensor, {'last': None, 'panes': {}})
+        last = sensor_state['last']
+        if last is not None and ts <= last[0]:
+            continue
+
+        elapsed = ts - last[0] if last is not None else 0.
+        last_values = last[1:] if last is not None else None
+        all_panes = sensor_state['panes']
+        for window in windows:
+            pane_size = window / PANES_PER_WINDOW
+            panes = all_panes.setdefault(str(window), [])
+            start = ts - ts % pane_size
+            if not panes or panes[-1][PANE_START] != start:
+                panes.append(_new_pane(start))
+            _update_pane(panes[-1], ts, values, elapsed, last_values,
+                         comfort)
+            # Expire the panes out of the window
+            while panes[0][PANE_START] + pane_size <= ts - window:
+                panes.pop(0)
+        # Windows not configured anymore
+        for window in set(all_panes) - {str(w) for w in windows}:
+            all_panes.pop(window)
+        sensor_state['last'] = [ts, *values]
+        changed = True
+    return changed
+
+
+def _merge_stats(panes, base, ref):
+    """Merge the stats of a variable in some panes, with times from `ref`."""
+    count = total = sum_dt = sum_dt2 = sum_dt_v = below = above = 0
+    v_min = v_max = None
+    for pane in panes:
+        n = pane[base + COUNT]
+        if not n:
+            continue
+        shift = pane[PANE_START] - ref
+        count += n
+        total += pane[base + SUM]
+        sum_dt2 += (pane[base + SUM_DT2] + 2 * shift * pane[base + SUM_DT]
+                    + n * shift * shift)
+        sum_dt += pane[base + SUM_DT] + n * shift
+        sum_dt_v += pane[base + SUM_DT_V] + shift * pane[base + SUM]
+        below += pane[base + TIME_BELOW]
+        above += pane[base + TIME_ABOVE]
+        v_min = min(v_min, pane[base + MIN]) if v_min is not None \
+            else pane[base + MIN]
+        v_max = max(v_max, pane[base + MAX]) if v_max is not None \
+            else pane[base + MAX]
+    return (count, total, v_min, v_max, sum_dt, sum_dt2, sum_dt_v,
+            below, above)
+
+
+def _window_label(window):
+    for size, unit in ((86400, 'd'), (3600, 'h'), (60, 'min')):
+        if window % size == 0:
+            return f'{window // size}{unit}'
+    return f'{window}s'
+
+
+def rolling_stats(state, windows=DEFAULT_WINDOWS):
+    """Statistics of each sensor in each window, by sensor and window label.
+
+    For each variable: min, max, mean, slope (least squares, by hour), and
+    the % of time below and above its comfort range.
+    """
+    stats = {}
+    for sensor, sensor_state in state.items():
+        if sensor_state['last'] is None:
+            continue
+        ref = sensor_state['last'][0]
+        sensor_stats = stats[sensor] = {}
+        for window in windows:
+            panes = sensor_state['panes'].get(str(window), [])
+            time_total = sum(pane[PANE_TIME] for pane in panes)
+            window_stats = {}
+            for i, (_name, label, unit) in enumerate(VARIABLES):
+                (count, total, v_min, v_max, sum_dt, sum_dt2, sum_dt_v,
+                 below, above) = _merge_stats(panes, 2 + i * STATS_SIZE, ref)
+                if not count:
+                    continue
+                denominator = count * sum_dt2 - sum_dt * sum_dt
+                slope = ((count * sum_dt_v - sum_dt * total) / denominator
+                         if count > 1 and denominator > 0 else 0.)
+                window_stats[f'{label} [{unit}]'] = {
+                    'min': round(v_min, 2), 'max': round(v_max, 2),
+                    'mean': round(total / count, 2),
+                    f'∆{label} [{unit}/h]': round(slope * 3600, 3),
+                    'below [%]': round(100 * below / time_total, 1)
+                    if time_total else 0.,
+                    'above [%]': round(100 * above / time_total, 1)
+                    if time_total else 0.}
+            if window_stats:
+                window_stats['num_readings'] = _merge_stats(panes, 2, ref)[0]
+                sensor_stats[_window_label(window)] = window_stats
+    return stats
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+"""Post-processing of the matplotlib SVG output, to make it smaller.
+
+- Coordinates in path data and positions are rounded to `precision`
+  decimals, and the path data is written without extra whitespace.
+- Comments, DOCTYPE, metadata, unreferenced ids and the group wrappers
+  left without attributes are removed.
+- Consecutive opaque stroked paths (without fill) with the same attributes
+  are merged into one path (translucent ones are not, as the overlaps of
+  a merged path are drawn once).
+- Inline styles used more than once are moved to CSS classes.
+"""
+import re
+import xml.etree.ElementTree as ElementTree
+
+
+NS_SVG = 'http://www.w3.org/2000/svg'
+NS_XLINK = 'http://www.w3.org/1999/xlink'
+ElementTree.register_namespace('', NS_SVG)
+ElementTree.register_namespace('xlink', NS_XLINK)
+
+TAG_G = f'{{{NS_SVG}}}g'
+TAG_PATH = f'{{{NS_SVG}}}path'
+TAG_STYLE = f'{{{NS_SVG}}}style'
+TAG_DEFS = f'{{{NS_SVG}}}defs'
+TAG_METADATA = f'{{{NS_SVG}}}metadata'
+TAG_TEXT = f'{{{NS_SVG}}}text'
+
+DEFAULT_PRECISION = 2
+# Attributes with coordinates (transforms are not rounded, as they scale)
+ROUND_ATTRS = ('x', 'y', 'x1', 'x2', 'y1', 'y2', 'cx', 'cy', 'r',
+               'width', 'height')
+MIN_USES_STYLE_CLASS = 2
+OPACITY_PROPERTIES = ('opacity', 'stroke-opacity')
+
+_RE_NUMBER = re.compile(r'-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_RE_PATH_TOKEN = re.compile(
+    r'[A-Za-z]|-?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?')
+_RE_ID_REF = re.compile(r'(?:url\(#|href="#)([^)"]+)')
+
+
+def _format_number(value, precision):
+    text = f"{round(float(value), precision):.{precision}f}"
+    if '.' in text:
+        text = text.rstrip('0').rstrip('.')
+    return '0' if text == '-0' else text
+
+
+def _compact_path(path_data, precision):
+    parts = []
+    last_is_number = False
+    for token in _RE_PATH_TOKEN.findall(path_data):
+        if token[0].isalpha():
+            parts.append(token)
+            last_is_number = False
+        else:
+            number = _format_number(token, precision)
+            if last_is_number and not number.startswith('-'):
+                parts.append(' ')
+            parts.append(number)
+            last_is_number = True
+    return ''.join(parts)
+
+
+def _round_numbers(value, precision):
+    return _RE_NUMBER.sub(
+        lambda m: _format_number(m.group(), precision), value)
+
+
+def _simplify(parent, precision, referenced_ids):
+    """Round, strip and unwrap the children of an element, recursively."""
+    new_children = []
+    for child in list(parent):
+        if child.tag == TAG_METADATA:
+            continue
+        if 'id' in child.attrib and child.get('id') not in referenced_ids:
+            del child.attrib['id']
+        if 'd' in child.attrib:
+            child.set('d', _compact_path(child.get('d'), precision))
+        for attr in ROUND_ATTRS:
+            if attr in child.attrib:
+                child.set(attr, _round_numbers(child.get(attr), precision))
+        if child.tag not in (TAG_STYLE, TAG_TEXT):
+            if child.text is not None and not child.text.strip():
+                child.text = None
+            _simplify(child, precision, referenced_ids)
+        if child.tail is not None and not child.tail.strip():
+            child.tail = None
+
+        if child.tag == TAG_G and not child.attrib:
+            new_children.extend(child)  # Unwrap group
+        else:
+            new_children.append(child)
+
+    parent[:] = _merge_paths(new_children)
+
+
+def _parse_style(style):
+    """Declarations of an inline style, as a dict."""
+    declarations = {}
+    for declaration in style.split(';'):
+        name, sep, value = declaration.partition(':')
+        if sep:
+            declarations[name.strip().lower()] = value.strip()
+    return declarations
+
+
+def _is_opaque(value):
+    try:
+        return float(value) >= 1
+    except ValueError:
+        return False
+
+
+def _mergeable_key(element):
+    """Attributes of an opaque stroked path without fill, or None."""
+    if (element.tag != TAG_PATH or 'id' in element.attrib
+            or 'd' not in element.attrib):
+        return None
+    # Presentation attributes, overridden by the inline style
+    properties = {name: element.get(name).strip()
+                  for name in ('fill',) + OPACITY_PROPERTIES
+                  if name in element.attrib}
+    properties.update(_parse_style(element.get('style', '')))
+    if properties.get('fill') != 'none' or not all(
+            _is_opaque(properties.get(name, '1'))
+            for name in OPACITY_PROPERTIES):
+        return None
+    return (tuple(sorted(properties.items())),
+            tuple(sorted((k, v) for k, v in element.attrib.items()
+                         if k not in ('d', 'style'))))
+
+
+def _merge_paths(elements):
+    """Merge consecutive opaque stroked paths with the same attributes."""
+    merged = []
+    last_key = None
+    for element in elements:
+        key = _mergeable_key(element)
+        if key is not None and key == last_key:
+            previous = merged[-1]
+            previous.set('d', previous.get('d') + element.get('d'))
+            continue
+        merged.append(element)
+        last_key = key
+    return merged
+
+
+def _styles_to_classes(root):
+    """Move the repeated inline styles to CSS classes."""
+    elements = [e for e in root.iter() if 'style' in e.attrib]
+    counter = {}
+    for element in elements:
+        style = element.get('style')
+        counter[style] = counter.get(style, 0) + 1
+
+    classes = {}
+    for element in elements:
+        style = element.get('style')
+        if counter[style] < MIN_USES_STYLE_CLASS:
+            continue
+        if style not in classes:
+            classes[style] = f's{len(classes)}'
+        del element.attrib['style']
+        element.set('class', classes[style])
+
+    if classes:
+        css = ''.join(f'.{name}{{{style}}}'
+                      for style, name in classes.items())
+        style_elem = root.find(f'{TAG_DEFS}/{TAG_STYLE}')
+        if style_elem is None:
+            defs = root.find(TAG_DEFS)
+            if defs is None:
+                defs = ElementTree.Element(TAG_DEFS)
+                root.insert(0, defs)
+            style_elem = ElementTree.SubElement(
+                defs, TAG_STYLE, {'type': 'text/css'})
+        style_elem.text = (style_elem.text or '').strip() + css
+
+
+def optimize_svg(svg: bytes, precision: int = DEFAULT_PRECISION) -> bytes:
+    """Return a smaller, equivalent, SVG."""
+    referenced_ids = set(_RE_ID_REF.findall(svg.decode()))
+    # Comments and DOCTYPE are dropped by the parser
+    root = ElementTree.fromstring(svg)
+    root.text = None
+    _simplify(root, precision, referenced_ids)
+    _styles_to_classes(root)
+    return ElementTree.tostring(root, encoding='utf-8', method='xml')
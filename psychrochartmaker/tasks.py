@@ -3,25 +3,53 @@ import logging
 import sys
 
 from celery import shared_task
+from celery.exceptions import SoftTimeLimitExceeded
+from celery.signals import worker_process_init
+from redis.exceptions import LockError
 
+from psychrodata import Config
 from psychrodata.common import (
     load_chart_styles, load_chart_zones, load_homeassistant_config,
     save_homeassistant_config, save_chart_style, save_chart_zones)
 from psychrodata.redis_mng import (
     get_redis, get_celery,
-    get_var, set_var, has_var, remove_var, clean_all_vars)
+    get_var, get_vars, set_vars, remove_vars, clean_all_vars,
+    publish_chart_version, publish_evolution_version)
 
 from psychrochartmaker import (
     TASK_CLEAN_CACHE_DATA, TASK_CREATE_PSYCHROCHART, TASK_RELOAD_HA_CONFIG,
-    TASK_PERIODIC_GET_HA_STATES)
+    TASK_PERIODIC_GET_HA_STATES, TASK_INGEST_SENSOR_READINGS,
+    TASK_MAKE_RASTER_CHART, end_raster_request, parse_raster_sizes,
+    render_lease, schedule_render, send_render_task, take_render_request)
 from psychrochartmaker.ha_remote_polling import (
-    get_ha_states, make_points_from_states, get_ha_api, parse_config_ha)
-from psychrochartmaker.make_charts import make_psychrochart
+    get_ha_states, merge_sensor_readings, parse_config_ha, reset_ha_api)
+from psychrochartmaker.make_charts import (
+    clear_chart_backgrounds, make_psychrochart, make_raster_chart,
+    prepare_chart_background)
 
 
 redis = get_redis()
 celery = get_celery('chartworker')
 
+RENDER_SOFT_TIME_LIMIT = 30  # seconds
+RENDER_TIME_LIMIT = 45  # seconds
+KEY_POLLING_LEASE = 'ha_polling_lease'
+POLLING_LEASE_TTL = 60  # seconds
+
+
+###############################################################################
+# Render worker processes
+###############################################################################
+@worker_process_init.connect
+def _warm_up_render_process(**kwargs):
+    """Plot the chart background as soon as a render process is forked."""
+    try:
+        if prepare_chart_background(redis, Config.PRESSURE_TABLE_STEP):
+            logging.info('Chart background ready in render process')
+    except Exception as exc:
+        logging.error(f"Can't prepare chart background: "
+                      f"{exc.__class__}: {str(exc)}")
+
 
 ###############################################################################
 # Celery Tasks
@@ -31,10 +59,14 @@ def _log_task_init(task_name):
 
 
 def _load_chart_config():
-    if not has_var(redis, 'chart_style'):
-        set_var(redis, 'chart_style', load_chart_styles())
-    if not has_var(redis, 'chart_zones'):
-        set_var(redis, 'chart_zones', load_chart_zones())
+    chart_style, chart_zones = get_vars(redis, 'chart_style', 'chart_zones')
+    new_config = {}
+    if chart_style is None:
+        new_config['chart_style'] = load_chart_styles()
+    if chart_zones is None:
+        new_config['chart_zones'] = load_chart_zones()
+    if new_config:
+        set_vars(redis, new_config)
     logging.info('CHART CONFIG LOADED')
 
 
@@ -47,6 +79,9 @@ def _load_homeassistant_config():
 
 def _clean_all():
     clean_all_vars(redis)
+    clear_chart_backgrounds()
+    publish_chart_version(redis, None)
+    publish_evolution_version(redis, None)
     logging.warning('CACHE DATA CLEANED')
 
 
@@ -59,22 +94,94 @@ def clean_cache_data():
     return True
 
 
-@shared_task(name=TASK_CREATE_PSYCHROCHART)
-def create_psychrochart():
-    make_psychrochart(redis)
-    return True
+def _save_changed_config():
+    """Save to disk the config changes, once they produce a chart."""
+    ha_yaml_changed, chart_config_changed = get_vars(
+        redis, 'ha_yaml_changed', 'chart_config_changed')
+    if ha_yaml_changed:
+        # HA Configuration changed, and the result is OK, saving it now
+        logging.warning('Saving HA config to disk '
+                        '(after producing successfully one chart)')
+        save_homeassistant_config(get_var(redis, 'ha_yaml_config'))
+        remove_vars(redis, 'ha_yaml_changed', 'ha_yaml_config')
+        _load_homeassistant_config()
+
+    if chart_config_changed:
+        # HA Configuration changed, and the result is OK, saving it now
+        logging.warning('Saving PsychroChart config to disk '
+                        '(after producing successfully one chart)')
+        chart_style, chart_zones = get_vars(
+            redis, 'chart_style', 'chart_zones')
+        save_chart_style(chart_style)
+        save_chart_zones(chart_zones)
+        remove_vars(redis, 'chart_config_changed',
+                    'chart_style', 'chart_zones')
+        _load_chart_config()
+
+
+@shared_task(name=TASK_CREATE_PSYCHROCHART,
+             soft_time_limit=RENDER_SOFT_TIME_LIMIT,
+             time_limit=RENDER_TIME_LIMIT)
+def create_psychrochart(only_if_changed=False):
+    """Render task, executed by the prefork worker of the render queue.
+
+    It renders with the latest data, for all the requests collapsed in it,
+    holding the render lease, so only one render runs at a time.
+    """
+    lease = render_lease(redis)
+    if not lease.acquire(blocking=False):
+        logging.debug('Render in progress, rescheduling render')
+        schedule_render(celery, redis, Config.RENDER_MIN_INTERVAL,
+                        reschedule=True)
+        return False
+
+    try:
+        if take_render_request(redis):
+            only_if_changed = False
+        ok = make_psychrochart(
+            redis, only_if_changed=only_if_changed,
+            store_chart_state=Config.STORE_CHART_STATE,
+            svg_precision=Config.SVG_PRECISION,
+            raster_sizes=parse_raster_sizes(Config.RASTER_PREWARM),
+            pressure_step=Config.PRESSURE_TABLE_STEP)
+    except SoftTimeLimitExceeded:
+        logging.error(f"Chart render took more than "
+                      f"{RENDER_SOFT_TIME_LIMIT}s. Aborted")
+        return False
+    finally:
+        try:
+            lease.release()
+        except LockError:
+            logging.error('Render lease expired before the render end')
+
+    if ok:
+        _save_changed_config()
+    return ok
+
+
+@shared_task(name=TASK_MAKE_RASTER_CHART, ignore_result=False,
+             soft_time_limit=RENDER_SOFT_TIME_LIMIT,
+             time_limit=RENDER_TIME_LIMIT)
+def make_raster_image(image_type, width):
+    """Render task to make a raster image not pre-warmed with the chart."""
+    try:
+        return make_raster_chart(redis, image_type, width,
+                                 Config.PRESSURE_TABLE_STEP)
+    except SoftTimeLimitExceeded:
+        logging.error(f"Raster chart render took more than "
+                      f"{RENDER_SOFT_TIME_LIMIT}s. Aborted")
+        return False
+    finally:
+        end_raster_request(redis, image_type, width)
 
 
 @shared_task(name=TASK_RELOAD_HA_CONFIG)
 def reload_ha_config():
-    remove_var(redis, 'ha_config')
-    remove_var(redis, 'ha_api')
-    remove_var(redis, 'ha_sensors')
-    remove_var(redis, 'ha_states')
-    remove_var(redis, 'last_points')
-    remove_var(redis, 'points_unknown')
-    remove_var(redis, 'deque_points')
-    remove_var(redis, 'arrows')
+    reset_ha_api()
+    remove_vars(redis, 'ha_config', 'ha_sensors', 'ha_states',
+                'pushed_states', 'last_points', 'points_properties',
+                'points_unknown', 'history_points', 'arrows',
+                'ha_rolling_stats', 'ha_heatmap', 'heatmap')
 
     # TODO Reset/restart periodic task
     # if 'history' in new_data:  # Reset periodic task
@@ -86,53 +193,44 @@ def reload_ha_config():
     return True
 
 
+@shared_task(name=TASK_INGEST_SENSOR_READINGS)
+def ingest_sensor_readings(readings):
+    """Background task to merge sensor readings pushed to the webhook."""
+    _log_task_init("ingest_sensor_readings")
+    if merge_sensor_readings(redis, readings):
+        send_render_task(celery, redis, only_if_changed=True)
+    return True
+
+
 @shared_task(name=TASK_PERIODIC_GET_HA_STATES)
 def periodic_get_ha_states():
     """Background task to update the HA sensors states."""
-    making_chart_now = get_var(redis, 'making_chart_now', default=0)
-    if making_chart_now:
+    # Lease with TTL, so a crashed poll doesn't block the next ones
+    lease = redis.lock(KEY_POLLING_LEASE, timeout=POLLING_LEASE_TTL)
+    if not lease.acquire(blocking=False):
         logging.warning('last periodic_get_ha_states is not finished. '
                         'Aborting this try...')
         return
 
-    set_var(redis, 'making_chart_now', 1)
-    _log_task_init("periodic_get_ha_states")
+    try:
+        _log_task_init("periodic_get_ha_states")
 
-    _load_homeassistant_config()
-    if not has_var(redis, 'ha_api'):
-        get_ha_api(redis)
-    logging.debug('loading states...')
-    states = get_ha_states(redis)
-    if not states:
-        logging.error(f"Can't load HA states!")
-        set_var(redis, 'making_chart_now', 0)
-        return
-
-    logging.debug('making points...')
-    make_points_from_states(redis, states)
-    logging.debug('making chart...')
-    ok = make_psychrochart(redis)
-    logging.debug('chart DONE')
-    set_var(redis, 'making_chart_now', 0)
-
-    if ok and get_var(redis, 'ha_yaml_changed'):
-        # HA Configuration changed, and the result is OK, saving it now
-        logging.warning('Saving HA config to disk '
-                        '(after producing successfully one chart)')
-        save_homeassistant_config(get_var(redis, 'ha_yaml_config'))
-        remove_var(redis, 'ha_yaml_changed')
-        remove_var(redis, 'ha_yaml_config')
         _load_homeassistant_config()
-
-    if ok and get_var(redis, 'chart_config_changed'):
-        # HA Configuration changed, and the result is OK, saving it now
-        logging.warning('Saving PsychroChart config to disk '
-                        '(after producing successfully one chart)')
-        save_chart_style(get_var(redis, 'chart_style'))
-        save_chart_zones(get_var(redis, 'chart_zones'))
-        remove_var(redis, 'chart_config_changed')
-        remove_var(redis, 'chart_style')
-        remove_var(redis, 'chart_zones')
-        _load_chart_config()
-
+        if get_var(redis, 'ha_push_alive'):
+            logging.debug('HA states are pushed by websocket, no polling')
+        else:
+            logging.debug('loading states and making points...')
+            states = get_ha_states(redis, make_points=True)
+            if not states:
+                logging.error("Can't load HA states!")
+                return
+    finally:
+        try:
+            lease.release()
+        except LockError:
+            logging.error('HA polling lease expired before the poll end')
+
+    # Render in the render worker, which saves any pending config change
+    logging.debug('sending chart render...')
+    send_render_task(celery, redis, only_if_changed=True)
     return True
@@ -8,6 +8,13 @@ __version__ = '0.1'
 
 log_level = os.getenv('LOGGING_LEVEL') or 'INFO'
 prefix_web = os.getenv('API_PREFIX') or ''
+store_chart_state = os.getenv('STORE_CHART_STATE', '').lower() in (
+    '1', 'true', 'yes')
+svg_precision = int(os.getenv('SVG_PRECISION') or 2)
+raster_prewarm = os.getenv('RASTER_PREWARM') or 'png:800'
+pressure_table_step = float(os.getenv('PRESSURE_TABLE_STEP') or .5)
+render_min_interval = float(os.getenv('RENDER_MIN_INTERVAL') or 2)
+history_retention_days = int(os.getenv('HISTORY_RETENTION_DAYS') or 90)
 redis_pwd = os.getenv('REDIS_PWD') or ''
 redis_host = 'redis'
 redis_port = 6379
@@ -22,6 +29,18 @@ class Config(object):
     TESTING = False
     LOG_LEVEL = log_level
     PREFIX_WEB = prefix_web
+    # Store the chart inputs and geometry with the SVG (to rebuild it)
+    STORE_CHART_STATE = store_chart_state
+    # Decimals of the coordinates in the optimized SVG (< 0 to not optimize)
+    SVG_PRECISION = svg_precision
+    # Raster images made with each chart, like 'png:800,webp:1280'
+    RASTER_PREWARM = raster_prewarm
+    # kPa between the nodes of the table of curves by pressure (0 disables it)
+    PRESSURE_TABLE_STEP = pressure_table_step
+    # Min seconds between the starts of two renders (requests are collapsed)
+    RENDER_MIN_INTERVAL = render_min_interval
+    # Days of sensor history kept on disk (0 to keep it all)
+    HISTORY_RETENTION_DAYS = history_retention_days
 
     # Forms protection
     # CSRF_ENABLED = True
@@ -42,3 +61,6 @@ class Config(object):
     CELERY_TASK_IGNORE_RESULT = True
     CELERY_TASK_STORE_ERRORS_EVEN_IF_IGNORED = True
     CELERY_TASK_RESULT_EXPIRES = timedelta(seconds=300)
+    # Chart renders are CPU-bound, done by a prefork worker
+    CELERY_ROUTES = {'create_psychrochart': {'queue': 'render'},
+                     'make_raster_chart': {'queue': 'render'}}
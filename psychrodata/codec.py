@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""Compact binary codec for the cached data (points, arrows, states, ...).
+
+Values are packed with msgpack, preceded by a 2 bytes header: a marker
+never used by msgpack (0xc1) and the codec version. The map keys and the
+style dicts (values of 'style' keys) are stored once, in tables packed
+with the value, and referenced by its index wherever they appear.
+
+Datetimes are supported (as an extension type). Tuples are decoded as
+lists, like with JSON.
+"""
+import datetime as dt
+import struct
+
+import msgpack
+
+
+CODEC_VERSION = 1
+CODEC_MARKER = b'\xc1'
+HEADER = CODEC_MARKER + bytes([CODEC_VERSION])
+
+KEY_STYLE = 'style'
+# Shorter keys are not worth a reference
+MIN_LEN_KEY_REF = 4
+
+# msgpack extension types
+EXT_DATETIME = 1
+EXT_STYLE_REF = 2
+EXT_KEY_REF = 3
+
+EPOCH = dt.datetime(1970, 1, 1)
+# Datetimes as microseconds from epoch and UTC offset in seconds
+DATETIME_STRUCT = struct.Struct('>qi')
+NAIVE_OFFSET = -2 ** 31
+
+
+def is_encoded(raw_value: bytes) -> bool:
+    """Check if some bytes are encoded with this codec (of any version)."""
+    return raw_value[:1] == CODEC_MARKER
+
+
+def _pack_datetime(value):
+    # Naive datetimes are stored with its fields, as if they were UTC
+    offset = value.utcoffset()
+    naive = value.replace(tzinfo=None)
+    if offset is not None:
+        naive -= offset
+    delta = naive - EPOCH
+    microseconds = ((delta.days * 86400 + delta.seconds) * 1000000
+                    + delta.microseconds)
+    return DATETIME_STRUCT.pack(
+        microseconds,
+        int(offset.total_seconds()) if offset is not None else NAIVE_OFFSET)
+
+
+def _unpack_datetime(data):
+    microseconds, offset = DATETIME_STRUCT.unpack(data)
+    value = EPOCH + dt.timedelta(microseconds=microseconds)
+    if offset == NAIVE_OFFSET:
+        return value
+    return value.replace(tzinfo=dt.timezone.utc).astimezone(
+        dt.timezone(dt.timedelta(seconds=offset)))
+
+
+def _make_ref(code, item, table, refs, id_key):
+    ref = refs.get(id_key)
+    if ref is None:
+        index = len(table)
+        ref = msgpack.ExtType(
+            code, index.to_bytes(max(1, (index.bit_length() + 7) // 8),
+                                 'big'))
+        refs[id_key] = ref
+        table.append(item)
+    return ref
+
+
+def _intern(value, tables, refs):
+    """Replace map keys and style dicts with references to its tables."""
+    if isinstance(value, dict):
+        keys, styles = tables
+        key_refs, style_refs = refs
+        new_value = {}
+        for key, item in value.items():
+            if key == KEY_STYLE and isinstance(item, dict):
+                packed = msgpack.packb(item, default=_default,
+                                       use_bin_type=True)
+                item = _make_ref(
+                    EXT_STYLE_REF, item, styles, style_refs, packed)
+            elif isinstance(item, (dict, list, tuple)):
+                item = _intern(item, tables, refs)
+            if isinstance(key, str) and len(key) >= MIN_LEN_KEY_REF:
+                key = _make_ref(EXT_KEY_REF, key, keys, key_refs, key)
+            new_value[key] = item
+        return new_value
+    elif isinstance(value, (list, tuple)):
+        return [_intern(item, tables, refs) for item in value]
+    return value
+
+
+def _default(value):
+    if isinstance(value, dt.datetime):
+        return msgpack.ExtType(EXT_DATETIME, _pack_datetime(value))
+    raise TypeError(f"Can't encode {type(value)}: {value!r}")
+
+
+def encode(value) -> bytes:
+    """Encode a value with the compact codec.
+
+    Raises TypeError if the value contains types not supported.
+    """
+    keys, styles = [], []
+    payload = _intern(value, (keys, styles), ({}, {}))
+    return HEADER + msgpack.packb(
+        [keys, styles, payload], default=_default, use_bin_type=True)
+
+
+def decode(raw_value: bytes):
+    """Decode a value encoded with the compact codec.
+
+    Raises ValueError if the data is not encoded with a known version.
+    """
+    if not is_encoded(raw_value):
+        raise ValueError("Data not encoded with the codec")
+    version = raw_value[1]
+    if version != CODEC_VERSION:
+        raise ValueError(f"Unknown codec version: {version}")
+
+    keys, styles = [], []
+
+    def _ext_hook(code, data):
+        if code == EXT_DATETIME:
+            return _unpack_datetime(data)
+        elif code == EXT_KEY_REF:
+            return keys[int.from_bytes(data, 'big')]
+        elif code == EXT_STYLE_REF:
+            # Copy, so changes in one point don't affect the others
+            return dict(styles[int.from_bytes(data, 'big')])
+        return msgpack.ExtType(code, data)
+
+    # Tables are decoded first (they are before the payload)
+    unpacker = msgpack.Unpacker(
+        ext_hook=_ext_hook, raw=False, strict_map_key=False)
+    unpacker.feed(raw_value[2:])
+    unpacker.read_array_header()
+    keys.extend(unpacker.unpack())
+    styles.extend(unpacker.unpack())
+    return unpacker.unpack()
@@ -19,6 +19,8 @@ CHART_STYLE_DEFAULT = os.path.join(basedir, 'default_chart_style.yaml')
 CHART_STYLE_CUSTOM = os.path.join(customdir, 'custom_chart_style.yaml')
 CHART_ZONES_DEFAULT = os.path.join(basedir, 'default_zones_overlay.yaml')
 CHART_ZONES_CUSTOM = os.path.join(customdir, 'custom_zones_overlay.yaml')
+# Sensor history (in the custom dir, to persist it outside the container)
+HISTORY_DIR = os.path.join(customdir, 'history')
 
 ###############################################################################
 # Common methods
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Metadata and compressed variants of the served content (SVG, JSON).
+
+They are made once, when the content is generated, so the web workers can
+answer conditional requests and send compressed bodies without any work.
+"""
+import gzip
+import hashlib
+from time import time
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+# Supported content encodings, by order of preference
+ENCODINGS = ('br', 'gzip')
+GZIP_LEVEL = 9
+# Max quality (11) is ~6x slower for ~12% less bytes in the chart SVG
+BROTLI_QUALITY = 9
+
+
+def content_meta(content: bytes, ts: float = None) -> dict:
+    """Entity tag (content hash) and generation timestamp of some content."""
+    return {'etag': hashlib.sha1(content).hexdigest(),
+            'ts': ts if ts is not None else time()}
+
+
+def compressed_variants(content: bytes) -> dict:
+    """Compress some content with all the available encodings."""
+    variants = {'gzip': gzip.compress(content, GZIP_LEVEL)}
+    if brotli is not None:
+        variants['br'] = brotli.compress(
+            content, mode=brotli.MODE_TEXT, quality=BROTLI_QUALITY)
+    return variants
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Shape-preserving decimation of time series, to plot them with few points.
+
+- LTTB (Largest-Triangle-Three-Buckets): keeps, in each bucket, the point
+  making the largest triangle with the last kept one and the average of the
+  next bucket. Good for smooth trends.
+- Min/max: keeps the min and the max of each time bucket, so no peak is
+  lost. It also works over pre-aggregated (min, max) rows.
+"""
+import numpy as np
+
+
+def lttb(x, y, num_points):
+    """Return the indexes of the `num_points` LTTB points of (x, y)."""
+    size = len(x)
+    if num_points >= size or size <= 2:
+        return np.arange(size)
+    if num_points < 3:
+        return np.array([0, size - 1])[:max(num_points, 0)]
+
+    # Buckets of the points between the first and the last ones
+    edges = np.linspace(1, size - 1, num_points - 1).astype(int)
+    counts = np.diff(np.append(edges, size))
+    # Averages of the next bucket of each one (the last point for the last)
+    avg_x = np.add.reduceat(x, edges)[1:] / counts[1:]
+    avg_y = np.add.reduceat(y, edges)[1:] / counts[1:]
+    selected = np.empty(num_points, dtype=int)
+    selected[0] = last = 0
+    for i in range(num_points - 2):
+        start, end = edges[i], edges[i + 1]
+        areas = np.abs((x[last] - avg_x[i]) * (y[start:end] - y[last])
+                       - (x[last] - x[start:end]) * (avg_y[i] - y[last]))
+        last = selected[i + 1] = start + int(np.argmax(areas))
+    selected[-1] = size - 1
+    return selected
+
+
+def minmax(x, y_min, y_max, num_points):
+    """Return the (x, y) points with the min and max of each time bucket.
+
+    `y_min` and `y_max` are the same array for raw values, or the min and
+    max of pre-aggregated rows. Up to `num_points` points are returned.
+    """
+    num_buckets = max(num_points // 2, 1)
+    if len(x) <= num_buckets:
+        return x, (y_min + y_max) / 2
+    edges = np.unique(np.searchsorted(
+        x, np.linspace(x[0], x[-1], num_buckets + 1)[1:-1]))
+    xs, ys = [], []
+    for start, end in zip(np.concatenate([[0], edges]),
+                          np.concatenate([edges, [len(x)]])):
+        if end == start or np.isnan(y_min[start:end]).all():
+            continue
+        idx_min = start + np.nanargmin(y_min[start:end])
+        idx_max = start + np.nanargmax(y_max[start:end])
+        for index, values in sorted({idx_min: y_min, idx_max: y_max}.items(),
+                                    key=lambda item: item[0]):
+            xs.append(x[index])
+            ys.append(values[index])
+    return np.array(xs), np.array(ys)
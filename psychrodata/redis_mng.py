@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 """Very simple wrapper methods around the redis object."""
 import json
+import logging
 import pickle
 
 # from psychrocam import redis
@@ -8,11 +9,28 @@ import pickle
 from celery import Celery
 from redis import StrictRedis
 
-from psychrodata import Config
+from psychrodata import Config, codec
 
 
+# Set with the names of all the stored vars
+KEY_VARS_REGISTRY = '_psychrocam_vars'
+# Old per-var type keys (before storing the type with the value)
 PREFIX_TYPE_VAR = '_type_var__key_'
 
+# Type tags of the stored values (1st byte)
+TAG_INT = b'i'
+TAG_FLOAT = b'f'
+TAG_BOOL = b'?'
+TAG_BYTES = b'b'
+TAG_CODEC = b'c'
+TAG_PICKLE = b'p'
+# Old JSON values, only decoded
+TAG_JSON = b'j'
+
+# Pub/sub channels where the new chart and evolution versions are announced
+CHANNEL_CHART_VERSION = 'psychrocam:chart_version'
+CHANNEL_EVOLUTION_VERSION = 'psychrocam:evolution_version'
+
 
 def get_celery(main):
     celery_obj = Celery(
@@ -29,53 +47,153 @@ def get_redis():
         db=Config.REDIS_DB, password=Config.REDIS_PASSWORD)
 
 
-def set_var(redis, key, value, expiration=None, pickle_object=False):
-    type_value = type(value)
-    # print(f'Set var {key}, type: {type_value}')
-    # TODO include dt.now() en metadata
-    redis.set(PREFIX_TYPE_VAR + key, type_value)
-    if isinstance(value, int) or \
-            isinstance(value, float) or \
-            isinstance(value, bytes):
-        redis.set(key, value)
+def _encode_value(value, pickle_object=False):
+    if isinstance(value, bool):
+        return TAG_BOOL + (b'1' if value else b'0')
+    elif isinstance(value, int):
+        return TAG_INT + str(value).encode()
+    elif isinstance(value, float):
+        return TAG_FLOAT + repr(value).encode()
+    elif isinstance(value, bytes):
+        return TAG_BYTES + value
     elif pickle_object:
-        redis.set(key, pickle.dumps(value))
-    else:
-        redis.set(key, json.dumps(value).encode())
+        return TAG_PICKLE + pickle.dumps(value)
+    return TAG_CODEC + codec.encode(value)
 
-    if expiration is not None:
-        # if isinstance(expiration, datetime.datetime):
-        #     redis.expireat(PREFIX_TYPE_VAR + key, expiration)
-        # else:
-        redis.expire(PREFIX_TYPE_VAR + key, expiration)
 
-
-def get_var(redis, key, default=None, unpickle_object=False):
-    type_v = redis.get(PREFIX_TYPE_VAR + key)
-    value = redis.get(key)
-
-    if type_v is None or value is None:
+def _decode_value(raw_value, default=None):
+    if raw_value is None:
         return default
 
-    type_v = type_v.decode()
-    if 'int' in type_v:
+    tag, value = raw_value[:1], raw_value[1:]
+    if tag == TAG_INT:
         return int(value)
-    elif 'float' in type_v:
+    elif tag == TAG_FLOAT:
         return float(value)
-    elif 'bytes' in type_v or 'bool' in type_v:
+    elif tag == TAG_BOOL:
+        return value == b'1'
+    elif tag == TAG_BYTES:
         return value
-    elif unpickle_object:
+    elif tag == TAG_CODEC:
+        try:
+            return codec.decode(value)
+        except ValueError as exc:
+            logging.error(f"Can't decode stored value: {exc}")
+            return default
+    elif tag == TAG_PICKLE:
         return pickle.loads(value)
-    else:
+    elif tag == TAG_JSON:
         return json.loads(value)
+    # Migration: untagged values of the first versions (numbers and JSON)
+    try:
+        return json.loads(raw_value)
+    except ValueError:
+        logging.error(f"Unknown type of stored value: {raw_value[:20]}")
+        return default
+
+
+def _decode_record(raw_record):
+    if raw_record is None:
+        return None
+    elif codec.is_encoded(raw_record):
+        return codec.decode(raw_record)
+    # Old JSON records
+    return json.loads(raw_record)
+
+
+def set_vars(redis, values, expiration=None, pickle_keys=()):
+    """Set many vars in one pipelined round trip.
+
+    Values are stored with its type, and pickled if its key is in
+    `pickle_keys` (or encoded with the compact codec, if not a number or
+    bytes).
+    """
+    pipe = redis.pipeline()
+    for key, value in values.items():
+        pipe.set(key, _encode_value(value, key in pickle_keys),
+                 ex=expiration)
+    pipe.sadd(KEY_VARS_REGISTRY, *values.keys())
+    pipe.execute()
+
+
+def set_var(redis, key, value, expiration=None, pickle_object=False):
+    # TODO include dt.now() en metadata
+    set_vars(redis, {key: value}, expiration=expiration,
+             pickle_keys=(key,) if pickle_object else ())
+
+
+def get_vars(redis, *keys, defaults=None):
+    """Get many vars in one round trip, as a list of values.
+
+    `defaults` is a dict with the default values for missing keys.
+    """
+    defaults = defaults or {}
+    return [_decode_value(raw_value, defaults.get(key))
+            for key, raw_value in zip(keys, redis.mget(keys))]
+
+
+def get_var(redis, key, default=None):
+    return get_vars(redis, key, defaults={key: default})[0]
 
 
 def has_var(redis, key):
-    return redis.exists(PREFIX_TYPE_VAR + key) and redis.exists(key)
+    return redis.exists(key)
+
+
+def remove_vars(redis, *keys):
+    pipe = redis.pipeline()
+    pipe.delete(*keys)
+    pipe.srem(KEY_VARS_REGISTRY, *keys)
+    pipe.execute()
 
 
 def remove_var(redis, key):
-    redis.delete(key, PREFIX_TYPE_VAR + key)
+    remove_vars(redis, key)
+
+
+def append_history(redis, key, record, maxlen, replace_last=False):
+    """Append a record to a capped list (ring buffer), returning its length.
+
+    The records are encoded with the codec, and the oldest ones trimmed to
+    keep `maxlen` records, all in one round trip. With `replace_last`, the
+    record replaces the last one of a non empty list.
+    """
+    pipe = redis.pipeline()
+    pipe.sadd(KEY_VARS_REGISTRY, key)
+    if replace_last:
+        pipe.lset(key, -1, codec.encode(record))
+    else:
+        pipe.rpush(key, codec.encode(record))
+    pipe.ltrim(key, -maxlen, -1)
+    pipe.llen(key)
+    return pipe.execute()[-1]
+
+
+def get_history_items(redis, key, *indexes):
+    """Get some records of a capped list by index (None if not present)."""
+    pipe = redis.pipeline(transaction=False)
+    for index in indexes:
+        pipe.lindex(key, index)
+    return [_decode_record(value) for value in pipe.execute()]
+
+
+def get_history(redis, key, start=0, end=-1):
+    return [_decode_record(value)
+            for value in redis.lrange(key, start, end)]
+
+
+def get_history_len(redis, key):
+    return redis.llen(key)
+
+
+def publish_chart_version(redis, version):
+    """Announce a new chart to the web workers. Returns the num of them."""
+    return redis.publish(CHANNEL_CHART_VERSION, version or '')
+
+
+def publish_evolution_version(redis, version):
+    """Announce new evolution data to the web workers."""
+    return redis.publish(CHANNEL_EVOLUTION_VERSION, version or '')
 
 
 def get_var_keys(redis, pattern='*'):
@@ -83,7 +201,9 @@ def get_var_keys(redis, pattern='*'):
 
 
 def clean_all_vars(redis):
-    all_vars = get_var_keys(redis, pattern=PREFIX_TYPE_VAR + '*')
-    if all_vars:
-        keys = [k.decode()[len(PREFIX_TYPE_VAR):] for k in all_vars]
-        redis.delete(*keys)
+    keys = [k.decode() for k in redis.smembers(KEY_VARS_REGISTRY)]
+    # Migration: remove the vars stored with the old per-var type keys
+    old_type_keys = get_var_keys(redis, pattern=PREFIX_TYPE_VAR + '*')
+    keys += [k.decode()[len(PREFIX_TYPE_VAR):] for k in old_type_keys]
+    keys += [k.decode() for k in old_type_keys]
+    redis.delete(KEY_VARS_REGISTRY, *keys)
@@ -0,0 +1,298 @@
+# -*- coding: utf-8 -*-
+"""Columnar store of the sensor history, in NumPy chunks on disk.
+
+Each sensor has a directory with a chunk of readings for each day. The
+chunk of the current day is a file of rows (`<chunk start ts>.rows`), so
+each new reading is one append, without reading or rewriting the chunk.
+Once the day ends, the chunk is sealed as one file per column
+(`<chunk start ts>.<column>`) with the raw values, so the queries only load
+the chunks and columns they need.
+It lives outside Redis, so it survives the cache cleanings.
+
+Rollups (count, and min, max and mean of each column, in buckets of
+`ROLLUP_LEVELS` seconds) are saved for each chunk when it is complete, so
+the queries of long time ranges read a few rows instead of the readings.
+"""
+import fcntl
+import logging
+import os
+import tempfile
+from urllib.parse import quote, unquote
+
+import numpy as np
+
+from psychrodata import Config
+from psychrodata.common import HISTORY_DIR
+from psychrodata.downsampling import lttb, minmax
+
+
+COLUMNS = (('ts', '<f8'), ('temperature', '<f4'),
+           ('humidity', '<f4'), ('pressure', '<f4'))
+DTYPES = dict(COLUMNS)
+ROW_DTYPE = np.dtype(list(COLUMNS))
+VALUE_COLUMNS = ('temperature', 'humidity', 'pressure')
+CHUNK_SECONDS = 86400
+ROLLUP_LEVELS = (300, 3600)  # seconds
+ROLLUP_DTYPE = np.dtype(
+    [('ts', '<f8'), ('count', '<u4')]
+    + [(f'{column}_{stat}', '<f4')
+       for column in VALUE_COLUMNS for stat in ('min', 'max', 'mean')])
+DOWNSAMPLING_METHODS = ('lttb', 'minmax')
+
+
+class TimeSeriesStore(object):
+    """Readings (temperature, humidity and pressure) by sensor and time."""
+
+    def __init__(self, path, retention_days=0):
+        self.path = path
+        self.retention_days = retention_days
+
+    def _sensor_dir(self, sensor):
+        return os.path.join(self.path, quote(sensor, safe=''))
+
+    def _chunk_path(self, sensor, chunk, column):
+        return os.path.join(self._sensor_dir(sensor), f'{chunk}.{column}')
+
+    def _chunks(self, sensor):
+        try:
+            names = os.listdir(self._sensor_dir(sensor))
+        except FileNotFoundError:
+            return []
+        return sorted({int(name.split('.')[0]) for name in names
+                       if name.endswith(('.ts', '.rows'))})
+
+    def _read_rows(self, sensor, chunk):
+        """Rows of an open chunk, or None if it is sealed."""
+        try:
+            with open(self._chunk_path(sensor, chunk, 'rows'), 'rb') as f:
+                raw = f.read()
+        except FileNotFoundError:
+            return None
+        # Without the last row if it is being appended
+        size = len(raw) // ROW_DTYPE.itemsize
+        return np.frombuffer(raw, dtype=ROW_DTYPE, count=size)
+
+    def _read_chunk(self, sensor, chunk, columns):
+        rows = self._read_rows(sensor, chunk)
+        if rows is not None:
+            return {column: rows[column].copy() for column in columns}
+        return {column: np.fromfile(self._chunk_path(sensor, chunk, column),
+                                    dtype=DTYPES[column])
+                for column in columns}
+
+    def _seal_chunk(self, sensor, chunk):
+        """Convert a complete chunk of rows to one file per column."""
+        rows_path = self._chunk_path(sensor, chunk, 'rows')
+        try:
+            f = open(rows_path, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            rows = self._read_rows(sensor, chunk)
+            if rows is None:
+                return  # Sealed by another process
+            # Timestamps last, as they mark the chunk as sealed
+            for column, _dtype in COLUMNS[1:] + COLUMNS[:1]:
+                fd, tmp_path = tempfile.mkstemp(
+                    dir=self._sensor_dir(sensor))
+                with os.fdopen(fd, 'wb') as f_column:
+                    f_column.write(rows[column].tobytes())
+                os.replace(tmp_path, self._chunk_path(sensor, chunk, column))
+            os.remove(rows_path)
+
+    def sensors(self):
+        """Return the names of the sensors with stored readings."""
+        try:
+            return sorted(unquote(name) for name in os.listdir(self.path))
+        except FileNotFoundError:
+            return []
+
+    def last_ts(self, sensor):
+        """Return the timestamp of the last reading of a sensor, or None."""
+        for chunk in reversed(self._chunks(sensor)):
+            rows_path = self._chunk_path(sensor, chunk, 'rows')
+            if os.path.exists(rows_path):
+                path, dtype = rows_path, ROW_DTYPE
+            else:
+                path, dtype = self._chunk_path(sensor, chunk, 'ts'), \
+                    np.dtype(DTYPES['ts'])
+            try:
+                with open(path, 'rb') as f:
+                    size = os.fstat(f.fileno()).st_size // dtype.itemsize
+                    if not size:
+                        continue
+                    f.seek((size - 1) * dtype.itemsize)
+                    last = np.frombuffer(f.read(dtype.itemsize), dtype=dtype)
+            except FileNotFoundError:
+                return self.last_ts(sensor)  # Sealed while reading
+            return float(last['ts'][0] if dtype.names else last[0])
+        return None
+
+    def append(self, sensor, ts, temperature, humidity, pressure=None):
+        """Append a reading of a sensor, if newer than the last one."""
+        last_ts = self.last_ts(sensor)
+        if last_ts is not None and ts <= last_ts:
+            return False
+
+        os.makedirs(self._sensor_dir(sensor), exist_ok=True)
+        chunk = int(ts // CHUNK_SECONDS) * CHUNK_SECONDS
+        row = np.array((ts, temperature, humidity,
+                        np.nan if pressure is None else pressure),
+                       dtype=ROW_DTYPE)
+        # Unbuffered, so the row is written in a single append
+        with open(self._chunk_path(sensor, chunk, 'rows'), 'ab',
+                  buffering=0) as f:
+            # Appends are serialized, with the check of the last ts
+            fcntl.flock(f, fcntl.LOCK_EX)
+            new_chunk = not os.fstat(f.fileno()).st_size
+            last_ts = self.last_ts(sensor)
+            if last_ts is not None and ts <= last_ts:
+                if new_chunk:
+                    os.remove(f.name)
+                return False
+            f.write(row.tobytes())
+
+        if new_chunk:
+            # The previous chunks are complete now
+            for old_chunk in self._chunks(sensor)[:-1]:
+                self._seal_chunk(sensor, old_chunk)
+                for level in ROLLUP_LEVELS:
+                    self._rollup(sensor, old_chunk, level, complete=True)
+            if self.retention_days:
+                self.prune(sensor, ts - self.retention_days * 86400)
+        return True
+
+    def prune(self, sensor, older_than):
+        """Remove the chunks of a sensor with readings older than a ts."""
+        names = os.listdir(self._sensor_dir(sensor))
+        for chunk in self._chunks(sensor):
+            if chunk + CHUNK_SECONDS > older_than:
+                break
+            for name in names:
+                if name.startswith(f'{chunk}.'):
+                    os.remove(os.path.join(self._sensor_dir(sensor), name))
+            logging.info(f"History of {sensor} from {chunk} removed")
+
+    def _rollup(self, sensor, chunk, level, complete):
+        """Rollup of a chunk, saved once the chunk is complete."""
+        path = self._chunk_path(sensor, chunk, f'r{level}')
+        if complete and os.path.exists(path):
+            return np.fromfile(path, dtype=ROLLUP_DTYPE)
+
+        rollup = _make_rollup(
+            self._read_chunk(sensor, chunk, DTYPES), level)
+        if complete:
+            # Written apart and renamed, so it is never read half written
+            fd, tmp_path = tempfile.mkstemp(dir=self._sensor_dir(sensor))
+            with os.fdopen(fd, 'wb') as f:
+                f.write(rollup.tobytes())
+            os.replace(tmp_path, path)
+        return rollup
+
+    def query_rollup(self, sensor, level, start, end):
+        """Rollup rows (of `ROLLUP_DTYPE`) of a sensor in a time range."""
+        chunks = self._chunks(sensor)
+        parts = [self._rollup(sensor, chunk, level, chunk != chunks[-1])
+                 for chunk in chunks
+                 if chunk < end and chunk + CHUNK_SECONDS > start]
+        if not parts:
+            return np.empty(0, dtype=ROLLUP_DTYPE)
+        rollup = np.concatenate(parts)
+        return rollup[(rollup['ts'] >= start) & (rollup['ts'] < end)]
+
+    def query(self, sensor, start=None, end=None, resolution=None,
+              columns=None):
+        """Readings of a sensor in the [start, end) time range.
+
+        Returns a dict of arrays by column ('ts' always included). With a
+        `resolution` in seconds, they are averaged in buckets of that size.
+        """
+        columns = ['ts'] + [c for c in (columns or DTYPES) if c != 'ts']
+        start = -np.inf if start is None else start
+        end = np.inf if end is None else end
+        parts = [self._read_chunk(sensor, chunk, columns)
+                 for chunk in self._chunks(sensor)
+                 if chunk < end and chunk + CHUNK_SECONDS > start]
+        if not parts:
+            return {column: np.array([], dtype=DTYPES[column])
+                    for column in columns}
+
+        data = {column: np.concatenate([part[column] for part in parts])
+                for column in columns}
+        mask = (data['ts'] >= start) & (data['ts'] < end)
+        data = {column: values[mask] for column, values in data.items()}
+        if resolution:
+            data = _bucket_means(data, resolution)
+        return data
+
+    def downsample(self, sensor, column, start, end, num_points,
+                   method='lttb'):
+        """Readings of a column in a time range, decimated to `num_points`.
+
+        The source is the coarsest rollup level with at least `num_points`
+        buckets in the range, or the readings themselves. Returns the
+        timestamps, the values, and the level used (0 for the readings).
+        """
+        level = next((level for level in reversed(ROLLUP_LEVELS)
+                      if (end - start) / level >= num_points), 0)
+        if level:
+            rollup = self.query_rollup(sensor, level, start, end)
+            ts = rollup['ts'] + level / 2  # Bucket centers
+            values = rollup[f'{column}_mean']
+            values_min = rollup[f'{column}_min']
+            values_max = rollup[f'{column}_max']
+        else:
+            data = self.query(sensor, start, end, columns=[column])
+            ts = data['ts']
+            values = values_min = values_max = data[column]
+
+        valid = ~np.isnan(values)
+        ts, values = ts[valid], values[valid]
+        if method == 'minmax':
+            ts, values = minmax(
+                ts, values_min[valid], values_max[valid], num_points)
+        else:
+            indexes = lttb(ts, values, num_points)
+            ts, values = ts[indexes], values[indexes]
+        return ts, values, level
+
+
+def _make_rollup(data, level):
+    """Count, min, max and mean of each column in buckets of time."""
+    if not len(data['ts']):
+        return np.zeros(0, dtype=ROLLUP_DTYPE)
+    keys = data['ts'] // level
+    starts = np.flatnonzero(np.concatenate([[True], np.diff(keys) != 0]))
+    rollup = np.zeros(len(starts), dtype=ROLLUP_DTYPE)
+    rollup['ts'] = keys[starts] * level
+    rollup['count'] = np.diff(np.append(starts, len(keys)))
+    for column in VALUE_COLUMNS:
+        values = data[column]
+        valid = ~np.isnan(values)
+        with np.errstate(invalid='ignore'):
+            rollup[f'{column}_min'] = np.fmin.reduceat(values, starts)
+            rollup[f'{column}_max'] = np.fmax.reduceat(values, starts)
+            rollup[f'{column}_mean'] = (
+                np.add.reduceat(np.where(valid, values, 0), starts)
+                / np.add.reduceat(valid.astype(int), starts))
+    return rollup
+
+
+def _bucket_means(data, resolution):
+    """Average the readings (ignoring NaNs) in buckets of time."""
+    _, bucket = np.unique(data['ts'] // resolution, return_inverse=True)
+    means = {}
+    for column, values in data.items():
+        valid = ~np.isnan(values)
+        sums = np.bincount(bucket[valid], weights=values[valid],
+                           minlength=bucket.max(initial=-1) + 1)
+        counts = np.bincount(bucket[valid],
+                             minlength=bucket.max(initial=-1) + 1)
+        with np.errstate(invalid='ignore'):
+            means[column] = (sums / counts).astype(values.dtype)
+    return means
+
+
+def get_history_store():
+    return TimeSeriesStore(HISTORY_DIR, Config.HISTORY_RETENTION_DAYS)
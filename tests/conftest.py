@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import fakeredis
+import pytest
+import yaml
+
+from psychrodata.common import CHART_STYLE_DEFAULT, CHART_ZONES_DEFAULT
+
+
+@pytest.fixture
+def redis():
+    redis = fakeredis.FakeStrictRedis()
+    yield redis
+    redis.flushall()
+
+
+@pytest.fixture
+def chart_config():
+    """Default chart style and zones."""
+    with open(CHART_STYLE_DEFAULT) as f:
+        chart_style = yaml.safe_load(f)
+    with open(CHART_ZONES_DEFAULT) as f:
+        zones = yaml.safe_load(f)
+    return chart_style, zones
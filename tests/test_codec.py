@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+import datetime as dt
+import json
+
+import numpy as np
+import pytest
+
+from psychrodata import codec
+from psychrodata.redis_mng import (
+    append_history, get_history_items, get_var, get_vars, set_var,
+    TAG_CODEC, TAG_JSON)
+
+
+STYLE = {'marker': 'o', 'color': [0.8, 0.1, 0.1, 0.6], 'markersize': 15}
+POINTS = {
+    key: {'xy': [20. + i, 40. + i], 'style': dict(STYLE), 'label': key,
+          'ts': 1529565079.5 + i}
+    for i, key in enumerate(['Office', 'Living', 'Kitchen', 'Bedroom'])}
+
+
+def _round_trip(value):
+    return codec.decode(codec.encode(value))
+
+
+def test_round_trip_points_with_shared_styles():
+    assert _round_trip(POINTS) == POINTS
+    # Each style is stored once
+    assert codec.encode(POINTS).count(b'markersize') == 1
+    assert len(codec.encode(POINTS)) < len(json.dumps(POINTS))
+
+
+def test_decoded_styles_are_independent():
+    points = _round_trip(POINTS)
+    points['Office']['style']['color'] = 'red'
+    assert points['Living']['style'] == STYLE
+
+
+def test_round_trip_zones(chart_config):
+    _chart_style, zones = chart_config
+    assert _round_trip(zones) == zones
+
+
+def test_round_trip_tuples_as_lists():
+    assert _round_trip({'xy': (22.5, 45)}) == {'xy': [22.5, 45]}
+
+
+@pytest.mark.parametrize('value', [
+    dt.datetime(2018, 6, 21, 7, 11, 19, 575077),
+    dt.datetime(2018, 6, 21, 7, 11, 19, tzinfo=dt.timezone.utc),
+    dt.datetime(2018, 6, 21, 9, 11, 19,
+                tzinfo=dt.timezone(dt.timedelta(hours=2))),
+])
+def test_round_trip_datetimes(value):
+    decoded = _round_trip({'last_updated': value})['last_updated']
+    assert decoded == value
+    assert decoded.utcoffset() == value.utcoffset()
+
+
+def test_round_trip_int_keys_and_bytes():
+    value = {1: b'\x00\xffsvg', 2: [b'', 'text'], 'long_key': {3: None}}
+    assert _round_trip(value) == value
+
+
+@pytest.mark.parametrize('value', [
+    np.float32(1.5), np.int64(3), np.bool_(True), {'ts': np.int32(7)}])
+def test_numpy_scalars_rejected(value):
+    with pytest.raises(TypeError):
+        codec.encode(value)
+
+
+def test_decode_unknown_data():
+    with pytest.raises(ValueError):
+        codec.decode(b'{"a": 1}')
+    with pytest.raises(ValueError):
+        codec.decode(codec.CODEC_MARKER + bytes([codec.CODEC_VERSION + 1])
+                     + codec.encode(POINTS)[2:])
+
+
+###############################################################################
+# Stored values
+###############################################################################
+@pytest.mark.parametrize('value', [
+    7, -2.5, True, False, b'<svg></svg>', 'text', [1, 'a'], POINTS,
+    {'last_updated': dt.datetime(2018, 6, 21, tzinfo=dt.timezone.utc)}])
+def test_var_round_trip(redis, value):
+    set_var(redis, 'var', value)
+    assert get_var(redis, 'var') == value
+
+
+def test_var_pickled(redis):
+    set_var(redis, 'var', {1, 2}, pickle_object=True)
+    assert get_var(redis, 'var') == {1, 2}
+
+
+def test_var_unknown_codec_version(redis):
+    redis.set('var', TAG_CODEC + codec.CODEC_MARKER
+              + bytes([codec.CODEC_VERSION + 1]))
+    assert get_var(redis, 'var', default={}) == {}
+
+
+def test_decode_tagged_json_values(redis):
+    # Values stored as JSON before the codec
+    redis.set('points', TAG_JSON + json.dumps(POINTS).encode())
+    assert get_var(redis, 'points') == POINTS
+
+
+def test_decode_untagged_values(redis):
+    # Values of the first versions, without type tag
+    redis.set('points', json.dumps(POINTS).encode())
+    redis.set('altitude', b'7')
+    redis.set('pressure_kpa', b'101.71')
+    redis.set('svg_chart', b'<svg></svg>')
+    assert get_vars(redis, 'points', 'altitude', 'pressure_kpa',
+                    'svg_chart', defaults={'svg_chart': b''}) == [
+        POINTS, 7, 101.71, b'']
+
+
+def test_decode_history_records(redis):
+    record = {'Office': [22.5, 45., 1529565079.5]}
+    append_history(redis, 'history_points', record, 10)
+    # Old JSON record, before the codec
+    redis.rpush('history_points', json.dumps(record).encode())
+    assert get_history_items(redis, 'history_points', 0, 1, 2) == [
+        record, record, None]
@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+
+from psychrodata.downsampling import lttb, minmax
+
+
+def _series(size, seed=1):
+    rnd = np.random.RandomState(seed)
+    x = np.cumsum(rnd.uniform(1, 60, size))
+    y = np.cumsum(rnd.normal(0, 1, size))
+    return x, y
+
+
+@pytest.mark.parametrize('size', [0, 1, 2, 5, 100])
+def test_lttb_not_decimated(size):
+    x, y = _series(size)
+    for num_points in (size, size + 1, 1000):
+        assert lttb(x, y, num_points).tolist() == list(range(size))
+
+
+def test_lttb_less_than_3_points():
+    x, y = _series(100)
+    assert lttb(x, y, 2).tolist() == [0, 99]
+    assert lttb(x, y, 1).tolist() == [0]
+    assert lttb(x, y, 0).tolist() == []
+
+
+@pytest.mark.parametrize('num_points', [3, 4, 10, 99])
+def test_lttb_points(num_points):
+    x, y = _series(1000)
+    indexes = lttb(x, y, num_points)
+    assert len(indexes) == num_points
+    assert indexes[0] == 0 and indexes[-1] == 999
+    assert (np.diff(indexes) > 0).all()
+
+
+def test_lttb_keeps_peaks():
+    x = np.arange(1000.)
+    y = np.sin(x / 100)
+    y[[137, 555, 812]] = [50, -50, 30]
+    assert {137, 555, 812} <= set(lttb(x, y, 20).tolist())
+
+
+@pytest.mark.parametrize('num_points', [10, 1000])
+def test_minmax_not_decimated(num_points):
+    x, y = _series(5)
+    x_out, y_out = minmax(x, y, y, num_points)
+    assert x_out.tolist() == x.tolist()
+    assert y_out.tolist() == y.tolist()
+    # Pre-aggregated rows, with the mean of each
+    x_out, y_out = minmax(x, y - 1, y + 1, num_points)
+    assert y_out == pytest.approx(y)
+
+
+@pytest.mark.parametrize('num_points', [0, 1, 2])
+def test_minmax_less_than_3_points(num_points):
+    x, y = _series(100)
+    x_out, y_out = minmax(x, y, y, num_points)
+    assert sorted(y_out) == [y.min(), y.max()]
+    assert x_out.tolist() == sorted(x_out)
+
+
+@pytest.mark.parametrize('num_points', [4, 20, 101])
+def test_minmax_of_each_bucket(num_points):
+    x, y = _series(1000)
+    y_min, y_max = y - np.abs(y) / 10, y + np.abs(y) / 10
+    x_out, y_out = minmax(x, y_min, y_max, num_points)
+    assert len(x_out) <= num_points
+    assert (np.diff(x_out) >= 0).all()
+
+    num_buckets = num_points // 2
+    bounds = np.linspace(x[0], x[-1], num_buckets + 1)
+    bounds[-1] = np.inf
+    for low, high in zip(bounds[:-1], bounds[1:]):
+        in_bucket = (x >= low) & (x < high)
+        selected = (x_out >= low) & (x_out < high)
+        assert sorted(y_out[selected]) == [
+            y_min[in_bucket].min(), y_max[in_bucket].max()]
+
+
+def test_minmax_skips_empty_buckets():
+    x = np.array([0., 1, 2, 100, 101])
+    y = np.array([1., np.nan, 3, np.nan, np.nan])
+    x_out, y_out = minmax(x, y, y, 4)
+    assert x_out.tolist() == [0, 2]
+    assert y_out.tolist() == [1, 3]
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import threading
+
+import pytest
+from redis.exceptions import LockError
+
+from psychrochartmaker import ha_remote_polling
+from psychrochartmaker.ha_remote_polling import (
+    merge_sensor_readings, state_lease)
+from psychrodata.redis_mng import get_history, get_var, get_vars, set_vars
+from psychrodata.timeseries import TimeSeriesStore
+
+
+SENSORS = {'interior': {
+    'Office': {'temperature': 'sensor.t_office',
+               'humidity': 'sensor.h_office', 'style': {'color': 'red'}},
+    'Living': {'temperature': 'sensor.t_living',
+               'humidity': 'sensor.h_living', 'style': {'color': 'blue'}}}}
+TS = 1529565079.
+
+
+@pytest.fixture
+def ha_redis(redis, tmp_path, monkeypatch):
+    monkeypatch.setattr(ha_remote_polling, 'history_store',
+                        TimeSeriesStore(str(tmp_path)))
+    set_vars(redis, {'ha_sensors': SENSORS, 'ha_history': {}})
+    return redis
+
+
+def _readings(sensor, ts, temp, humid):
+    return [{'entity_id': f'sensor.t_{sensor}', 'state': str(temp), 'ts': ts},
+            {'entity_id': f'sensor.h_{sensor}', 'state': str(humid), 'ts': ts}]
+
+
+def test_merge_sensor_readings(ha_redis):
+    assert merge_sensor_readings(ha_redis, _readings('office', TS, 22, 50))
+    # Older readings are ignored
+    assert not merge_sensor_readings(
+        ha_redis, _readings('office', TS - 60, 20, 40))
+    points = get_var(ha_redis, 'last_points')
+    assert points['Office']['xy'] == [22., 50.]
+
+
+def test_concurrent_merges_not_lost(ha_redis):
+    def _push(sensor):
+        for i in range(10):
+            merge_sensor_readings(
+                ha_redis, _readings(sensor, TS + i, 20 + i, 40 + i))
+
+    threads = [threading.Thread(target=_push, args=(sensor,))
+               for sensor in ('office', 'living')]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    pushed_states, states, points = get_vars(
+        ha_redis, 'pushed_states', 'ha_states', 'last_points')
+    assert len(pushed_states) == len(states) == 4
+    assert {key: point['xy'] for key, point in points.items()} == {
+        'Office': [29., 49.], 'Living': [29., 49.]}
+
+
+def test_merge_waits_for_state_lease(ha_redis, monkeypatch):
+    monkeypatch.setattr(ha_remote_polling, 'STATE_LEASE_WAIT', .2)
+    with state_lease(ha_redis):
+        with pytest.raises(LockError):
+            merge_sensor_readings(ha_redis, _readings('office', TS, 22, 50))
+    assert merge_sensor_readings(ha_redis, _readings('office', TS, 22, 50))
+
+
+def test_history_records_by_scan_interval(ha_redis):
+    set_vars(ha_redis, {
+        'ha_sensors': {'interior': {'Office': SENSORS['interior']['Office']}},
+        'ha_history': {'delta_arrows': 600, 'scan_interval': 60}})
+    # A temperature or humidity change every 10s, for 20 min
+    for i in range(120):
+        variable = 't' if i % 2 else 'h'
+        merge_sensor_readings(ha_redis, [{
+            'entity_id': f'sensor.{variable}_office',
+            'state': str(20 + i / 10 if i % 2 else 50), 'ts': TS + 10 * i}])
+
+    # A record each 60s, and the last one, being updated
+    records = get_history(ha_redis, 'history_points')
+    assert len(records) == 10
+    assert {records[i + 1]['Office'][2] - records[i]['Office'][2]
+            for i in range(8)} == {60}
+    span = records[-1]['Office'][2] - records[0]['Office'][2]
+    assert 480 < span <= 540
+
+    arrows, evolution = get_vars(ha_redis, 'arrows', 'ha_evolution')
+    end, start = arrows['Office']['xy']
+    assert end[0] - start[0] == pytest.approx(span / 100)
+    assert evolution['Office']['first']['∆t [min]'] == pytest.approx(
+        span / 60, abs=.05)
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import datetime as dt
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from psychrochartmaker import ha_remote_polling, ha_websocket
+from psychrochartmaker.ha_websocket import (
+    listen_state_changes, update_ha_state)
+from psychrochartmaker.remote import HomeAssistantError, State
+from psychrodata.redis_mng import get_var, set_vars
+from psychrodata.timeseries import TimeSeriesStore
+
+
+SENSORS = {'interior': {
+    'Office': {'temperature': 'sensor.t_office',
+               'humidity': 'sensor.h_office', 'style': {'color': 'red'}}}}
+ENTITIES = {'sensor.t_office', 'sensor.h_office'}
+API_PASSWORD = 'secret'
+TS = dt.datetime(2018, 6, 21, 7, 11, 19, tzinfo=dt.timezone.utc)
+
+
+def _state(entity_id, state, seconds=0):
+    last_updated = TS + dt.timedelta(seconds=seconds)
+    return {'entity_id': entity_id, 'state': state, 'attributes': {},
+            'last_changed': last_updated.isoformat(),
+            'last_updated': last_updated.isoformat()}
+
+
+def _event(entity_id, old_state, new_state):
+    return {'id': 1, 'type': 'event', 'event': {
+        'event_type': 'state_changed',
+        'data': {'entity_id': entity_id, 'old_state': old_state,
+                 'new_state': new_state}}}
+
+
+EVENTS = [
+    _event('sensor.t_office', _state('sensor.t_office', '21', -60),
+           _state('sensor.t_office', '22')),
+    # Not a sensor of the chart
+    _event('sensor.t_garage', _state('sensor.t_garage', '15', -60),
+           _state('sensor.t_garage', '16')),
+    # Only attributes changed
+    _event('sensor.t_office', _state('sensor.t_office', '22'),
+           _state('sensor.t_office', '22', 10)),
+    _event('sensor.h_office', None, _state('sensor.h_office', '50')),
+]
+
+
+def _run_stand_in_server(events, auth_ok=True, **listen_kwargs):
+    """Listen to a stand-in of the HA websocket API sending some events."""
+    received = []
+
+    async def _websocket_handler(request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_json({'type': 'auth_required'})
+        msg = await ws.receive_json()
+        received.append(msg)
+        if not auth_ok or msg.get('api_password') != API_PASSWORD:
+            await ws.send_json({'type': 'auth_invalid'})
+            await ws.close()
+            return ws
+        await ws.send_json({'type': 'auth_ok'})
+        msg = await ws.receive_json()
+        received.append(msg)
+        await ws.send_json({'id': msg['id'], 'type': 'result',
+                            'success': True, 'result': None})
+        for event in events:
+            await ws.send_json(event)
+        await ws.close()
+        return ws
+
+    async def _listen():
+        app = web.Application()
+        app.router.add_get(ha_websocket.URL_API_WEBSOCKET, _websocket_handler)
+        async with TestServer(app) as server:
+            url = str(server.make_url(ha_websocket.URL_API_WEBSOCKET))
+            await listen_state_changes(url, **listen_kwargs)
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(_listen())
+    finally:
+        loop.close()
+    return received
+
+
+def test_listen_state_changes():
+    states = []
+    received = _run_stand_in_server(
+        EVENTS, api_password=API_PASSWORD, entity_ids=ENTITIES,
+        on_state_changed=states.append)
+
+    assert received == [
+        {'type': 'auth', 'api_password': API_PASSWORD},
+        {'id': 1, 'type': 'subscribe_events', 'event_type': 'state_changed'}]
+    assert [(s.entity_id, s.state, s.last_updated) for s in states] == [
+        ('sensor.t_office', '22', TS), ('sensor.h_office', '50', TS)]
+
+
+def test_listen_state_changes_auth_error():
+    with pytest.raises(HomeAssistantError):
+        _run_stand_in_server(
+            EVENTS, auth_ok=False, api_password=API_PASSWORD,
+            entity_ids=ENTITIES, on_state_changed=lambda state: None)
+
+
+@pytest.fixture
+def ha_redis(redis, tmp_path, monkeypatch):
+    monkeypatch.setattr(ha_remote_polling, 'history_store',
+                        TimeSeriesStore(str(tmp_path)))
+    set_vars(redis, {'ha_sensors': SENSORS, 'ha_history': {}})
+    return redis
+
+
+def test_stale_state_changes_ignored(ha_redis):
+    states = []
+    _run_stand_in_server(
+        EVENTS, api_password=API_PASSWORD, entity_ids=ENTITIES,
+        on_state_changed=states.append)
+    assert all(update_ha_state(ha_redis, state) for state in states)
+    assert get_var(ha_redis, 'last_points')['Office']['xy'] == [22., 50.]
+
+    # An event delivered late, older than the stored state
+    late_state = State.from_dict(_state('sensor.t_office', '20', -30))
+    assert not update_ha_state(ha_redis, late_state)
+    ha_states = get_var(ha_redis, 'ha_states')
+    assert ha_states['sensor.t_office']['state'] == '22'
+    assert get_var(ha_redis, 'last_points')['Office']['xy'] == [22., 50.]
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import matplotlib
+import pytest
+
+from psychrochartmaker import make_charts, raster_var
+from psychrochartmaker.make_charts import (
+    clear_chart_backgrounds, make_psychrochart, make_raster_chart)
+from psychrodata.redis_mng import get_var, remove_vars, set_vars
+
+
+POINTS = {
+    'Office': {'xy': (24.5, 45.), 'style': {'marker': 'o', 'color': 'red'},
+               'label': 'Office'},
+    'Living': {'xy': (21., 55.), 'style': {'marker': 'o', 'color': 'blue'},
+               'label': 'Living'}}
+
+
+@pytest.fixture
+def chart_redis(redis, chart_config, monkeypatch):
+    # Same SVG ids in each render, to compare them
+    monkeypatch.setitem(matplotlib.rcParams, 'svg.hashsalt', 'test')
+    chart_style, zones = chart_config
+    set_vars(redis, {'chart_style': chart_style, 'chart_zones': zones,
+                     'last_points': POINTS})
+    clear_chart_backgrounds()
+    yield redis
+    clear_chart_backgrounds()
+
+
+def _broken(*args, **kwargs):
+    raise RuntimeError('Broken render step')
+
+
+def test_overlay_removed_after_render_error(chart_redis, monkeypatch):
+    make_psychrochart(chart_redis)
+    svg = get_var(chart_redis, 'svg_chart')
+
+    with monkeypatch.context() as m:
+        m.setattr(make_charts, 'optimize_svg', _broken)
+        with pytest.raises(RuntimeError):
+            make_psychrochart(chart_redis)
+
+    # Same chart, without the points of the failed render
+    make_psychrochart(chart_redis)
+    assert get_var(chart_redis, 'svg_chart') == svg
+
+
+def test_chart_background_dropped_if_overlay_not_removed(
+        chart_redis, monkeypatch):
+    make_psychrochart(chart_redis)
+    chart = next(iter(make_charts._chart_backgrounds.values()))
+
+    with monkeypatch.context() as m:
+        m.setattr(make_charts, '_remove_overlay', _broken)
+        make_psychrochart(chart_redis)
+    assert chart not in make_charts._chart_backgrounds.values()
+
+    make_psychrochart(chart_redis)
+    assert len(make_charts._chart_backgrounds) == 1
+
+
+def test_raster_chart_of_last_chart_version(chart_redis):
+    make_psychrochart(chart_redis, raster_sizes=[('png', 400)])
+    png = get_var(chart_redis, raster_var('png', 400))
+    etag = get_var(chart_redis, 'svg_chart_meta')['etag']
+    assert png['version'] == etag
+
+    # New readings, not rendered yet
+    set_vars(chart_redis, {'last_points': {
+        'Office': dict(POINTS['Office'], xy=(30., 70.))}})
+    remove_vars(chart_redis, raster_var('png', 400))
+    assert make_raster_chart(chart_redis, 'png', 400)
+    assert get_var(chart_redis, raster_var('png', 400)) == png
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from psychrochart.chart import PsychroChart, load_config
+
+from psychrochartmaker import make_charts
+from psychrochartmaker.chart_geometry import CURVE_FAMILIES
+from psychrochartmaker.make_charts import (
+    clear_chart_backgrounds, get_chart_background)
+from psychrochartmaker.pressure_table import PressureTable
+
+
+# Off-node pressures (kPa), with the default step of 0.5 kPa
+PRESSURES = (75.13, 82.11, 88.83, 95.23, 101.16, 109.38)
+# Curves with points solved by iteration in psychrochart, with the
+# tolerance of its solver in the direct charts too
+SOLVED_FAMILIES = ('constant_v', 'constant_humidity')
+
+
+def _direct_chart(chart_style, zones, pressure_kpa):
+    chart_style = load_config(chart_style)
+    chart_style['limits']['pressure_kpa'] = pressure_kpa
+    chart_style['limits'].pop('altitude_m', None)
+    return PsychroChart(chart_style, zones)
+
+
+def _max_errors(family, family_direct):
+    assert len(family.curves) == len(family_direct.curves)
+    errors = [(np.abs(np.subtract(curve.x_data, direct.x_data)).max(),
+               np.abs(np.subtract(curve.y_data, direct.y_data)).max())
+              for curve, direct in zip(family.curves, family_direct.curves)
+              if len(direct.x_data)]
+    return np.max(errors, axis=0) if errors else (0, 0)
+
+
+@pytest.fixture
+def table(chart_config):
+    return PressureTable(*chart_config)
+
+
+@pytest.mark.parametrize('pressure_kpa', PRESSURES)
+def test_interpolated_curves_as_direct_ones(table, chart_config,
+                                            pressure_kpa):
+    chart = table.make_chart(pressure_kpa)
+    direct = _direct_chart(*chart_config, pressure_kpa)
+    assert chart.p_atm_kpa == pressure_kpa
+
+    for name, attr in CURVE_FAMILIES:
+        if getattr(direct, attr) is None:
+            assert getattr(chart, attr) is None
+            continue
+        error_t, error_w = _max_errors(
+            getattr(chart, attr), getattr(direct, attr))
+        if name in SOLVED_FAMILIES:
+            assert error_t < .1 and error_w < .05, name
+        else:
+            # Interpolation error of the humidity ratio, < 0.001 g/kg
+            assert error_t == 0 and error_w < 1e-3, name
+    assert len(chart.zones) == len(direct.zones)
+    for zone, zone_direct in zip(chart.zones, direct.zones):
+        assert _max_errors(zone, zone_direct)[1] < 1e-3
+
+
+def test_pressure_table_nodes(table, chart_config):
+    chart = table.make_chart(95.)
+    direct = _direct_chart(*chart_config, 95.)
+    for _name, attr in CURVE_FAMILIES:
+        if getattr(direct, attr) is not None:
+            assert tuple(_max_errors(
+                getattr(chart, attr), getattr(direct, attr))) == (0, 0)
+    # Only the needed nodes are computed
+    assert len(table) == 1
+    table.make_chart(95.23)
+    assert len(table) == 2
+    assert table.make_chart(74.9) is None
+    assert table.make_chart(110.1) is None
+
+
+def _broken(*args, **kwargs):
+    raise RuntimeError('Pressure table used')
+
+
+def test_no_pressure_table_with_step_0(chart_config, monkeypatch):
+    chart_style, zones = chart_config
+    clear_chart_backgrounds()
+    monkeypatch.setattr(make_charts, 'PressureTable', _broken)
+    chart = get_chart_background(
+        chart_style, zones, pressure_kpa=95.23, pressure_step=0)
+    assert not make_charts._pressure_tables
+    assert chart.p_atm_kpa == 95.23
+    # Same curves as the computed ones
+    direct = _direct_chart(chart_style, zones, 95.23)
+    for _name, attr in CURVE_FAMILIES:
+        if getattr(direct, attr) is not None:
+            assert tuple(_max_errors(
+                getattr(chart, attr), getattr(direct, attr))) == (0, 0)
+
+    with pytest.raises(RuntimeError):
+        get_chart_background(
+            chart_style, zones, pressure_kpa=95.23, pressure_step=.5)
+    clear_chart_backgrounds()
@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import pytest
+from psychrochart import equations
+from psychrochart.chart import curve_constant_humidity_ratio
+
+from psychrochartmaker.heatmap import heatmap_grid, update_heatmap
+from psychrochartmaker.psychrometrics import (
+    derived_properties, humidity_ratio, saturation_pressure)
+
+
+TEMPS = np.arange(-20, 50.5, .5)
+P_ATM_KPA = 95.
+
+
+@pytest.mark.parametrize('mode', [1, 2, 3])
+def test_saturation_pressure_as_psychrochart(mode):
+    expected = [equations.saturation_pressure_water_vapor(t, mode=mode)
+                for t in TEMPS]
+    p_sat = saturation_pressure(TEMPS, mode)
+    assert p_sat == pytest.approx(expected, rel=1e-9)
+
+    expected = [equations.humidity_ratio(p * .6, P_ATM_KPA)
+                for p in expected]
+    assert humidity_ratio(p_sat * .6, P_ATM_KPA) == pytest.approx(
+        expected, rel=1e-9)
+
+
+def test_derived_properties_as_psychrochart():
+    properties = derived_properties(TEMPS, 60, P_ATM_KPA)
+    p_vapor = [equations.saturation_pressure_water_vapor(t) * .6
+               for t in TEMPS]
+    assert properties['humidity_ratio'] == pytest.approx(
+        [1000 * equations.humidity_ratio(p, P_ATM_KPA) for p in p_vapor])
+    assert properties['dew_point'] == pytest.approx(
+        [equations.dew_point_temperature(p) for p in p_vapor])
+    assert properties['enthalpy'] == pytest.approx(
+        [equations.enthalpy_moist_air(t, p, P_ATM_KPA)
+         for t, p in zip(TEMPS, p_vapor)])
+    assert properties['specific_volume'] == pytest.approx(
+        [equations.specific_volume(t, p, P_ATM_KPA)
+         for t, p in zip(TEMPS, p_vapor)])
+    # Its humidity ratio, with the psychrochart equations
+    assert [1000 * equations.humidity_ratio_from_temps(t, t_wet, P_ATM_KPA)
+            for t, t_wet in zip(TEMPS, properties['wet_bulb'])] \
+        == pytest.approx(properties['humidity_ratio'], abs=1e-5)
+
+
+def test_heatmap_bins_of_plotted_points(chart_config):
+    chart_style, _zones = chart_config
+    grid = heatmap_grid(chart_style, (1, .1))
+    t_min, t_max, w_min, w_max, n_t, n_w = grid
+    readings = {f's{i}': (1., t, 50.)
+                for i, t in enumerate(np.arange(t_min + .5, t_max, 1.5))}
+    state = {}
+    update_heatmap(state, readings, grid, P_ATM_KPA)
+
+    for key, (_ts, temp, humid) in readings.items():
+        # Same humidity ratio as the point in the chart
+        w_g_kg = curve_constant_humidity_ratio(
+            [temp], humid, P_ATM_KPA)[0]
+        if not w_min <= w_g_kg < w_max:
+            assert not state['sensors'][key]['slices']
+            continue
+        row = int((w_g_kg - w_min) / (w_max - w_min) * n_w)
+        col = int((temp - t_min) / (t_max - t_min) * n_t)
+        (_start, counts), = state['sensors'][key]['slices']
+        assert counts == {str(row * n_t + col): 1}
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import json
+import random
+
+import pytest
+
+from psychrochartmaker.remote import iter_json_array
+
+
+ARRAYS = [
+    [{'entity_id': 'sensor.t_office', 'state': '22.5',
+      'attributes': {'unit_of_measurement': '°C', 'values': [1, 2]}},
+     {'entity_id': 'sensor.h_office', 'state': '50', 'attributes': {}}],
+    [1234, -5.25e-3, 0, 98765432101234, 7],
+    ['one', 'two, "quoted" ]', '', 'ünïcode \\ €'],
+    [True, False, None, [[]], {}, 'mixed', 1.5],
+    [],
+]
+
+
+def _random_chunks(text, rnd):
+    cuts = sorted(rnd.sample(range(1, len(text)),
+                             min(len(text) - 1, rnd.randint(1, 12))))
+    return [text[i:j] for i, j in zip([0] + cuts, cuts + [len(text)])]
+
+
+@pytest.mark.parametrize('array', ARRAYS)
+def test_iter_json_array_random_chunks(array):
+    rnd = random.Random(42)
+    for text in (json.dumps(array), json.dumps(array, indent=2)):
+        assert list(iter_json_array([text])) == array
+        # All the splits of one cut, and random splits of more
+        for i in range(1, len(text)):
+            assert list(iter_json_array([text[:i], text[i:]])) == array
+        for _ in range(50):
+            chunks = _random_chunks(text, rnd)
+            assert list(iter_json_array(chunks)) == array
+
+
+def test_iter_json_array_split_number():
+    assert list(iter_json_array(['[12', '34]'])) == [1234]
+    assert list(iter_json_array(['[1', '2', '.', '5e', '1, 3', ']'])) \
+        == [125, 3]
+
+
+@pytest.mark.parametrize('chunks', [
+    ['{"a": 1}'], ['[1, 2'], ['[1, {"a": '], ['12']])
+def test_iter_json_array_errors(chunks):
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunks))
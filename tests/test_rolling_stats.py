@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from psychrochartmaker.rolling_stats import (
+    PANE_START, PANES_PER_WINDOW, rolling_stats, update_rolling_stats)
+
+
+TS_START = 1539000000  # a multiple of all pane sizes
+WINDOWS = (900, 3600)
+
+
+def _feed(state, readings, windows=WINDOWS):
+    for ts, temp, humid in readings:
+        assert update_rolling_stats(state, {'s': (ts, temp, humid)}, windows)
+
+
+def test_rolling_stats_slope():
+    state = {}
+    _feed(state, [(TS_START + t, 20 + 1.5 * t / 3600 + 1e-5, 50.)
+                  for t in range(0, 7201, 60)])
+    stats = rolling_stats(state, WINDOWS)['s']
+    assert set(stats) == {'15min', '1h'}
+    for label in ('15min', '1h'):
+        assert stats[label]['T [°C]']['∆T [°C/h]'] == pytest.approx(1.5)
+        assert stats[label]['HR [%]']['∆HR [%/h]'] == 0
+        assert stats[label]['HR [%]']['min'] == 50
+        assert stats[label]['T [°C]']['max'] == 23
+    assert stats['1h']['T [°C]']['mean'] == pytest.approx(22.25, abs=.05)
+
+    # Old or repeated readings are ignored
+    assert not update_rolling_stats(state, {'s': (TS_START + 7200, 0, 0)})
+    assert rolling_stats(state, WINDOWS)['s'] == stats
+
+
+def test_rolling_stats_comfort_time():
+    state = {}
+    readings = []
+    for t in range(0, 3601, 60):
+        humid = 20. if t < 900 else (50. if t < 2700 else 80.)
+        readings.append((TS_START + t, 22., humid))
+    _feed(state, readings, (3600,))
+    stats = rolling_stats(state, (3600,))['s']['1h']
+    assert stats['num_readings'] == 61
+    assert stats['HR [%]']['below [%]'] == 25
+    assert stats['HR [%]']['above [%]'] == 25
+    assert stats['T [°C]']['below [%]'] == stats['T [°C]']['above [%]'] == 0
+
+    # With its own comfort ranges
+    state = {}
+    for ts, temp, humid in readings:
+        update_rolling_stats(state, {'s': (ts, temp, humid)}, (3600,),
+                             comfort={'temperature': (23, 30)})
+    stats = rolling_stats(state, (3600,))['s']['1h']
+    assert stats['T [°C]']['below [%]'] == 100
+    assert stats['HR [%]']['below [%]'] == 25
+
+
+def test_rolling_stats_panes_expire():
+    state = {}
+    _feed(state, [(TS_START + t, t / 60 + 1 / 3, 50.)
+                  for t in range(0, 7201, 60)])
+    last_ts = TS_START + 7200
+    for window in WINDOWS:
+        pane_size = window / PANES_PER_WINDOW
+        panes = state['s']['panes'][str(window)]
+        assert len(panes) <= PANES_PER_WINDOW + 1
+        assert panes[0][PANE_START] + pane_size > last_ts - window
+
+    stats = rolling_stats(state, WINDOWS)['s']
+    # Only the readings of the window, and of its partial oldest pane
+    temp_stats = stats['15min']['T [°C]']
+    assert stats['15min']['num_readings'] == 16
+    assert temp_stats['min'] == 105.33
+    assert temp_stats['max'] == 120.33
+    assert stats['1h']['num_readings'] == 61
+    assert stats['1h']['T [°C]']['min'] == 60.33
+
+    # A window not configured anymore is dropped
+    _feed(state, [(last_ts + 60, 0., 50.)], (900,))
+    assert set(state['s']['panes']) == {'900'}
+    assert set(rolling_stats(state, (900,))['s']) == {'15min'}
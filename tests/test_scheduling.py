@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import pytest
+
+from psychrochartmaker import (
+    RENDER_QUEUE, TASK_CREATE_PSYCHROCHART, TASK_MAKE_RASTER_CHART,
+    end_raster_request, render_lease, send_raster_task, send_render_task,
+    take_render_request, tasks)
+from psychrodata import Config
+
+
+class CeleryStub(object):
+    """Records the tasks sent, as (name, options)."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_task(self, name, **options):
+        self.sent.append((name, options))
+        return len(self.sent)
+
+
+def test_raster_requests_collapsed(redis):
+    celery = CeleryStub()
+    assert send_raster_task(celery, redis, 'png', 1280, expires=10)
+    # Requests of the same image, while it is being made
+    assert send_raster_task(celery, redis, 'png', 1280, expires=10) is None
+    assert send_raster_task(celery, redis, 'png', 1280, expires=10) is None
+    assert send_raster_task(celery, redis, 'webp', 1280, expires=10)
+    assert celery.sent == [
+        (TASK_MAKE_RASTER_CHART, {'args': [image_type, 1280],
+                                  'queue': RENDER_QUEUE, 'expires': 10})
+        for image_type in ('png', 'webp')]
+    assert 0 < redis.ttl('raster_request:png:1280') <= 11
+
+    end_raster_request(redis, 'png', 1280)
+    assert send_raster_task(celery, redis, 'png', 1280, expires=10)
+    assert len(celery.sent) == 3
+
+
+def test_render_requests_collapsed(redis):
+    celery = CeleryStub()
+    assert send_render_task(celery, redis, only_if_changed=True)
+    for only_if_changed in (True, False, True):
+        assert send_render_task(celery, redis, only_if_changed) is None
+    (name, options), = celery.sent
+    assert name == TASK_CREATE_PSYCHROCHART
+    assert options['kwargs'] == {'only_if_changed': True}
+    assert options['queue'] == RENDER_QUEUE
+    assert options['countdown'] == 0
+
+    # The render starts: new requests wait for the min interval
+    assert take_render_request(redis)
+    for _ in range(5):
+        send_render_task(celery, redis, only_if_changed=True)
+    assert len(celery.sent) == 2
+    countdown = celery.sent[-1][1]['countdown']
+    assert Config.RENDER_MIN_INTERVAL - 1 < countdown \
+        <= Config.RENDER_MIN_INTERVAL
+    assert not take_render_request(redis)
+
+
+@pytest.mark.parametrize('requests', [
+    (False, True, True), (True, False, True), (True, True, False)])
+def test_render_force_request_kept(redis, requests):
+    celery = CeleryStub()
+    for only_if_changed in requests:
+        send_render_task(celery, redis, only_if_changed)
+    assert len(celery.sent) == 1
+    assert take_render_request(redis)
+
+
+def _broken(*args, **kwargs):
+    raise RuntimeError('Broken render')
+
+
+def test_render_lease_released_after_error(redis, monkeypatch):
+    celery = CeleryStub()
+    monkeypatch.setattr(tasks, 'redis', redis)
+    monkeypatch.setattr(tasks, 'celery', celery)
+    monkeypatch.setattr(tasks, 'make_psychrochart', _broken)
+    send_render_task(celery, redis)
+    with pytest.raises(RuntimeError):
+        tasks.create_psychrochart(only_if_changed=True)
+    assert not take_render_request(redis)
+
+    lease = render_lease(redis)
+    assert lease.acquire(blocking=False)
+    # A render while another one runs is rescheduled
+    assert tasks.create_psychrochart(only_if_changed=True) is False
+    assert celery.sent[-1][1]['countdown'] == Config.RENDER_MIN_INTERVAL
+    lease.release()
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+from collections import Counter
+from io import BytesIO
+import os
+import xml.etree.ElementTree as ElementTree
+
+import numpy as np
+import pytest
+
+from psychrochartmaker.svg_optimizer import optimize_svg
+
+
+SVG_CHART = os.path.join(
+    os.path.dirname(__file__), '..', 'screenshots', 'svgchart.svg')
+# Elements drawing something in the chart
+DRAWING_TAGS = ('path', 'use', 'text', 'rect')
+
+
+def _svg(*paths):
+    return ('<svg xmlns="http://www.w3.org/2000/svg">'
+            + ''.join(f'<path d="M 0 {i} L 10 {i}" style="{style}"/>'
+                      for i, style in enumerate(paths))
+            + '</svg>').encode()
+
+
+def _tags(svg):
+    return Counter(element.tag.split('}')[1]
+                   for element in ElementTree.fromstring(svg).iter())
+
+
+@pytest.mark.parametrize('style', [
+    'fill:none;stroke:#ff0000;',
+    # matplotlib 3.x style
+    'fill: none; stroke: #ff0000',
+    'fill:none;opacity:1;stroke:#ff0000;stroke-opacity:1.0;'])
+def test_opaque_strokes_merged(style):
+    svg = optimize_svg(_svg(style, style, style))
+    assert _tags(svg)['path'] == 1
+    path = ElementTree.fromstring(svg).find('{*}path')
+    assert path.get('d') == 'M0 0L10 0M0 1L10 1M0 2L10 2'
+
+
+@pytest.mark.parametrize('style', [
+    'fill:none;opacity:0.7;stroke:#ff0000;',
+    'fill: none; stroke: #ff0000; stroke-opacity: 0.5',
+    'fill:#ff0000;stroke:#ff0000;'])
+def test_translucent_or_filled_paths_not_merged(style):
+    assert _tags(optimize_svg(_svg(style, style)))['path'] == 2
+
+
+def test_optimize_chart_svg():
+    with open(SVG_CHART, 'rb') as f:
+        svg = f.read()
+    optimized = optimize_svg(svg)
+    assert len(optimized) < len(svg) * .7
+
+    # All the chart curves are translucent, so only groups are removed
+    tags, new_tags = _tags(svg), _tags(optimized)
+    assert sum(new_tags.values()) < sum(tags.values())
+    assert all(new_tags[tag] == tags[tag] for tag in DRAWING_TAGS)
+
+
+def test_optimized_chart_svg_rasterized():
+    cairosvg = pytest.importorskip('cairosvg')
+    Image = pytest.importorskip('PIL.Image')
+
+    def _rasterize(svg):
+        png = cairosvg.svg2png(bytestring=svg, background_color='white')
+        return np.asarray(Image.open(BytesIO(png)).convert('RGB'), dtype=int)
+
+    with open(SVG_CHART, 'rb') as f:
+        svg = f.read()
+    image, new_image = _rasterize(svg), _rasterize(optimize_svg(svg))
+    assert image.shape == new_image.shape
+    # Only antialiasing differences, of the rounded coordinates
+    diff = np.abs(image - new_image)
+    assert diff.mean() < .5
+    assert (diff.max(axis=2) > 64).mean() < .001
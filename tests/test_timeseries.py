@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+import numpy as np
+
+from psychrodata.timeseries import CHUNK_SECONDS, TimeSeriesStore
+
+
+DAY = 1529539200  # 21/06/2018 00:00 UTC
+
+
+def test_append_and_query(tmp_path):
+    store = TimeSeriesStore(str(tmp_path))
+    for i in range(6):
+        assert store.append('Office', DAY + i * CHUNK_SECONDS / 3,
+                            20 + i, 40 + i, 101.3)
+    # Readings not newer than the last one are ignored
+    assert not store.append('Office', DAY, 10, 10)
+    assert store.last_ts('Office') == DAY + 5 * CHUNK_SECONDS / 3
+
+    data = store.query('Office')
+    assert data['ts'].tolist() == [DAY + i * CHUNK_SECONDS / 3
+                                   for i in range(6)]
+    assert data['temperature'].tolist() == [20, 21, 22, 23, 24, 25]
+    assert np.allclose(data['pressure'], 101.3)
+
+    # Complete chunks are sealed as one file per column
+    names = os.listdir(os.path.join(str(tmp_path), 'Office'))
+    assert f'{DAY}.ts' in names and f'{DAY}.rows' not in names
+    assert f'{DAY + CHUNK_SECONDS}.rows' in names
+
+    data = store.query('Office', DAY + CHUNK_SECONDS / 2, DAY + CHUNK_SECONDS,
+                       columns=['humidity'])
+    assert list(data) == ['ts', 'humidity']
+    assert data['humidity'].tolist() == [42]
+
+
+def test_concurrent_appends(tmp_path):
+    store = TimeSeriesStore(str(tmp_path))
+
+    def _append(offset):
+        for i in range(300):
+            store.append('Office', DAY + 2 * i + offset, 20, 40)
+
+    threads = [threading.Thread(target=_append, args=(offset,))
+               for offset in (0, 1)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    ts = store.query('Office')['ts']
+    assert len(ts) > 300
+    assert (np.diff(ts) > 0).all()
+
+
+def test_rollups(tmp_path):
+    store = TimeSeriesStore(str(tmp_path))
+    for i in range(4):
+        store.append('Office', DAY + i * 1800, 20 + i, 40, None)
+    store.append('Office', DAY + CHUNK_SECONDS, 30, 50)
+
+    rollup = store.query_rollup('Office', 3600, DAY, DAY + 2 * CHUNK_SECONDS)
+    assert rollup['count'].tolist() == [2, 2, 1]
+    assert rollup['temperature_mean'].tolist() == [20.5, 22.5, 30]
+    assert np.isnan(rollup['pressure_mean'][:2]).all()
+
+    # Empty chunk, as just created by an append
+    open(os.path.join(str(tmp_path), 'Office',
+                      f'{DAY + 2 * CHUNK_SECONDS}.rows'), 'wb').close()
+    assert not len(store.query_rollup(
+        'Office', 3600, DAY + 2 * CHUNK_SECONDS, DAY + 3 * CHUNK_SECONDS))